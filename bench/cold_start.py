@@ -0,0 +1,56 @@
+"""
+冷启动基准：在全新的进程中测量从导入编译器到第一次编译完成的耗时。
+
+对比两种方式：使用预生成的 public/rop_parsers.py（standalone），
+以及屏蔽该模块、改用 lark 包现场分析语法（lark）。
+
+用法:
+    python bench/cold_start.py [-n 5]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import sys, time, io, contextlib
+start = time.perf_counter()
+if {block_standalone}:
+    sys.modules["rop_parsers"] = None
+sys.path.insert(0, {public!r})
+import compiler
+libraries = {{name: open({libdir!r} + "/" + name, encoding="utf-8").read()
+             for name in ("basic-991cnx-verc.ggt", "basic-common.macro")}}
+source = "import basic-991cnx-verc.ggt\nimport basic-common.macro\n@block.main:\n*print (d522)\n*delay ()\n@blockend\n"
+with contextlib.redirect_stdout(io.StringIO()):
+    result = compiler.compile_to_bytecode(source, libraries)
+assert "error" not in result, result
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def run(block_standalone):
+    code = CHILD.format(
+        block_standalone=block_standalone,
+        public=os.path.join(ROOT, "public"),
+        libdir=os.path.join(ROOT, "public", "vendor", "libraries"),
+    )
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="冷启动基准")
+    arg_parser.add_argument("-n", type=int, default=5, help="每种方式启动的进程数")
+    args = arg_parser.parse_args()
+
+    for label, block_standalone in (("standalone", False), ("lark", True)):
+        timings = [run(block_standalone) for _ in range(args.n)]
+        print(f"{label:<11} import -> first compile: median {statistics.median(timings):7.1f} ms  (min {min(timings):.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+磁盘缓存基准：在临时目录中生成一批程序（其中一半导入一个共享的宏库），用 tools/ropc.py --cache 依次
+冷编译、不做修改重新编译、修改共享宏库中的一个宏后重新编译，对比耗时与直接使用缓存结果的程序数，
+并检查使用缓存时的输出与不使用缓存时逐字节相同。
+
+用法:
+    python bench/compile_cache.py [--programs 200] [-j 4]
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB_DIR = os.path.join(ROOT, "public", "vendor", "libraries")
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+import ropc  # noqa: E402
+
+SHARED = "*shared_init (v) {{\n    $er0= %_v_% $er2= {0}\n}}\n*shared_other (v) {{\n    $er4= %_v_%\n}}\n"
+
+
+def gen_program(i):
+    # 偶数号程序导入 shared.macro，其中只有一半用到被修改的 *shared_init
+    header = "import basic-991cnx-verc.ggt\nimport basic-common.macro\n"
+    blocks = []
+    for j in range(8):
+        calls = f"    *print (d522, {(i + j) % 256:02x})\n    *memcpy (d200, d300, 0010)\n    @adr.l{j}\n    *jump_er14 (#l{j})\n"
+        if i % 2 == 0:
+            calls += f"    *shared_{'init' if i % 4 == 0 else 'other'} ({j:04x})\n"
+        blocks.append(f"@block.b{j}:\n    @offset=d180\n    @rstoffst\n{calls}@blockend\n")
+    return header + ("import shared.macro\n" if i % 2 == 0 else "") + "\n".join(blocks)
+
+
+def build(tree, libs, output, jobs, cache=None):
+    argv = [tree, "-o", output, "-L", libs, "-L", LIB_DIR, "-j", str(jobs)]
+    if cache is not None:
+        argv += ["--cache", cache]
+    stderr = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stderr(stderr):
+        status = ropc.main(argv)
+    elapsed = (time.perf_counter() - start) * 1000
+    assert status == 0, stderr.getvalue()
+    return elapsed, stderr.getvalue().strip().splitlines()[-1]
+
+
+def read_tree(directory):
+    result = {}
+    for parent, _, filenames in os.walk(directory):
+        for filename in filenames:
+            with open(os.path.join(parent, filename), encoding="utf-8") as f:
+                result[os.path.relpath(os.path.join(parent, filename), directory)] = f.read()
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="磁盘缓存基准")
+    arg_parser.add_argument("--programs", type=int, default=200, help="程序数")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="并行进程数（默认为 CPU 数）")
+    args = arg_parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix="ropc-cache-bench-")
+    try:
+        tree, libs, cache = (os.path.join(work, name) for name in ("src", "libs", "cache"))
+        os.makedirs(tree)
+        os.makedirs(libs)
+        for i in range(args.programs):
+            with open(os.path.join(tree, f"p{i:04d}.rop"), "w", encoding="utf-8") as f:
+                f.write(gen_program(i))
+
+        def write_shared(value):
+            with open(os.path.join(libs, "shared.macro"), "w", encoding="utf-8") as f:
+                f.write(SHARED.format(value))
+
+        write_shared("0001")
+        for label in ("cold", "unchanged"):
+            elapsed, summary = build(tree, libs, os.path.join(work, "out"), args.jobs, cache)
+            print(f"{label:<16} {elapsed:8.1f} ms   {summary}")
+        write_shared("0002")
+        elapsed, summary = build(tree, libs, os.path.join(work, "out"), args.jobs, cache)
+        print(f"{'shared changed':<16} {elapsed:8.1f} ms   {summary}")
+        elapsed, _ = build(tree, libs, os.path.join(work, "fresh"), args.jobs)
+        print(f"{'no cache':<16} {elapsed:8.1f} ms")
+        assert read_tree(os.path.join(work, "out")) == read_tree(os.path.join(work, "fresh")), "cached build produced different output"
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+大型库文件基准：生成包含大量 $gadget 定义的合成库（类似由 ROM 生成的 gadget 库），
+对比文本库与索引库（tools/pack_library.py）在「导入 + 编译一个只引用少量定义的程序」上的耗时和峰值内存。
+
+用法:
+    python bench/large_library.py [--gadgets 50000]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "public"))
+
+import compiler  # noqa: E402
+
+
+def make_library(count):
+    lines = [f"$g{i:05x} {{ {i & 0xffff:04x} 30 }}   //gadget {i}" for i in range(count)]
+    return "\n".join(lines) + "\n"
+
+
+def make_source(library_name, count):
+    calls = " ".join(f"$g{i:05x}" for i in range(0, count, max(count // 20, 1)))
+    return f"import {library_name}\n@block.main:\n@offset=d180\n{calls}\n@blockend\n"
+
+
+def measure(library_name, content, source):
+    compiler._LIBRARY_CACHE.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        blocks = compiler.ROPCompiler({library_name: content}).Compile(source)
+    elapsed = (time.perf_counter() - start) * 1000
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, blocks["main"].hex()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="大型库文件基准")
+    arg_parser.add_argument("--gadgets", type=int, default=50000, help="合成库中的定义数量")
+    args = arg_parser.parse_args()
+
+    text = make_library(args.gadgets)
+    with contextlib.redirect_stdout(io.StringIO()):
+        compiler.get_parser("config")  # 解析器构建不计入
+        compiler.get_parser("func")
+        compiler.get_parser("asm")
+        packed = compiler.pack_library("rom.ggt", text)
+    print(f"{args.gadgets} gadgets: text {len(text) / 1024:.0f} KiB, indexed {len(packed) / 1024:.0f} KiB")
+
+    outputs = []
+    for label, name, content in (("text", "rom.ggt", text), ("indexed", "rom.ggt.idx", packed)):
+        elapsed, peak, output = measure(name, content, make_source(name, args.gadgets))
+        outputs.append(output)
+        print(f"{label:<8} import + compile {elapsed:8.1f} ms   peak {peak / 1024 / 1024:6.1f} MiB")
+    assert outputs[0] == outputs[1], "text and indexed libraries produced different output"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+大型源码压力测试：生成由程序生成的、几 MiB 的合成源码（少数很大的块，或大量以 @end 结尾的块），
+对比预处理阶段的线性扫描器（parse_definitions）与 LALR 解析（get_parser("pre").parse）的耗时，
+并检查两者得到的定义与块内容完全相同。
+
+用法:
+    python bench/large_source.py [--lines 100000] [--blocks 50] [--no-lalr]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "public"))
+
+import compiler  # noqa: E402
+
+DEFINITIONS = (
+    "import basic-991cnx-verc.ggt\n"
+    "def $mine {1234}\n"
+    "def *twice (a, b=99){\n    // 片段开头的注释整体跳过，其中的 { 不计入\n    $er0= %_a_% %_b_%\n    { %_a_% }\n}\n"
+    "def !guard (v) {%%BODY%%} {\n    $er0= %_v_%\n    %%BODY%%\n}\n"
+)
+
+
+def gen_source(blocks, lines, terminator):
+    row = "    $er0= 1234 *twice (56) ; 行尾注释\n"
+    parts = [DEFINITIONS]
+    for i in range(blocks):
+        parts.append(f"@block.b{i}:\n    @offset=d180\n@adr.top{i}\n{row * lines}{terminator}\n")
+    return "".join(parts)
+
+
+def measure(parse, source):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = compiler.PreTransformer({}).transform(parse(source))
+    return (time.perf_counter() - start) * 1000, result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="大型源码压力测试")
+    arg_parser.add_argument("--lines", type=int, default=100000, help="单个大块的行数")
+    arg_parser.add_argument("--blocks", type=int, default=50, help="多块场景的块数（每块 2000 行）")
+    arg_parser.add_argument("--no-lalr", action="store_true", help="只运行扫描器（LALR 解析在多块 @end 场景下耗时随块数平方增长）")
+    args = arg_parser.parse_args()
+
+    compiler.get_parser("pre")  # 解析器构建不计入
+    scenarios = (
+        (f"1 x {args.lines} lines, @blockend", gen_source(1, args.lines, "@blockend")),
+        (f"1 x {args.lines} lines, @end", gen_source(1, args.lines, "@end")),
+        (f"{args.blocks} x 2000 lines, @blockend", gen_source(args.blocks, 2000, "@blockend")),
+        (f"{args.blocks} x 2000 lines, @end", gen_source(args.blocks, 2000, "@end")),
+    )
+    for label, source in scenarios:
+        scan_ms, scanned = measure(lambda code: compiler.parse_definitions("pre", code), source)
+        line = f"{label:<32} {len(source) / 1024 / 1024:5.1f} MiB   scanner {scan_ms:8.1f} ms"
+        if not args.no_lalr:
+            lalr_ms, parsed = measure(compiler.get_parser("pre").parse, source)
+            assert scanned == parsed, f"{label}: scanner and LALR parser disagree"
+            line += f"   LALR {lalr_ms:9.1f} ms"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
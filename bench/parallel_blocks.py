@@ -0,0 +1,79 @@
+"""
+多块并行编译基准：用自带库文件生成包含大量块的合成程序，对比串行编译与进程池并行编译（ROPCompiler(workers=N)）的耗时，
+并检查两者输出逐字节相同。
+
+用法:
+    python bench/parallel_blocks.py [--blocks 120] [-j 4] [--repeat 3]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB_DIR = os.path.join(ROOT, "public", "vendor", "libraries")
+sys.path.insert(0, os.path.join(ROOT, "public"))
+
+import compiler  # noqa: E402
+
+HEADER = "import basic-991cnx-verc.ggt\nimport basic-common.macro\n\n"
+
+
+def gen_program(n):
+    # n 个块，每块若干常用宏调用和跨块引用的地址标签
+    blocks = []
+    for i in range(n):
+        calls = "\n".join(
+            f"    *print (d522, {(i + j) % 256:02x})\n"
+            f"    *memcpy (d200, d300, 0010)\n"
+            f"    @adr.l{i}_{j}\n"
+            f"    *jump_er14 (#l{(i * 7) % n}_{j})"
+            for j in range(8)
+        )
+        blocks.append(f"@block.b{i}:\n    @offset=d180\n    @rstoffst\n{calls}\n@blockend\n")
+    return HEADER + "\n".join(blocks)
+
+
+def measure(source, libraries, workers, repeat):
+    best = None
+    output = None
+    rop = compiler.ROPCompiler(libraries, workers=workers)
+    try:
+        for _ in range(repeat + 1):     # 第一次编译包含进程池的启动，不计入
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                blocks = rop.Compile(source)
+            elapsed = (time.perf_counter() - start) * 1000
+            if output is not None:
+                best = elapsed if best is None else min(best, elapsed)
+            output = {block_name: block.hex() for block_name, block in blocks.items()}
+    finally:
+        rop.close()
+    return best, output
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="多块并行编译基准")
+    arg_parser.add_argument("--blocks", type=int, default=120, help="合成程序中的块数")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="并行进程数（默认为 CPU 数）")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快的一次")
+    args = arg_parser.parse_args()
+
+    libraries = {}
+    for filename in ("basic-991cnx-verc.ggt", "basic-common.macro"):
+        with open(os.path.join(LIB_DIR, filename), encoding="utf-8") as f:
+            libraries[filename] = f.read()
+    source = gen_program(args.blocks)
+
+    serial_ms, serial_output = measure(source, libraries, None, args.repeat)
+    parallel_ms, parallel_output = measure(source, libraries, max(args.jobs, 2), args.repeat)
+    assert serial_output == parallel_output, "parallel compilation produced different output"
+    print(f"{args.blocks} blocks, {os.cpu_count()} CPUs")
+    print(f"serial              {serial_ms:8.1f} ms")
+    print(f"parallel (-j {max(args.jobs, 2):<2})    {parallel_ms:8.1f} ms   x{serial_ms / parallel_ms:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+窥孔优化基准：生成含大量相邻 load 的合成程序，对比 ROPCompiler(optimize=True) 与不优化时的输出字节数和编译耗时，
+检查优化前后的标签地址相同；另有一组必须保持逐字节不变的程序（标签加偏移指向的字节、@overwrite 等），防止改写移动被引用的字节。
+
+用法:
+    python bench/peephole.py [--blocks 40] [--repeat 3]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB_DIR = os.path.join(ROOT, "public", "vendor", "libraries")
+sys.path.insert(0, os.path.join(ROOT, "public"))
+
+import compiler  # noqa: E402
+
+HEADER = "import basic-991cnx-verc.ggt\nimport basic-common.macro\n\n"
+LOADS = "$er0= 1111\n$er0= 2222\n"
+
+# 优化不能改变输出的程序
+UNCHANGED = {
+    # 自修改链：#x + 0008 指向第二个 $er0= 的数据，删除第一个 load 会使它指向别处
+    "label + offset": "@block.a:\n@adr.x\n" + LOADS + "$er2= [< #x + 0008 >]\n@blockend\n",
+    # 同上，标签在之前的块中定义，之间没有 @rstoffst
+    "label + offset, later block": "@block.a:\n@adr.x\n@blockend\n@block.b:\n" + LOADS + "@blockend\n@block.c:\n@rstoffst\n$er2= [< #x + 0010 >]\n@blockend\n",
+    # 只作为数据地址使用的标签不固定其后的字节，写作 < #tbl + 0000 > 时与标签加偏移相同
+    "label + 0000 as data": "@block.a:\n@adr.tbl\n" + LOADS + "*memcpy (d300, < #tbl + 0000 >, 0004)\n@blockend\n",
+    "label after rewrite": "@block.a:\n" + LOADS + "@adr.x\n$er2= #x\n@blockend\n",
+    "overwrite": "@block.a:\n" + LOADS + "@overwrite(0004, 3333)\n@blockend\n",
+}
+
+
+def gen_program(blocks):
+    # 每块若干可删除或合并的相邻 load，块间用 @rstoffst 分隔；标签只在块首定义，且不用于加减表达式
+    # （*jump_er14 计算 #标签 - 0008，会使标签之后的字节都不能移动）
+    parts = [HEADER]
+    for i in range(blocks):
+        body = "".join(f"$er0= {j:04x}\n$er0= {i:04x}\n$er2= {j:04x}\n*print (d522, {j:02x})\n" for j in range(16))
+        parts.append(f"@block.b{i}:\n@offset=d180\n@rstoffst\n@adr.top{i}\n{body}$er2= #top{i}\n@blockend\n")
+    return "".join(parts)
+
+
+def compile_source(libraries, source, optimize):
+    rop = compiler.ROPCompiler(libraries, optimize=optimize, source_map=optimize)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        blocks = rop.Compile(source)
+    elapsed = (time.perf_counter() - start) * 1000
+    return elapsed, {block_name: block.hex() for block_name, block in blocks.items()}, rop.adr_map
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="窥孔优化基准")
+    arg_parser.add_argument("--blocks", type=int, default=40, help="合成程序中的块数")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快的一次")
+    args = arg_parser.parse_args()
+
+    libraries = {}
+    for filename in ("basic-991cnx-verc.ggt", "basic-common.macro"):
+        with open(os.path.join(LIB_DIR, filename), encoding="utf-8") as f:
+            libraries[filename] = f.read()
+
+    for label, body in UNCHANGED.items():
+        _, plain, _ = compile_source(libraries, HEADER + body, False)
+        _, optimized, _ = compile_source(libraries, HEADER + body, True)
+        assert plain == optimized, f"{label}: optimization changed the output"
+    print(f"{len(UNCHANGED)} label-sensitive programs unchanged")
+
+    source = gen_program(args.blocks)
+    results = {}
+    for optimize in (False, True):
+        best = None
+        for _ in range(args.repeat):
+            elapsed, output, labels = compile_source(libraries, source, optimize)
+            best = elapsed if best is None else min(best, elapsed)
+        results[optimize] = (best, sum(len(text) // 2 for text in output.values()), labels)
+    assert results[False][2] == results[True][2], "optimization moved a label"
+    for optimize, name in ((False, "plain"), (True, "optimize")):
+        elapsed, size, _ = results[optimize]
+        print(f"{name:<10} {elapsed:8.1f} ms   {size} bytes")
+
+
+if __name__ == "__main__":
+    main()
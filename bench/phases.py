@@ -0,0 +1,185 @@
+"""
+分阶段基准：用自带的 basic-991cnx-verc.ggt / basic-common.macro 生成规模递增的合成程序，
+分别统计 PreCompile / FuncCompile / AdrCompile / Pass2Compile 各阶段的耗时和峰值内存，结果写为 JSON。
+
+用法:
+    python bench/phases.py [-o bench_output.json] [--compiler public/compiler.py] [--repeat 3] [--scale 1] [--source-map]
+
+--compiler 可以指向其它提交导出的 compiler.py（ROPCompiler 位于模块顶层、解析器只构建一次之后的版本），便于跨提交比较；--source-map 在编译时同时生成 source map；
+脚本在缺少 js 模块时注入一个最小的桩模块，以兼容需要 js 的旧版本。
+"""
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import platform
+import runpy
+import sys
+import time
+import tracemalloc
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB_DIR = os.path.join(ROOT, "public", "vendor", "libraries")
+PHASES = ("PreCompile", "FuncCompile", "AdrCompile", "Pass2Compile")
+HEADER = "import basic-991cnx-verc.ggt\nimport basic-common.macro\n\n"
+
+
+def gen_blocks(n):
+    # n 个块，每块若干常用宏调用
+    blocks = []
+    for i in range(n):
+        blocks.append(
+            f"@block.b{i}:\n"
+            f"    @offset=d180\n"
+            f"    *print (d522, {i % 256:02x})\n"
+            f"    *memcpy (d200, d300, 0010)\n"
+            f"    *delay ()\n"
+            f"    $er0= {i % 65536:04x}\n"
+            f"@blockend\n"
+        )
+    return HEADER + "\n".join(blocks)
+
+
+def gen_nesting(depth):
+    # depth 层嵌套的 !ifzeror2? 高阶函数
+    body = "*print (d522)"
+    for _ in range(depth):
+        body = f"!ifzeror2? () {{\n    $er0= 0000\n    {body}\n}}"
+    return HEADER + f"@block.main:\n@offset=d180\n{body}\n@blockend\n"
+
+
+def gen_labels(n):
+    # n 个地址标签，每个标签都被跳转引用一次
+    lines = ["@block.main:", "@offset=d180"]
+    for i in range(n):
+        lines.append(f"@adr.l{i}")
+        lines.append(f"*jump_er14 (#l{(i * 7) % n})")
+        lines.append(f"##l{i}")
+    lines.append("@blockend")
+    return HEADER + "\n".join(lines) + "\n"
+
+
+def gen_overwrites(n):
+    # 2n 字节的数据和 n 个覆写
+    lines = ["@block.main:", "00 " * (2 * n)]
+    for i in range(n):
+        lines.append(f"@overwrite({2 * i:04x}, {i % 256:02x})")
+    lines.append("@blockend")
+    return HEADER + "\n".join(lines) + "\n"
+
+
+SCENARIOS = {
+    "blocks": (gen_blocks, (10, 50, 200)),
+    "nesting": (gen_nesting, (4, 16, 48)),
+    "labels": (gen_labels, (50, 200, 800)),
+    "overwrites": (gen_overwrites, (50, 500, 2000)),
+}
+
+
+def install_js_stub():
+    try:
+        import js  # noqa: F401
+    except ImportError:
+        js = types.ModuleType("js")
+        js.console = types.SimpleNamespace(error=lambda *args: None, log=lambda *args: None)
+        js.globalThis = types.SimpleNamespace()
+        sys.modules["js"] = js
+
+
+def load_libraries():
+    return {
+        name: open(os.path.join(LIB_DIR, name), encoding="utf-8").read()
+        for name in sorted(os.listdir(LIB_DIR))
+    }
+
+
+def run_phases(compiler_class, libraries, source):
+    compiler = compiler_class(libraries)
+    timings = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for phase in PHASES:
+            method = getattr(compiler, phase)
+            start = time.perf_counter()
+            method(source) if phase == "PreCompile" else method()
+            timings[phase] = (time.perf_counter() - start) * 1000
+    return timings, compiler.blocks
+
+
+def output_size(blocks):
+    size = 0
+    for block in blocks.values():
+        size += len(block) if not isinstance(block, str) else len(block) // 2
+    return size
+
+
+def measure(compiler_class, libraries, source, repeat):
+    best = None
+    for _ in range(repeat):
+        timings, blocks = run_phases(compiler_class, libraries, source)
+        if best is None or sum(timings.values()) < sum(best.values()):
+            best = timings
+    tracemalloc.start()
+    run_phases(compiler_class, libraries, source)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "phases_ms": {phase: round(best[phase], 3) for phase in PHASES},
+        "total_ms": round(sum(best.values()), 3),
+        "peak_kib": round(peak / 1024, 1),
+        "source_chars": len(source),
+        "output_bytes": output_size(blocks),
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="分阶段编译基准")
+    arg_parser.add_argument("-o", "--output", default="bench_output.json")
+    arg_parser.add_argument("--compiler", default=os.path.join(ROOT, "public", "compiler.py"))
+    arg_parser.add_argument("--repeat", type=int, default=3, help="每个用例重复次数，取最快一次")
+    arg_parser.add_argument("--scale", type=float, default=1.0, help="所有规模乘以该系数")
+    arg_parser.add_argument("--only", choices=sorted(SCENARIOS), action="append", help="只运行指定场景")
+    arg_parser.add_argument("--source-map", action="store_true", help="同时生成 source map（ROPCompiler(source_map=True)）")
+    args = arg_parser.parse_args()
+
+    install_js_stub()
+    namespace = runpy.run_path(args.compiler)
+    if "ROPCompiler" not in namespace:
+        # 基线等早期版本的 ROPCompiler 定义在 compile_to_bytecode 内部，无法分阶段计时
+        arg_parser.error(f"{args.compiler} has no module-level ROPCompiler; only versions with the shared parser registry are supported")
+    compiler_class = namespace["ROPCompiler"]
+    if args.source_map:
+        compiler_class = functools.partial(compiler_class, source_map=True)
+    libraries = load_libraries()
+
+    # 预热：构建解析器、解析库文件
+    run_phases(compiler_class, libraries, gen_blocks(1))
+
+    results = []
+    for name, (generator, sizes) in SCENARIOS.items():
+        if args.only and name not in args.only:
+            continue
+        for size in sizes:
+            size = max(1, int(size * args.scale))
+            result = {"scenario": name, "size": size}
+            result.update(measure(compiler_class, libraries, generator(size), args.repeat))
+            results.append(result)
+            phases = " ".join(f"{phase}={ms:.1f}" for phase, ms in result["phases_ms"].items())
+            print(f"{name:<11}{size:>6}  total={result['total_ms']:9.1f} ms  peak={result['peak_kib']:9.1f} KiB  {phases}")
+
+    report = {
+        "compiler": os.path.abspath(args.compiler),
+        "source_map": args.source_map,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+重复编译基准：在同一进程内对同一段程序连续编译 N 次，统计首次与后续编译耗时。
+
+用法:
+    python bench/repeat_compile.py [--compiler public/compiler.py] [-n 20]
+
+--compiler 可以指向任意版本的 compiler.py（例如 git show 导出的旧版本），
+便于对比优化前后的结果。脚本会注入一个最小的 js 桩模块，因此可以直接在 CPython 下运行。
+"""
+import argparse
+import contextlib
+import io
+import os
+import runpy
+import statistics
+import sys
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB_DIR = os.path.join(ROOT, "public", "vendor", "libraries")
+
+SAMPLE_PROGRAM = r"""
+import basic-991cnx-verc.ggt
+import basic-common.macro
+
+@block.main:
+    @offset=d180
+    *print (d522, 21)
+    !ifzeror2? () {
+        *delay ()
+        *jump_er14 (#loop)
+    }
+    @adr.loop
+    *key->er0 ()
+    !loop (d200, d300) { $er0= 0123 }
+@blockend
+"""
+
+
+class _JsProxy:
+    def __init__(self, value):
+        self.value = value
+
+    def to_py(self):
+        return self.value
+
+
+def install_js_stub():
+    js = types.ModuleType("js")
+    js.console = types.SimpleNamespace(error=lambda *args: None, log=lambda *args: None)
+    js.globalThis = types.SimpleNamespace()
+    sys.modules["js"] = js
+
+
+def load_libraries():
+    return {
+        name: open(os.path.join(LIB_DIR, name), encoding="utf-8").read()
+        for name in sorted(os.listdir(LIB_DIR))
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--compiler", default=os.path.join(ROOT, "public", "compiler.py"))
+    arg_parser.add_argument("-n", type=int, default=20, help="编译次数")
+    args = arg_parser.parse_args()
+
+    install_js_stub()
+    module = runpy.run_path(args.compiler)
+    compile_to_bytecode = module["compile_to_bytecode"]
+    libraries = _JsProxy(load_libraries())
+
+    timings = []
+    for _ in range(args.n):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = compile_to_bytecode(SAMPLE_PROGRAM, libraries)
+        timings.append((time.perf_counter() - start) * 1000)
+        if "error" in result:
+            raise SystemExit(result["error"])
+
+    print(f"compiler: {args.compiler}")
+    print(f"first compile:      {timings[0]:8.2f} ms")
+    if len(timings) > 1:
+        print(f"subsequent median:  {statistics.median(timings[1:]):8.2f} ms")
+    print(f"total ({args.n} runs): {sum(timings):8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+编译结果传输基准：生成输出很长的合成程序，对比 compile_to_bytecode（{块名: 十六进制字符串}）与
+compile_to_bytecode_binary（一段 memoryview 加块偏移、标签与占位符半字节的索引）在 Python 一侧生成结果的耗时和要交给 JS 的数据量，
+并检查两者的字节码相同。
+
+用法:
+    python bench/result_transfer.py [--blocks 32] [--calls 64] [--repeat 5]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB_DIR = os.path.join(ROOT, "public", "vendor", "libraries")
+sys.path.insert(0, os.path.join(ROOT, "public"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import compiler  # noqa: E402
+from streaming import gen_program  # noqa: E402
+
+
+def to_hex(blocks):
+    return {block_name: block.hex() for block_name, block in blocks.items()}
+
+
+def measure(func, blocks, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(blocks)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="编译结果传输基准")
+    arg_parser.add_argument("--blocks", type=int, default=32, help="块数")
+    arg_parser.add_argument("--calls", type=int, default=64, help="每块调用 *chunk 的次数（每次 256 字节）")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="重复次数，取最快的一次")
+    args = arg_parser.parse_args()
+
+    libraries = {}
+    for filename in ("basic-991cnx-verc.ggt", "basic-common.macro"):
+        with open(os.path.join(LIB_DIR, filename), encoding="utf-8") as f:
+            libraries[filename] = f.read()
+    rop = compiler.ROPCompiler(libraries)
+    with contextlib.redirect_stdout(io.StringIO()):
+        blocks = rop.Compile(gen_program(args.blocks, args.calls))
+
+    hex_ms, hex_result = measure(to_hex, blocks, args.repeat)
+    binary_ms, binary_result = measure(lambda b: compiler.pack_blocks(b, rop.adr_map), blocks, args.repeat)
+    data = bytes(binary_result["data"])
+    for block_name, start, length in binary_result["blocks"]:
+        assert data[start:start + length].hex().upper() == hex_result[block_name], f"{block_name}: binary result differs"
+
+    hex_size = sum(len(text) for text in hex_result.values())
+    table_size = len(json.dumps({key: value for key, value in binary_result.items() if key != "data"}))
+    print(f"{len(blocks)} blocks, {len(data) / 1024 / 1024:.1f} MiB bytecode, {len(binary_result['wild'])} wildcard runs, {len(binary_result['labels'])} labels")
+    print(f"hex dict     {hex_ms:8.1f} ms   {hex_size / 1024 / 1024:7.2f} MiB")
+    print(f"binary       {binary_ms:8.1f} ms   {len(data) / 1024 / 1024:7.2f} MiB + side table {table_size / 1024:.1f} KiB")
+
+
+if __name__ == "__main__":
+    main()
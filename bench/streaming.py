@@ -0,0 +1,90 @@
+"""
+流式编译基准：生成源码很短、输出很长的合成程序，对比 Compile（整体返回再转为十六进制字典，与 compile_to_bytecode 相同）
+与 CompileStream（逐块转为十六进制后立即丢弃）的耗时和 tracemalloc 峰值内存，并检查两者输出相同。
+
+用法:
+    python bench/streaming.py [--blocks 32] [--calls 64]
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB_DIR = os.path.join(ROOT, "public", "vendor", "libraries")
+sys.path.insert(0, os.path.join(ROOT, "public"))
+
+import compiler  # noqa: E402
+
+HEADER = "import basic-991cnx-verc.ggt\nimport basic-common.macro\n\n"
+
+
+def gen_program(blocks, calls):
+    # 源码很短、展开后很长的程序（类似由宏生成的长链）：blocks 个块，每块 calls 次调用 *chunk，每次展开为 256 字节，
+    # 另有一次库函数调用和块内跳转标签
+    row = " ".join(f"{k:02x}" for k in range(32))
+    parts = [HEADER, "def *chunk (v) {\n" + f"    %_v_% {row[3:]}\n" * 8 + "}\n\n"]
+    for i in range(blocks):
+        parts.append(f"@block.b{i}:\n@offset=d180\n@rstoffst\n@adr.top{i}\n*memcpy (d200, d300, 0010)\n")
+        parts.extend(f"*chunk ({(i + j) % 256:02x})\n" for j in range(calls))
+        parts.append(f"*jump_er14 (#top{i})\n@blockend\n")
+    return "".join(parts)
+
+
+def run_compile(rop, source):
+    result = {block_name: block.hex() for block_name, block in rop.Compile(source).items()}
+    return {block_name: hashlib.sha1(text.encode()).hexdigest() for block_name, text in result.items()}, sum(map(len, result.values()))
+
+
+def run_stream(rop, source):
+    digests = {}
+    size = 0
+    for block_name, block in rop.CompileStream(source):
+        text = block.hex()      # 模拟交给调用方（写文件 / 传给 JS）
+        digests[block_name] = hashlib.sha1(text.encode()).hexdigest()
+        size += len(text)
+    return digests, size
+
+
+def measure(func, libraries, source):
+    rop = compiler.ROPCompiler(libraries)
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        digests, size = func(rop, source)
+    elapsed = (time.perf_counter() - start) * 1000
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, digests, size
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="流式编译基准")
+    arg_parser.add_argument("--blocks", type=int, default=32, help="块数")
+    arg_parser.add_argument("--calls", type=int, default=64, help="每块调用 *chunk 的次数（每次 256 字节）")
+    args = arg_parser.parse_args()
+
+    libraries = {}
+    for filename in ("basic-991cnx-verc.ggt", "basic-common.macro"):
+        with open(os.path.join(LIB_DIR, filename), encoding="utf-8") as f:
+            libraries[filename] = f.read()
+    with contextlib.redirect_stdout(io.StringIO()):
+        compiler.get_parser("func")     # 解析器构建与库文件解析不计入
+        compiler.get_parser("asm")
+        compiler.ROPCompiler(libraries).Compile(HEADER)
+    source = gen_program(args.blocks, args.calls)
+
+    results = []
+    for label, func in (("Compile", run_compile), ("CompileStream", run_stream)):
+        elapsed, peak, digests, size = measure(func, libraries, source)
+        results.append(digests)
+        print(f"{label:<14} {elapsed:8.1f} ms   peak {peak / 1024 / 1024:7.1f} MiB   output {size / 2 / 1024 / 1024:.1f} MiB")
+    assert results[0] == results[1], "streaming produced different output"
+
+
+if __name__ == "__main__":
+    main()
@@ -1,817 +1,3131 @@
-import js
+"""
+ROP 链编译器。
+
+在 CPython 下可以直接导入使用：
+
+    from compiler import ROPCompiler
+    blocks = ROPCompiler({"basic-common.macro": text}).Compile(source)
+    blocks["main"].hex()   # 或 bytes(blocks["main"].data)
+    pack_blocks(blocks)     # 全部块拼接为一段 memoryview，附带块偏移、标签与占位符半字节的索引
+    for block_name, block in ROPCompiler(libraries).CompileStream(source): ...   # 逐块输出，用于很大的程序
+    rop = ROPCompiler(libraries, source_map=True); rop.Compile(source)
+    rop.source_maps["main"].entries, rop.SizeReport()   # 每段字节的来源（源码行与宏 / gadget 调用链），按块、gadget、宏汇总的字节数
+    ROPCompiler(libraries, optimize=True).Compile(source)   # 窥孔优化：删除被覆盖的 load、合并相邻的 load
+    ROPCompiler(libraries, cache=CompileCache("cache/")).Compile(source)   # 批量编译时跨进程、跨次运行复用结果
+
+    check(source, {"basic-common.macro": text})   # 只检查，返回带位置的诊断列表
+    index(source, {"basic-common.macro": text})   # 符号索引，用于补全和悬停提示
+
+在浏览器（Pyodide）中由 index.html 加载，compile_to_bytecode 作为 pyProcessCode、compile_to_bytecode_binary 作为 pyProcessCodeBinary、
+compile_to_bytecode_stream 作为 pyProcessCodeStream、check 作为 pyCheckCode、index 作为 pyIndexCode 暴露给 JS。
+"""
+import asyncio
+import bisect
+import functools
+import hashlib
+import heapq
 import json
+import os
 import re
-from lark import Lark, Transformer
-from typing import Any, Dict, cast
-import uuid
-
-def compile_to_bytecode(source_code, libraries_js_proxy):
-    """
-    这是您需要编写的核心函数。
-    它接收JS传来的源代码、库文件(JS Proxy)和地址。
-    """
-    try:
-        # 1. 将JS对象转换为Python字典
-        libraries_dict = libraries_js_proxy.to_py()
+import time
+from collections import ChainMap
+from collections.abc import Mapping
+from typing import Any, Dict, Tuple, cast
+
+try:
+    # 预生成的独立解析器（tools/gen_parsers.py），内含 lark 运行时与各语法的分析表，
+    # 存在时无需安装 lark，也无需在启动时分析语法
+    import rop_parsers as _parser_runtime
+    from rop_parsers import Token, Transformer, Tree, VisitError, UnexpectedInput, UnexpectedCharacters, UnexpectedToken
+except ImportError:
+    _parser_runtime = None
+    from lark import Token, Transformer, Tree
+    from lark.exceptions import VisitError, UnexpectedInput, UnexpectedCharacters, UnexpectedToken
+
+try:
+    import js
+except ImportError:
+    # 不在 Pyodide 中运行（命令行 / 批量编译）
+    js = None
+
+config_grammar = r"""
+    ?start: config_program
+
+    config_program: (ggt_def | spf_def | cpf_def)*
+
+    ggt_def: GGT_NAME "{" brace_block "}"
+    spf_def: SPF_NAME "(" params ")" "{" brace_block "}"
+    cpf_def: CPF_NAME "(" params ")" "{%%BODY%%}" "{" brace_block "}"
+
+
+    brace_block: (brace_block_nested | ANY_CHAR)+
+    brace_block_nested: "{" brace_block "}"
+    param: CNAME ("=" ANY_STRING)?
+    params: [param ("," param)*]
+
+    
+    //终结符
+    GGT_NAME: /\$[^ \t\r\n(]+/
+    SPF_NAME: /\*[^ \t\r\n(]+/
+    CPF_NAME: /![^ \t\r\n(]+/
+    ANY_STRING: /[^,)]+/
+    ANY_CHAR: /[^\{\}]+/
+    
+    COMMENT: /(\/\/|;)[^\n]*/
+    // --- 导入和忽略 ---
+    %import common.CNAME 
+    %import common.NEWLINE 
+    %import common.WS
+    %ignore WS          // 忽略空格
+    %ignore NEWLINE     // 忽略空行
+    %ignore COMMENT
+    
+"""
+
+
+class ConfigTransformer(Transformer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ggt = {}
+        self.spf = {}
+        self.cpf = {}
+
+
+    # ggt_def 处理器：直接更新 ggt_dict
+    def ggt_def(self, items):
+        name = items[0]
+        data = items[1]
+        self.ggt[name] = data
+        return None
+
+    # spf_def 处理器：直接更新 spf_dict
+    def spf_def(self, items):
+        name = items[0]
+        params = items[1]
+        body = items[2]
+        self.spf[name] = {'params': params, 'body': body, 'template': MacroTemplate(params, body)}
+        return None
+    
+    # cpf_def 处理器：直接更新 cpf_dict
+    def cpf_def(self, items):
+        name = items[0]
+        params = items[1]
+        body = items[2]
+        self.cpf[name] = {'params': params, 'body': body, 'template': MacroTemplate(params, body)}
+        return None
         
-        # -----------------------------------------------
-        # --- [ 在这里替换为您自己的字节码转换逻辑 ] ---
-        # -----------------------------------------------
+    
+    def brace_block(self, items): return "".join(items)
+    def brace_block_nested(self, token): return f"{{ {token[0]} }}"
+    def param(self, items): return (items[0], items[1]) if len(items) > 1 else (items[0], None)
+    def params(self, items): return items
+    
+    def GGT_NAME(self, token): return token.value
+    def SPF_NAME(self, token): return token.value
+    def CPF_NAME(self, token): return token.value
+    def CNAME(self, token): return token.value
+    def ANY_STRING(self, token): return token.value
+    def ANY_CHAR(self, token): return token.value
+
+    def config_program(self, items):
+        return {
+            "ggt": self.ggt,
+            "spf": self.spf,
+            "cpf": self.cpf,
+        }
+    
+
+
+pre_grammar = r"""
+    ?start: pre_program
+
+    pre_program: (import_stmt | ggt_def | spf_def | cpf_def | block)*
+
+    import_stmt: "import" FILE_NAME
+    ggt_def: "def" GGT_NAME "{" brace_block "}"
+    spf_def: "def" SPF_NAME "(" params ")" "{" brace_block "}"
+    cpf_def: "def" CPF_NAME "(" params ")" "{%%BODY%%}" "{" brace_block "}"
+
+    block: "@block" "." CNAME ":" BLOCK_CONTENT "@blockend" | "@block" "." CNAME ":" BLOCK_CONTENT "@end"
+
+    brace_block: (brace_block_nested | ANY_CHAR)+
+    brace_block_nested: "{" brace_block "}"
+    params: [param ("," param)*]
+    param: CNAME ("=" ANY_STRING)?
+
+    COMMENT: /(\/\/|;)[^\n]*/
+    //终结符
+    BLOCK_CONTENT: /(.|\n)+?(?=@blockend)/ | /(.|\n)+?(?=@end)/
+    GGT_NAME: /\$[^ \t\r\n(]+/
+    SPF_NAME: /\*[^ \t\r\n(]+/
+    CPF_NAME: /![^ \t\r\n(]+/
+    FILE_NAME: /[a-zA-Z0-9_\-.]+/
+    ANY_STRING: /[^,)]+/
+    ANY_CHAR: /[^\{\}]+/
+
+    
+    %ignore COMMENT
+    // --- 导入和忽略 ---
+    %import common.CNAME 
+    %import common.NEWLINE 
+    %import common.WS
+    %ignore WS          // 忽略空格
+    %ignore NEWLINE     // 忽略空行
+"""
+
+
+
+class PreTransformer(Transformer):
+    def __init__(self, libraries_dict, stats=None):
+        super().__init__()
+        self.libraries_dict = libraries_dict
+        self.stats = stats
+        self.ggt = {}
+        self.spf = {}
+        self.cpf = {}
+        self.blocks = {}
+        self.block_lines = {}       # 块名 -> 块内容第一行的行号
+        self.imports = []           # 成功导入的库文件名，按导入顺序
+        self.import_requests = []   # 源码中 import 的全部库文件名（含导入失败的），按出现顺序
+        self.definition_lines = {}  # 源码中定义的名称 -> 行号
+
+
+    # import 语句处理器
+    def import_stmt(self, token):
+        self.import_requests.append(token[0])
+        self._load_module(token[0])
+        return None
+
+    # ggt_def 处理器：直接更新 ggt_dict
+    def ggt_def(self, items):
+        name = self._definition_name(items[0])
+        data = items[1]
+        self.ggt[name] = data
+        return None
+
+    # spf_def 处理器：直接更新 spf_dict
+    def spf_def(self, items):
+        name = self._definition_name(items[0])
+        params = items[1]
+        body = items[2]
+        self.spf[name] = {'params': params, 'body': body, 'template': MacroTemplate(params, body)}
+        return None
+    
+    # cpf_def 处理器：直接更新 cpf_dict
+    def cpf_def(self, items):
+        name = self._definition_name(items[0])
+        params = items[1]
+        body = items[2]
+        self.cpf[name] = {'params': params, 'body': body, 'template': MacroTemplate(params, body)}
+        return None
         
-        config_grammar = r"""
-            ?start: config_program
-
-            config_program: (ggt_def | spf_def | cpf_def)*
-
-            ggt_def: GGT_NAME "{" brace_block "}"
-            spf_def: SPF_NAME "(" params ")" "{" brace_block "}"
-            cpf_def: CPF_NAME "(" params ")" "{%%BODY%%}" "{" brace_block "}"
-
-
-            brace_block: (brace_block_nested | ANY_CHAR)+
-            brace_block_nested: "{" brace_block "}"
-            param: CNAME ("=" ANY_STRING)?
-            params: [param ("," param)*]
-
-            
-            //终结符
-            GGT_NAME: /\$[^ \t\r\n(]+/
-            SPF_NAME: /\*[^ \t\r\n(]+/
-            CPF_NAME: /![^ \t\r\n(]+/
-            ANY_STRING: /[^,)]+/
-            ANY_CHAR: /[^\{\}]+/
-            
-            COMMENT: /(\/\/|;)[^\n]*/
-            // --- 导入和忽略 ---
-            %import common.CNAME 
-            %import common.NEWLINE 
-            %import common.WS
-            %ignore WS          // 忽略空格
-            %ignore NEWLINE     // 忽略空行
-            %ignore COMMENT
-            
-        """
-
-
-        class ConfigTransformer(Transformer):
-            def __init__(self, *args, **kwargs):
-                super().__init__(*args, **kwargs)
-                self.ggt = {}
-                self.spf = {}
-                self.cpf = {}
-
-
-            # ggt_def 处理器：直接更新 ggt_dict
-            def ggt_def(self, items):
-                name = items[0]
-                data = items[1]
-                self.ggt[name] = data
-                return None
-
-            # spf_def 处理器：直接更新 spf_dict
-            def spf_def(self, items):
-                name = items[0]
-                params = items[1]
-                body = items[2]
-                self.spf[name] = {'params': params, 'body': body}
-                return None
-            
-            # cpf_def 处理器：直接更新 cpf_dict
-            def cpf_def(self, items):
-                name = items[0]
-                params = items[1]
-                body = items[2]
-                self.cpf[name] = {'params': params, 'body': body}
-                return None
-                
-            
-            def brace_block(self, items): return "".join(items)
-            def brace_block_nested(self, token): return f"{{ {token[0]} }}"
-            def param(self, items): return (items[0], items[1]) if len(items) > 1 else (items[0], None)
-            def params(self, items): return items
-            
-            def GGT_NAME(self, token): return token.value
-            def SPF_NAME(self, token): return token.value
-            def CPF_NAME(self, token): return token.value
-            def CNAME(self, token): return token.value
-            def ANY_STRING(self, token): return token.value
-            def ANY_CHAR(self, token): return token.value
-
-            def config_program(self, items):
-                return {
-                    "ggt": self.ggt,
-                    "spf": self.spf,
-                    "cpf": self.cpf,
-                }
-            
-        config_parser = Lark(config_grammar, start='config_program', parser='lalr',transformer=ConfigTransformer())
-
-
-        pre_grammar = r"""
-            ?start: pre_program
-
-            pre_program: (import_stmt | ggt_def | spf_def | cpf_def | block)*
-
-            import_stmt: "import" FILE_NAME
-            ggt_def: "def" GGT_NAME "{" brace_block "}"
-            spf_def: "def" SPF_NAME "(" params ")" "{" brace_block "}"
-            cpf_def: "def" CPF_NAME "(" params ")" "{%%BODY%%}" "{" brace_block "}"
-
-            block: "@block" "." CNAME ":" BLOCK_CONTENT "@blockend" | "@block" "." CNAME ":" BLOCK_CONTENT "@end"
-
-            brace_block: (brace_block_nested | ANY_CHAR)+
-            brace_block_nested: "{" brace_block "}"
-            params: [param ("," param)*]
-            param: CNAME ("=" ANY_STRING)?
-
-            COMMENT: /(\/\/|;)[^\n]*/
-            //终结符
-            BLOCK_CONTENT: /(.|\n)+?(?=@blockend)/ | /(.|\n)+?(?=@end)/
-            GGT_NAME: /\$[^ \t\r\n(]+/
-            SPF_NAME: /\*[^ \t\r\n(]+/
-            CPF_NAME: /![^ \t\r\n(]+/
-            FILE_NAME: /[a-zA-Z0-9_\-.]+/
-            ANY_STRING: /[^,)]+/
-            ANY_CHAR: /[^\{\}]+/
-
-            
-            %ignore COMMENT
-            // --- 导入和忽略 ---
-            %import common.CNAME 
-            %import common.NEWLINE 
-            %import common.WS
-            %ignore WS          // 忽略空格
-            %ignore NEWLINE     // 忽略空行
-        """
+    def block(self, items): 
+        name = items[0]
+        body = items[1]
+        self.blocks[name] = body.value
+        self.block_lines[name] = body.line
+        return None
+    
+    def brace_block(self, items): return "".join(items)
+    def brace_block_nested(self, token): return f"{{ {token[0]} }}"
+    def params(self, items): return items
+    def param(self, items): return (items[0], items[1]) if len(items) > 1 else (items[0], None)
+    
+    # 定义名与块内容保留为 Token，以便记录行号
+    def GGT_NAME(self, token): return token
+    def SPF_NAME(self, token): return token
+    def CPF_NAME(self, token): return token
+    def CNAME(self, token): return token.value
+    def ANY_STRING(self, token): return token.value
+    def FILE_NAME(self, token): return token.value
+    def ANY_CHAR(self, token): return token.value
+    def BLOCK_CONTENT(self, token): return token
+
+
+
+    def pre_program(self, items):
+        return {
+            "ggt": self.ggt,
+            "spf": self.spf,
+            "cpf": self.cpf,
+            "blocks": self.blocks,
+            "block_lines": self.block_lines,
+            "imports": self.imports,
+            "import_requests": self.import_requests,
+            "definition_lines": self.definition_lines,
+        }
+    # --- 辅助方法和基本规则 ---
+
+    def _definition_name(self, token):
+        self.definition_lines[token.value] = token.line
+        return token.value
+
+    def _load_module(self, filename):
+        file_content = None
+        try:
+            file_content = self.libraries_dict[filename]
+            if self.stats is not None:
+                start = time.perf_counter()
+                parses = self.stats.parses
+                config = load_library(filename, file_content, self.stats)
+                self.stats.libraries[filename] = {"ms": (time.perf_counter() - start) * 1000, "cached": self.stats.parses == parses}
+            else:
+                config = load_library(filename, file_content)
+            self.ggt = _merge_definitions(self.ggt, config["ggt"])
+            self.spf = _merge_definitions(self.spf, config["spf"])
+            self.cpf = _merge_definitions(self.cpf, config["cpf"])
+            self.imports.append(filename)
+            print(f"Successfully loaded module '{filename}'")
+        except Exception as e:
+            print(f"Error loading module '{filename}': {e}")
+
+
+
+
+
+
+#=======================================preprocess end=========================================
+    
+
+func_grammar = r"""
+    ?start: func_program
+
+    func_program: (HEX_DATA | ggt_call | spf_call | cpf_call |ANY_CHAR)*
+
+    ggt_call: GGT_NAME
+    spf_call: SPF_NAME "(" params ")"
+    cpf_call: CPF_NAME "(" params ")" "{" brace_block "}"
+
+
+    brace_block: (brace_block_nested | ANY_CHAR | ggt_call | spf_call | cpf_call)+
+    brace_block_nested: "{" brace_block "}"
+    param: ANY_STRING
+    params: [param ("," param)*]
+
+    COMMENT: /(\/\/|;)[^\n]*/
+    
+    //终结符
+    HEX_DATA: /[0-9a-fA-FxX]{2}/
+    GGT_NAME: /\$[^ \t\r\n(]+/
+    SPF_NAME: /\*[^ \t\r\n(]+/
+    CPF_NAME: /![^ \t\r\n(]+/
+    ANY_STRING: /[^,)]+/
+    ANY_CHAR: /[^\$\*!\{\}]+/
+
+    %ignore COMMENT
+    // --- 导入和忽略 ---
+    %import common.CNAME 
+    %import common.NEWLINE 
+    %import common.WS
+    %ignore WS          // 忽略空格
+    %ignore NEWLINE     // 忽略空行
+"""
+
+# 宏展开的默认预算：嵌套深度与单次展开结果的最大长度（字符数）
+MAX_EXPANSION_DEPTH = 64
+MAX_EXPANSION_SIZE = 4 * 1024 * 1024
+
+# 宏调用的标记字符，不含这些字符的文本无需再次解析
+_CALL_MARKS = re.compile(r'[\$\*!]')
+
+# 模板中的作用域标签与参数槽
+_SCOPED_LABEL = re.compile(r'&_(\S+)_&')
+_PARAM_SLOT = re.compile(r'%_([a-zA-Z_][a-zA-Z0-9_]*?)_%')
+
+# 操作数全为常量的 < > 表达式与 [ ] 字节交换。括号前须为空白或另一层括号，
+# 以免匹配到 $r0=er0<=er2? 这类名称中的字符
+_CONST_OPERAND = r'(?:[0-9a-fA-F]{2}\s*)+'
+_CONST_EXPR = re.compile(r'(?<![^\s\[(<,])<\s*(' + _CONST_OPERAND + r'(?:[+-]\s*' + _CONST_OPERAND + r')*)>')
+_CONST_SWAP = re.compile(r'(?<![^\s\[(<,])\[\s*(' + _CONST_OPERAND + r')\]')
+
+def _fold_constants(text):
+    """
+    在展开阶段对常量表达式求值，例如 *jump_er14 (d200) 中的 [< %_adr_% - 0008 >] 直接成为 F8D1，
+    汇编时不再逐个解析其中的符号。求值与汇编阶段相同（AsmTransformer），
+    结果位数为奇数或交换的长度不合法时保留原文，由汇编阶段报告错误。
+    """
+    def fold_expr(match):
+        parts = re.split(r'\s*([+-])\s*', match.group(1).strip())
+        items = [part if i % 2 else HexValue.parse(re.sub(r'\s', '', part).lower()) for i, part in enumerate(parts)]
+        value = AsmTransformer._eval_expr(items, "0") if len(items) > 1 else items[0]
+        return match.group() if value.digits % 2 else f" {value} "
+
+    def fold_swap(match):
+        value = HexValue.parse(re.sub(r'\s', '', match.group(1)).lower())
+        return match.group() if value.digits % 4 else f" {AsmTransformer._swap_endian([value])} "
+
+    while True:
+        folded = _CONST_SWAP.sub(fold_swap, _CONST_EXPR.sub(fold_expr, text))
+        if folded == text:
+            return text
+        text = folded
+
+class MacroTemplate():
+    """
+    spf/cpf 定义的预编译模板。定义时把函数体切分为片段：文本（str）、参数槽（形参序号 int）
+    和作用域标签槽（由前两者组成的 list，实例化时加上作用域后缀），实例化只需一次拼接，
+    不再对函数体逐个参数做正则替换。%%BODY%% 作为文本保留，在模板展开之后再填入调用处的代码块。
+    实参原样插入，其中的 %_xxx_% 与 &_xxx_& 不再被替换。
+    函数体含 < > 或 [ ] 时，实例化后对其中的常量表达式求值（见 _fold_constants）。
+    """
+    def __init__(self, params, body):
+        self.params = [param for param in params if param is not None]
+        self.body = body
+        self.fold = "<" in body or "[" in body
+        slots = {param_name: i for i, (param_name, _) in enumerate(self.params)}   # 同名形参以最后一个为准
+        self.segments = []
+        pos = 0
+        for match in _SCOPED_LABEL.finditer(body):
+            self._split(body[pos:match.start()], slots, self.segments)
+            label = []
+            self._split(match.group(1), slots, label)
+            self.segments.append(label)
+            pos = match.end()
+        self._split(body[pos:], slots, self.segments)
+
+    @staticmethod
+    def _split(text, slots, segments):
+        pos = 0
+        for match in _PARAM_SLOT.finditer(text):
+            slot = slots.get(match.group(1))
+            if slot is None:
+                continue
+            if match.start() > pos:
+                segments.append(text[pos:match.start()])
+            segments.append(slot)
+            pos = match.end()
+        if pos < len(text):
+            segments.append(text[pos:])
+
+    def __eq__(self, other):
+        # 定义内容相同的模板视为相同，增量编译据此判断依赖是否变化
+        return isinstance(other, MacroTemplate) and self.params == other.params and self.body == other.body
+
+    def instantiate(self, name, args, scope):
+        #将形参映射到实参，缺少的实参使用默认值
+        values = list(args[:len(self.params)])
+        for _, default in self.params[len(values):]:
+            if default is None:
+                raise Exception(f"Not enough parameters for function: {name}")
+            values.append(default)
+
+        parts = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+            elif isinstance(segment, int):
+                parts.append(values[segment])
+            else:
+                parts.extend(part if isinstance(part, str) else values[part] for part in segment)
+                parts.append(f"__{scope}")
+        text = "".join(parts)
+        return _fold_constants(text) if self.fold else text
+
+
+class _Expansion(str):
+    """
+    记录了来源的展开结果，只在 FuncTransformer(source_map=True) 时产生：
+    spans 为其中各次调用的展开区间 (起点, 终点, 调用名)，按起点排序、外层在前；
+    anchors 为 (展开文本中的偏移, 块源码中的偏移, 是否为原文)，按偏移排序。原文之后的字符与源码逐个对应，
+    调用的展开结果则整体对应到调用名所在的位置。只有块的顶层才有 anchors，宏体内的位置不对应块源码。
+    """
+    def __new__(cls, text, spans, anchors):
+        expansion = super().__new__(cls, text)
+        expansion.spans = spans
+        expansion.anchors = anchors
+        return expansion
+
+
+def _collect_errors(method):
+    # 检查模式（errors 不为 None）下，顶层调用出错时记录 (调用名 Token, 异常) 并以空文本代替，
+    # 继续展开其余调用，从而一次报告多个错误；嵌套展开中的错误归到引发它的顶层调用处
+    def wrapper(self, items):
+        if self.errors is None or self.call_stack:
+            return method(self, items)
+        try:
+            return method(self, items)
+        except Exception as e:
+            self.errors.append((items[0], e))
+            return ""
+    return wrapper
+
+class FuncTransformer(Transformer):
+    """
+    单遍递归展开器：每个调用在替换参数后立即递归展开自身的函数体，
+    因此一个块只需自顶向下解析一次，不再反复解析整个块直到不变。
+    source_map=True 时展开结果为 _Expansion，记录每段文本来自哪次调用、对应块源码的哪个位置（见 SourceMap）。
+    """
+    def __init__(self, ggt, spf, cpf, max_depth=MAX_EXPANSION_DEPTH, max_size=MAX_EXPANSION_SIZE, stats=None, source_map=False):
+        self.ggt = ggt
+        self.spf = spf
+        self.cpf = cpf
+        self.max_depth = max_depth
+        self.max_size = max_size
+        self.stats = stats
+        self.source_map = source_map
+        self.call_stack = []
+        self.used = {}      # 本次展开引用到的定义：名称 -> 定义内容，用于增量编译判断依赖是否变化
+        self.errors = None  # 检查模式下为列表，收集顶层调用的错误
+        self.scope = "block"
+        self.instances = 0
+        super().__init__()
+
+    def expand_block(self, block_name, code):
+        # 展开一个块：重置依赖记录；宏内的作用域标签按块名和块内的展开序号命名，
+        # 因此块源码与其依赖不变时，展开结果逐字节相同，与其他块的内容无关
+        self.used = {}
+        self.scope = block_name
+        self.instances = 0
+        return self.expand(code)
+
+    def expand(self, code):
+        if not _CALL_MARKS.search(code):
+            return code
+        if self.stats is not None:
+            self.stats.count_parse(code)
+        result = _transform(self, get_parser("func").parse(code))
+        if len(result) > self.max_size:
+            raise Exception(f"Expansion exceeds size limit ({self.max_size} chars): {' -> '.join(self.call_stack) or 'block'}")
+        if self.stats is not None:
+            self.stats.track_size(result)
+        return result
+
+    def _expand_call(self, name, def_body):
+        if name in self.call_stack:
+            raise Exception(f"Recursive function call: {' -> '.join(self.call_stack + [name])}")
+        if len(self.call_stack) >= self.max_depth:
+            raise Exception(f"Expansion depth limit ({self.max_depth}) exceeded: {' -> '.join(self.call_stack + [name])}")
+        if self.stats is not None:
+            self.stats.expansions[name] = self.stats.expansions.get(name, 0) + 1
+        self.call_stack.append(name)
+        try:
+            result = self.expand(def_body)
+        finally:
+            self.call_stack.pop()
+        if not self.source_map:
+            return result
+        # 顶层调用的展开结果整体对应到调用名（Token）在块源码中的位置
+        anchors = [] if self.call_stack else [(0, name.start_pos, False)]
+        return _Expansion(result, [(0, len(result), str(name))] + getattr(result, "spans", []), anchors)
+
+    def _join(self, items):
+        # 拼接转换结果；记录来源时平移各部分的区间，顶层的原文 Token 按自身位置对应到块源码
+        text = "".join(items)
+        if not self.source_map:
+            return text
+        spans, anchors = [], []
+        top = not self.call_stack
+        offset = 0
+        for item in items:
+            if isinstance(item, _Expansion):
+                spans.extend((start + offset, end + offset, name) for start, end, name in item.spans)
+                anchors.extend((pos + offset, source_pos, raw) for pos, source_pos, raw in item.anchors)
+            elif top and isinstance(item, Token):
+                anchors.append((offset, item.start_pos, True))
+            offset += len(item)
+        return _Expansion(text, spans, anchors)
+
+    def _fill_body(self, expansion, body, name):
+        # 记录来源时的 %%BODY%% 替换：模板展开结果中的区间随之平移，调用处代码块的区间与来源放到每个填入位置，
+        # 代码块之后的模板文本仍对应到调用名
+        marker = r"%%BODY%%"
+        text = expansion.replace(marker, body)
+        if not isinstance(expansion, _Expansion):
+            return text
+        found = [match.start() for match in re.finditer(re.escape(marker), expansion)]
+        delta = len(body) - len(marker)
+        spans = [
+            (start + delta * bisect.bisect_left(found, start), end + delta * bisect.bisect_right(found, end - len(marker)), span_name)
+            for start, end, span_name in expansion.spans
+        ]
+        anchors = list(expansion.anchors)
+        for i, pos in enumerate(found):
+            pos += delta * i
+            if isinstance(body, _Expansion):
+                spans.extend((start + pos, end + pos, span_name) for start, end, span_name in body.spans)
+                anchors.extend((body_pos + pos, source_pos, raw) for body_pos, source_pos, raw in body.anchors)
+            if expansion.anchors:
+                anchors.append((pos + len(body), name.start_pos, False))
+        spans.sort(key=lambda span: (span[0], -span[1]))
+        anchors.sort(key=lambda anchor: anchor[0])
+        return _Expansion(text, spans, anchors)
+
+    @_collect_errors
+    def ggt_call(self, token):
+        name = token[0]
+        try:
+            ggt_value = self.ggt[name]
+        except KeyError:
+            self.used[name] = None  # 之后补上定义时依赖随之变化
+            raise Exception(f"Undefined function: {name}")
+        self.used[name] = ggt_value
+        return self._expand_call(name, ggt_value)
+
+    @_collect_errors
+    def spf_call(self, items):
+        return self._macro_call(self.spf, items[0], items[1])
+
+    @_collect_errors
+    def cpf_call(self, items):
+        # 调用处的代码块在自底向上转换时已经展开，这里先展开模板本身，再填入%%BODY%%
+        expansion = self._macro_call(self.cpf, items[0], items[1])
+        if self.source_map:
+            return self._fill_body(expansion, items[2], items[0])
+        return expansion.replace(r"%%BODY%%", items[2])
+
+    def _macro_call(self, table, name, params):
+        try:
+            definition = table[name]
+        except KeyError:
+            self.used[name] = None  # 之后补上定义时依赖随之变化
+            raise Exception(f"Undefined function: {name}")
+        self.used[name] = definition
+        args = [item for item in params if item is not None]
+        # 作用域标签命名为 xxx__块名_序号，序号为该调用在块内的展开次序
+        self.instances += 1
+        def_body = definition['template'].instantiate(name, args, f"{self.scope}_{self.instances}")
+        return self._expand_call(name, def_body)
+
+
+
+    def brace_block(self, items): return self._join(items)
+    def brace_block_nested(self, token): return self._join(["{ ", token[0], " }"])
+    def param(self, token): return token[0]
+    def params(self, items): return items
+
+
+    # 原文保留为 Token，记录来源时据此对应到块源码中的位置；调用名保留为 Token（str 的子类），检查模式据此定位调用位置
+    def GGT_NAME(self, token): return token
+    def SPF_NAME(self, token): return token
+    def CPF_NAME(self, token): return token
+    def CNAME(self, token): return token.value
+    def ANY_STRING(self, token): return token.value
+    def HEX_DATA(self, token): return token
+    def ANY_CHAR(self, token): return token
+
+    
+    #返回处理后的代码
+    def func_program(self, items):
+        return self._join(items)
+
+
+asm_grammar = r"""
+    start: (expr | offset_def | x_def | label_def | overwrite | rstoffst)*
+    ?expr: term (( PLUS | MINUS ) term)*
+    ?term: factor+
+    ?factor: brackets | swap_endian | hex | LABEL_CALL | LABEL_CALL_RAW
+    swap_endian: "[" expr "]" 
+    ?brackets: "<" expr ">"
+
+    overwrite: "@overwrite" "(" expr "," expr ")"
+
+    offset_def: "@offset" "=" FOUR_BYTE
+    rstoffst: "@rstoffst"
+    x_def: "@x" "=" HALF_BYTE
+    label_def: "@adr" "." CNAME
+
+    PLUS: "+"
+    MINUS: "-"
+
+    FOUR_BYTE: /[0-9a-fA-F]{4}/
+    HALF_BYTE: /[0-9a-fA-F]/
+    hex: HEX_DATA+
+    LABEL_CALL: /#[a-zA-Z_][a-zA-Z0-9_]*/
+    LABEL_CALL_RAW: /##[a-zA-Z_][a-zA-Z0-9_]*/
+    HEX_DATA: /[0-9a-fA-FxX]{2}/
+
+    
+    COMMENT: /(\/\/|;)[^\n]*/
+
+    %ignore COMMENT
+    %import common.CNAME
+    %import common.WS
+    %ignore WS
+"""
+
+
+class HexValue():
+    """
+    汇编阶段的字节表达式的值：整数 value、十六进制位数 digits 与通配掩码 wild。
+    wild 与 value 对齐，来自占位符 x 的半字节为 F（此时 value 中对应的半字节为 0）；
+    表达式、[ ] 字节交换、< > 分组与拼接都直接作用于整数，只在输出字节码时按占位符填入 x。
+    """
+    __slots__ = ("value", "digits", "wild")
+
+    def __init__(self, value, digits, wild=0):
+        self.value = value
+        self.digits = digits
+        self.wild = wild
+
+    @classmethod
+    def parse(cls, text):
+        # 由十六进制文本（可含 x）构造
+        if "x" not in text:
+            return cls(int(text, 16), len(text))
+        return cls(int(text.replace("x", "0"), 16), len(text), int(re.sub(r'[^x]', "0", text).replace("x", "f"), 16))
+
+    @property
+    def wildcard(self):
+        return self.wild != 0
+
+    def filled(self, placeholder):
+        # x 替换为占位符（单个十六进制字符）后的整数
+        if not self.wild:
+            return self.value
+        return self.value | (self.wild & (int(placeholder, 16) * ((16 ** self.digits - 1) // 15)))
+
+    def to_bytes(self, placeholder):
+        # -> (字节, 占位符掩码)；掩码中 0xF0/0x0F 表示该字节的高/低半字节来自 x
+        if self.digits % 2 != 0:
+            raise ValueError(f"Odd number of hex digits: {self}")
+        size = self.digits // 2
+        mask = self.wild.to_bytes(size, "big") if self.wild else bytes(size)
+        return self.filled(placeholder).to_bytes(size, "big"), mask
+
+    def __str__(self):
+        text = f"{self.value:0{self.digits}X}"
+        if not self.wild:
+            return text
+        wild = f"{self.wild:0{self.digits}X}"
+        return "".join("x" if mask == "F" else char for char, mask in zip(text, wild))
+
+    def __repr__(self):
+        return f"HexValue({self})"
+
+def _concat(values):
+    # 依次拼接；各部分均为整字节时经由 bytes 拼接，耗时与总长度成线性
+    if len(values) == 1:
+        return values[0]
+    digits = sum(value.digits for value in values)
+    if any(value.digits % 2 for value in values):
+        return HexValue.parse("".join(str(value).lower() for value in values))
+    value = int.from_bytes(b"".join(value.value.to_bytes(value.digits // 2, "big") for value in values), "big")
+    wild = 0
+    if any(value.wild for value in values):
+        wild = int.from_bytes(b"".join(value.wild.to_bytes(value.digits // 2, "big") for value in values), "big")
+    return HexValue(value, digits, wild)
+
+def _hex_digits(value):
+    return max(1, (value.bit_length() + 3) // 4)
+
+
+class _ZeroLabels(dict):
+    # 所有标签都视为 0，用于在标签确定之前计算表达式的宽度
+    def __missing__(self, key):
+        return (0, 0)
+
+_ZERO_LABELS = _ZeroLabels()
+
+
+class Fixup():
+    """
+    依赖地址标签的值。resolve(label_map) 返回最终的 HexValue；
+    宽度（十六进制位数）按所有标签为 0 时的结果确定，回填时宽度必须保持不变。
+    """
+    def __init__(self, resolve, labels):
+        self.resolve = resolve
+        self.labels = labels
+        value = resolve(_ZERO_LABELS)
+        self.width = value.digits
+        self.wildcard = value.wildcard  # 回填的值含占位符 x（标签的值不含 x，与标签取值无关）
 
+    def patch(self, label_map):
+        value = self.resolve(label_map)
+        if value.digits != self.width:
+            raise Exception(f"Value out of range after resolving labels {', '.join(self.labels)}: {value}")
+        return value
 
 
-        class PreTransformer(Transformer):
-            def __init__(self):
-                super().__init__()
-                self.ggt = {}
-                self.spf = {}
-                self.cpf = {}
-                self.blocks = {}
+def _resolve(value, label_map):
+    return value.resolve(label_map) if isinstance(value, Fixup) else value
 
+def _has_wildcard(values):
+    # values 中可能夹有运算符（str）
+    return any(not isinstance(value, str) and value.wildcard for value in values)
 
-            # import 语句处理器
-            def import_stmt(self, token):
-                self._load_module(token[0])
-                return None
+# Fixup 的 resolve 只由模块级函数和 functools.partial 组成，可以被 pickle，以便在工作进程之间传递
+def _label_hex(label_name, index, label_map):
+    address = _lookup_label(label_map, label_name, index)
+    return HexValue(address, max(4, _hex_digits(address)))
 
-            # ggt_def 处理器：直接更新 ggt_dict
-            def ggt_def(self, items):
-                name = items[0]
-                data = items[1]
-                self.ggt[name] = data
-                return None
+def _apply(func, values, label_map):
+    return func([_resolve(value, label_map) for value in values])
 
-            # spf_def 处理器：直接更新 spf_dict
-            def spf_def(self, items):
-                name = items[0]
-                params = items[1]
-                body = items[2]
-                self.spf[name] = {'params': params, 'body': body}
-                return None
-            
-            # cpf_def 处理器：直接更新 cpf_dict
-            def cpf_def(self, items):
-                name = items[0]
-                params = items[1]
-                body = items[2]
-                self.cpf[name] = {'params': params, 'body': body}
+def _lookup_label(label_map, label_name, index):
+    try:
+        return label_map[label_name][index]
+    except KeyError:
+        raise Exception(f"Label undefined: {label_name}")
+
+def _deferred(func, values):
+    # 参与运算的值全部已知时直接求值，否则生成新的 Fixup
+    if not any(isinstance(value, Fixup) for value in values):
+        return func(values)
+    labels = []
+    for value in values:
+        if isinstance(value, Fixup):
+            labels.extend(label for label in value.labels if label not in labels)
+    return Fixup(functools.partial(_apply, func, values), labels)
+
+
+class CodeBuffer():
+    """
+    块的字节码缓冲区。data 为字节码，mask 与 data 等长，记录由占位符 x 填充的半字节；
+    fixups 与 patches 分别是待回填的标签值和待应用的覆写，只有调用 hex() 时才生成文本。
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.mask = bytearray()
+        self.fixups = []    # (字节偏移, Fixup, 占位符)
+        self.patches = []   # (地址, 值, 占位符)
+
+    def __len__(self):
+        return len(self.data)
+
+    def copy(self):
+        buffer = CodeBuffer()
+        buffer.data = bytearray(self.data)
+        buffer.mask = bytearray(self.mask)
+        buffer.fixups = list(self.fixups)
+        buffer.patches = list(self.patches)
+        return buffer
+
+    def label_names(self):
+        # 回填和覆写中引用到的全部标签名
+        names = set()
+        for _, fixup, _ in self.fixups:
+            names.update(fixup.labels)
+        for addr, value, _ in self.patches:
+            for item in (addr, value):
+                if isinstance(item, Fixup):
+                    names.update(item.labels)
+        return names
+
+    def emit(self, value, placeholder):
+        data, mask = value.to_bytes(placeholder)
+        self.data += data
+        self.mask += mask
+
+    def reserve(self, fixup, placeholder):
+        self.fixups.append((len(self.data), fixup, placeholder))
+        size = fixup.width // 2
+        self.data += bytes(size)
+        self.mask += bytes(size)
+
+    def write(self, pos, value, placeholder):
+        data, mask = value.to_bytes(placeholder)
+        self.data[pos:pos + len(data)] = data
+        self.mask[pos:pos + len(mask)] = mask
+
+    def resolve(self, label_map):
+        for pos, fixup, placeholder in self.fixups:
+            self.write(pos, fixup.patch(label_map), placeholder)
+        self.fixups = []
+
+        # 覆写：先全部求值并检查范围，再按声明顺序一次写入
+        patch_table = []
+        for addr, value, placeholder in self.patches:
+            addr = _resolve(addr, label_map)
+            value = _resolve(value, label_map)
+            # 地址按十六进制文本解释，与以往一样接受 0x 前缀
+            pos = int(str(addr), 16) if addr.wildcard else addr.value
+            if value.digits % 2 != 0 or pos + value.digits // 2 > len(self.data):
+                raise Exception(f"Overwrite address out of range: {addr}")
+            patch_table.append((pos, value, placeholder))
+        for pos, value, placeholder in patch_table:
+            self.write(pos, value, placeholder)
+        self.patches = []
+
+    def hex(self):
+        return self.data.hex().upper()
+
+
+# 单遍汇编：每个块只解析一次，直接输出字节码；遇到地址标签时记录回填项，
+# 所有块汇编完成、标签全部确定后再统一回填。source_map=True 时另外在 origins 中记录每段字节在展开文本中的位置
+class AsmTransformer(Transformer):
+    def __init__(self, stats=None, source_map=False):
+        self.stats = stats
+        self.source_map = source_map
+        self.origins = []       # (块内字节偏移, 展开文本中的偏移)，按字节偏移排序
+        self.nodes = []
+        self.term_widths = {}   # id(拼接结果) -> 各部分的十六进制位数
+        self.label_map = {}     # 标签名 -> (绝对地址, 相对地址)
+        self.byte_count = 0
+        self.offset = 0x0000
+        self.x_placeholder = "0"
+        self.block_placeholder = "0"
+        self.block_labels = []
+        self.label_flags = []   # 与 block_labels 对应：(定义时块内是否已设置 @offset, 是否已 @rstoffst)
+        self.overwrites = []
+        self.offset_set = self.count_reset = self.placeholder_set = self.placeholder_used = False
+        super().__init__()
+
+    def assemble(self, code):
+        # 返回该块的 CodeBuffer，标签相关的值留待 CodeBuffer.resolve 回填
+        self.block_placeholder = self.x_placeholder
+        self.block_labels = []
+        self.label_flags = []
+        self.overwrites = []
+        # 块内是否改变了偏移量 / 字节计数 / 占位符，以及是否用到了进入该块时的占位符，见 summary
+        self.offset_set = self.count_reset = self.placeholder_set = self.placeholder_used = False
+        if self.stats is not None:
+            self.stats.count_parse(code)
+        tree = get_parser("asm").parse(code)
+        if self.source_map:
+            self.origins = []
+            self.nodes = tree.children
+            self.term_widths = {}
+        return _transform(self, tree)
+
+    def state(self):
+        # 跨块传递的汇编状态，块的汇编结果只取决于块内容和该状态
+        return (self.offset, self.byte_count, self.x_placeholder)
+
+    def restore(self, state, labels):
+        # 复用缓存的汇编结果时，恢复块结束时的状态并登记块内定义的标签
+        self.offset, self.byte_count, self.x_placeholder = state
+        self.block_labels = []
+        for label_name, adr in labels:
+            self.define_label(label_name, adr)
+
+    def summary(self):
+        """
+        从初始状态（偏移量与字节计数为 0）汇编一个块之后，描述结果与进入状态的关系，供 relocate 使用：
+        labels 中未设置过 @offset 的标签偏移量为 None，未 @rstoffst 过的字节计数是相对于进入时的增量；
+        placeholder_used 为真时块的字节码依赖进入时的占位符，只有占位符与汇编时相同才能直接复用。
+        """
+        labels = []
+        for (label_name, (address, count)), (offset_set, count_reset) in zip(self.block_labels, self.label_flags):
+            labels.append((label_name, address - count if offset_set else None, count, count_reset))
+        return {
+            "labels": labels,
+            "offset": self.offset if self.offset_set else None,
+            "byte_count": self.byte_count,
+            "count_reset": self.count_reset,
+            "placeholder": self.x_placeholder if self.placeholder_set else None,
+            "placeholder_used": self.placeholder_used,
+        }
+
+    def relocate(self, summary):
+        # 把 summary 描述的块接在当前状态之后：登记块内标签并推进状态，结果与在当前状态下汇编该块相同
+        offset, byte_count = self.offset, self.byte_count
+        self.block_labels = []
+        for label_name, label_offset, count, count_reset in summary["labels"]:
+            count = count if count_reset else byte_count + count
+            label_offset = offset if label_offset is None else label_offset
+            self.define_label(label_name, (label_offset + count, count))
+        if summary["offset"] is not None:
+            self.offset = summary["offset"]
+        self.byte_count = summary["byte_count"] if summary["count_reset"] else byte_count + summary["byte_count"]
+        if summary["placeholder"] is not None:
+            self.x_placeholder = summary["placeholder"]
+
+    def define_label(self, label_name, adr):
+        if label_name in self.label_map:
+            raise Exception(f"Label {label_name} already defined")
+        self.label_map[label_name] = adr
+        self.block_labels.append((label_name, adr))
+
+    def hex(self, items):
+        return HexValue.parse("".join(items))
+    def term(self, items):
+        value = _deferred(_concat, items)
+        if self.source_map:
+            self.term_widths[id(value)] = [item.digits if isinstance(item, HexValue) else item.width for item in items]
+        return value
+    def overwrite(self, items):
+        if not self.placeholder_set and _has_wildcard(items[1:]):
+            self.placeholder_used = True
+        self.overwrites.append((items[0], items[1], self.x_placeholder))
+        return None
+    def offset_def(self, items):
+        return ("offset", int(items[0], 16))
+    def rstoffst(self, token):
+        return ("rstoffst",)
+    def x_def(self, items):
+        self.x_placeholder = items[0]
+        self.placeholder_set = True
+        return ("x", items[0])
+    def label_def(self, items):
+        return ("adr", items[0])
+
+    def swap_endian(self, token):
+        return _deferred(self._swap_endian, token)
+    def expr(self, items):
+        if len(items) == 1: return items[0]
+        if not self.placeholder_set and _has_wildcard(items):
+            self.placeholder_used = True
+        return _deferred(functools.partial(self._eval_expr, placeholder=self.x_placeholder), items)
+
+    def LABEL_CALL(self, token):
+        label_name = token.value[1:]
+        return Fixup(functools.partial(_label_hex, label_name, 0), [label_name])
+    
+    def LABEL_CALL_RAW(self, token):
+        label_name = token.value[2:]
+        return Fixup(functools.partial(_label_hex, label_name, 1), [label_name])
+    
+    def HEX_DATA(self, token):
+        hex_string:str = token.value
+        hex_string = hex_string.lower()
+        hex_string = hex_string.replace(" ", "")
+        # x 保留到输出时再替换为占位符，以便记录通配半字节的位置
+        return hex_string
+
+    def FOUR_BYTE(self, token):
+        return token.value
+    def HALF_BYTE(self, token):
+        return token.value
+    def PLUS(self, token): return token.value
+    def MINUS(self, token): return token.value
+    def CNAME(self, token):
+        return token.value
+
+    def start(self, items):
+        buffer = CodeBuffer()
+        buffer.patches = self.overwrites
+        placeholder = self.block_placeholder
+        entry_placeholder = True    # 仍在使用进入该块时的占位符
+        for i, item in enumerate(items):
+            if item is None:
+                continue
+            if self.source_map and isinstance(item, (HexValue, Fixup)):
+                self._record_origins(len(buffer), self.nodes[i], item)
+            if isinstance(item, HexValue):
+                buffer.emit(item, placeholder)
+                self.byte_count += item.digits // 2
+                if entry_placeholder and item.wild:
+                    self.placeholder_used = True
+            elif isinstance(item, Fixup):
+                buffer.reserve(item, placeholder)
+                self.byte_count += item.width // 2
+                if entry_placeholder and item.wildcard:
+                    self.placeholder_used = True
+            elif item[0] == "x":
+                placeholder = item[1]
+                entry_placeholder = False
+            elif item[0] == "adr":
+                self.define_label(item[1], (self.offset + self.byte_count, self.byte_count))
+                self.label_flags.append((self.offset_set, self.count_reset))
+            elif item[0] == "offset":
+                self.offset = item[1]
+                self.offset_set = True
+            elif item[0] == "rstoffst":
+                self.byte_count = 0
+                self.count_reset = True
+        return buffer
+
+    def _record_origins(self, offset, node, item):
+        # 字节码逐字节对应到 HEX_DATA；拼接按各部分拆开；表达式、字节交换与标签整体对应到第一个符号
+        if isinstance(node, Token):
+            self.origins.append((offset, node.start_pos))
+        elif node.data == "hex":
+            self.origins.extend((offset + i, token.start_pos) for i, token in enumerate(node.children))
+        elif node.data == "term":
+            digits = 0
+            for child, width in zip(node.children, self.term_widths[id(item)]):
+                self._record_origins(offset + digits // 2, child, None)
+                digits += width
+        else:
+            while not isinstance(node, Token):
+                node = node.children[0]
+            self.origins.append((offset, node.start_pos))
+
+    # 一些辅助函数（不依赖实例状态，可随 Fixup 一起 pickle）
+    @staticmethod
+    def _eval_expr(items, placeholder):
+        # items 为 [值, 运算符, 值, ...]；运算宽度取操作数中最长的位数并补齐为偶数，减法结果为负时按该宽度回绕，
+        # 加法溢出时结果变宽
+        width = max(items[i].digits for i in range(0, len(items), 2))
+        width += width % 2
+        result = items[0].filled(placeholder)
+        for i in range(2, len(items), 2):
+            op = items[i-1]
+            value = items[i].filled(placeholder)
+            if op == "+":
+                result += value
+            elif op == "-":
+                result -= value
+                if result < 0:
+                    result += 16 ** width
+            else:
+                raise Exception(f"Invalid operator: {op}")
+        return HexValue(result, max(width, _hex_digits(result)))
+
+    @staticmethod
+    def _swap_endian(values):
+        # 每两个字节交换位置
+        value = values[0]
+        if value.digits % 4 != 0:
+            raise ValueError("Hex string length for endian swap must have even length")
+        size = value.digits // 2
+        return HexValue(_swap_pairs(value.value, size), value.digits, _swap_pairs(value.wild, size) if value.wild else 0)
+
+
+def _swap_pairs(number, size):
+    data = number.to_bytes(size, "big")
+    swapped = bytearray(size)
+    swapped[0::2] = data[1::2]
+    swapped[1::2] = data[0::2]
+    return int.from_bytes(swapped, "big")
+
+
+#=======================================source map=========================================
+
+class SourceMap():
+    """
+    一个块的字节来源，由 ROPCompiler(source_map=True) 生成。entries 为按字节偏移排序的 (起点, 终点, 行, 调用链)：
+    行相对于块内容的第一行（从 0 开始），调用链为由外到内的调用名元组，如 ("*print", "$xr0=")，
+    空元组表示块中直接写出的字节码；相邻且来源相同的字节合并为一项。
+    line 为块内容第一行在源码中的行号（从 1 开始），每次编译时设置，块在源码中移动位置后缓存的 SourceMap 仍可复用。
+    """
+    def __init__(self, code, expanded, origins, size):
+        spans = getattr(expanded, "spans", [])
+        anchors = getattr(expanded, "anchors", None) or [(0, 0, True)]    # 不含调用的块与源码逐字对应
+        newlines = [match.start() for match in re.finditer("\n", code)]
+        self.line = 1
+        self.size = size
+        self.entries = []
+        open_spans = []
+        chain = ()
+        span_index = anchor_index = 0
+        for i, (offset, pos) in enumerate(origins):
+            end = origins[i + 1][0] if i + 1 < len(origins) else size
+            # 调用区间严格嵌套，栈中即为包含 pos 的各层调用
+            changed = False
+            while span_index < len(spans) and spans[span_index][0] <= pos:
+                while open_spans and open_spans[-1][1] <= spans[span_index][0]:
+                    open_spans.pop()
+                open_spans.append(spans[span_index])
+                span_index += 1
+                changed = True
+            while open_spans and open_spans[-1][1] <= pos:
+                open_spans.pop()
+                changed = True
+            if changed:
+                chain = tuple(span[2] for span in open_spans)
+            while anchor_index + 1 < len(anchors) and anchors[anchor_index + 1][0] <= pos:
+                anchor_index += 1
+            anchor_pos, source_pos, raw = anchors[anchor_index]
+            if raw:
+                source_pos += pos - anchor_pos
+            line = bisect.bisect_left(newlines, source_pos)
+            last = self.entries[-1] if self.entries else None
+            if last is not None and last[1] == offset and last[2] == line and last[3] == chain:
+                self.entries[-1] = (last[0], end, line, chain)
+            elif end > offset:
+                self.entries.append((offset, end, line, chain))
+
+    def lookup(self, offset):
+        # 块内字节偏移 -> 所在的一项，超出范围时为 None
+        i = bisect.bisect_right(self.entries, (offset, float("inf"))) - 1
+        if i >= 0 and self.entries[i][0] <= offset < self.entries[i][1]:
+            return self.entries[i]
+        return None
+
+    def to_dict(self):
+        return [{"start": start, "end": end, "line": self.line + line, "chain": list(chain)} for start, end, line, chain in self.entries]
+
+
+def size_report(source_maps):
+    """
+    按块、gadget 与宏汇总字节数（source_maps 为 {块名: SourceMap}）：
+    blocks 为各块的字节数；direct 为块中直接写出的字节数；gadgets 为各 gadget 自身输出的字节数；
+    macros 中 bytes 为宏展开的全部字节（含其中调用的 gadget 和宏），self 为宏体中直接写出的字节。各表按字节数从大到小排列。
+    """
+    blocks, gadgets, macros = {}, {}, {}
+    direct = 0
+    for block_name, source_map in source_maps.items():
+        blocks[block_name] = source_map.size
+        for start, end, _, chain in source_map.entries:
+            size = end - start
+            if not chain:
+                direct += size
+                continue
+            for name in chain:
+                if name[0] != "$":
+                    macros.setdefault(name, {"bytes": 0, "self": 0})["bytes"] += size
+            if chain[-1][0] == "$":
+                gadgets[chain[-1]] = gadgets.get(chain[-1], 0) + size
+            else:
+                macros[chain[-1]]["self"] += size
+    return {
+        "total": sum(blocks.values()),
+        "direct": direct,
+        "blocks": dict(sorted(blocks.items(), key=lambda item: -item[1])),
+        "gadgets": dict(sorted(gadgets.items(), key=lambda item: -item[1])),
+        "macros": dict(sorted(macros.items(), key=lambda item: -item[1]["bytes"])),
+    }
+
+
+#=======================================parser registry=========================================
+
+# 各阶段的语法与起始规则。LALR 分析表的构建开销远大于一次小程序的解析，
+# 因此 Lark 实例在整个进程内只构建一次；编译期状态全部放在每次新建的 Transformer 中，
+# 先 parse 出语法树再 transform，保证同一个解析器可以被安全复用。
+_GRAMMARS = {
+    "config": (config_grammar, 'config_program'),
+    "pre": (pre_grammar, 'pre_program'),
+    "func": (func_grammar, 'func_program'),
+    "asm": (asm_grammar, 'start'),
+}
+
+_PARSERS: Dict[str, Any] = {}
+
+def grammar_digest(name):
+    grammar, start = _GRAMMARS[name]
+    return hashlib.sha1(f"{start}\n{grammar}".encode("utf-8")).hexdigest()
+
+def serialize_parser(name):
+    # 用 lark 构建分析表并序列化为 (data, memo)，独立解析器运行时可直接加载
+    from lark import Lark
+    from lark.grammar import Rule
+    from lark.lexer import TerminalDef
+    grammar, start = _GRAMMARS[name]
+    return Lark(grammar, start=start, parser='lalr').memo_serialize([TerminalDef, Rule])
+
+def get_parser(name):
+    # 首次使用时构建，之后直接返回缓存的解析器
+    parser = _PARSERS.get(name)
+    if parser is None:
+        if _parser_runtime is None:
+            from lark import Lark
+            grammar, start = _GRAMMARS[name]
+            parser = Lark(grammar, start=start, parser='lalr')
+        else:
+            tables = _parser_runtime.load_tables(name, grammar_digest(name))
+            if tables is None:
+                # 语法已修改但 rop_parsers.py 未重新生成，退回到用 lark 现场构建
+                tables = serialize_parser(name)
+            parser = _parser_runtime.Lark._load_from_dict(*tables)
+        _PARSERS[name] = parser
+    return parser
+
+
+def _transform(transformer, tree):
+    # 语法树变换时回调中的异常会被包装为 VisitError（Error trying to process rule ...），
+    # 与以往在解析时直接变换一样，只向外报告原始异常
+    try:
+        return transformer.transform(tree)
+    except VisitError as e:
+        exc = e.orig_exc
+        while isinstance(exc, VisitError):
+            exc = exc.orig_exc
+        raise exc from None
+
+
+#=======================================definition scanner=========================================
+
+# pre/config 语法的线性扫描器：按位置找出 import、定义和 @block 区域，生成与 LALR 解析相同的语法树。
+# BLOCK_CONTENT 的惰性匹配在每个字符处都要检查前瞻，以 @end 结尾的块还要先向后查找整个文件中的 @blockend，
+# 块很大或很多时解析耗时急剧增长；扫描器用 str.find 定位块尾，总耗时与源码长度成正比。
+# 词法与语法保持一致：每个记号之前先跳过空白和注释（注释中的括号不计），定义体中的嵌套 { } 同样规范化为 "{ 内容 }"，
+# 块内容从 ":" 之后开始，截止到其后第一个 @blockend，没有时截止到第一个 @end。
+# 扫描器不接受的输入（语法错误或少见的写法）交给 LALR 解析器，错误信息与位置不变。
+
+_SCAN_IGNORED = re.compile(r'(?:[ \t\f\r\n]+|(?://|;)[^\n]*)*')
+_SCAN_BRACE = re.compile(r'[{}]')
+_SCAN_CNAME = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
+_SCAN_FILE_NAME = re.compile(r'[a-zA-Z0-9_\-.]+')
+_SCAN_ANY_STRING = re.compile(r'[^,)]+')
+_SCAN_DEFINITION_NAME = re.compile(r'[$*!][^ \t\r\n(]+')
+_SCAN_DEFINITIONS = {"$": ("GGT_NAME", "ggt_def"), "*": ("SPF_NAME", "spf_def"), "!": ("CPF_NAME", "cpf_def")}
+
+
+class _ScanFallback(Exception):
+    pass
+
+
+class _DefinitionScanner():
+    def __init__(self, code, keywords):
+        self.code = code
+        self.keywords = keywords    # pre 语法中定义以 def 开头，并有 import 与 @block
+        self.line = 1
+        self.line_pos = 0           # 已统计行号的位置
+        self.line_start = 0         # 该位置所在行的起点
+        self.blockend = None        # 下一个 @blockend 的位置，-1 表示之后没有
+
+    def _position(self, pos):
+        # -> (行, 列)；位置单调递增，总耗时与源码长度成正比
+        if pos < self.line_pos:
+            raise _ScanFallback()
+        newlines = self.code.count("\n", self.line_pos, pos)
+        if newlines:
+            self.line += newlines
+            self.line_start = self.code.rfind("\n", self.line_pos, pos) + 1
+        self.line_pos = pos
+        return self.line, pos - self.line_start + 1
+
+    def _token(self, kind, start, end, value=None):
+        line, column = self._position(start)
+        end_line, end_column = self._position(end)
+        return Token(kind, self.code[start:end] if value is None else value, start, line, column, end_line, end_column, end)
+
+    def _skip(self, pos):
+        return _SCAN_IGNORED.match(self.code, pos).end()
+
+    def _expect(self, pos, literal):
+        pos = self._skip(pos)
+        if not self.code.startswith(literal, pos):
+            raise _ScanFallback()
+        return pos + len(literal)
+
+    def _match(self, pos, pattern, kind):
+        pos = self._skip(pos)
+        match = pattern.match(self.code, pos)
+        if match is None:
+            raise _ScanFallback()
+        return self._token(kind, pos, match.end()), match.end()
+
+    def scan(self):
+        code, children, pos = self.code, [], 0
+        while True:
+            pos = self._skip(pos)
+            if pos == len(code):
+                return Tree("pre_program" if self.keywords else "config_program", children)
+            if self.keywords and code.startswith("import", pos):
+                token, pos = self._match(pos + 6, _SCAN_FILE_NAME, "FILE_NAME")
+                children.append(Tree("import_stmt", [token]))
+            elif self.keywords and code.startswith("@block", pos):
+                stmt, pos = self._block(pos + 6)
+                children.append(stmt)
+            else:
+                if self.keywords:
+                    if not code.startswith("def", pos):
+                        raise _ScanFallback()
+                    pos += 3
+                stmt, pos = self._definition(pos)
+                children.append(stmt)
+
+    def _block(self, pos):
+        name, pos = self._match(self._expect(pos, "."), _SCAN_CNAME, "CNAME")
+        start = self._expect(pos, ":")
+        # 块内容至少一个字符，截止到其后第一个 @blockend，没有时截止到第一个 @end。
+        # 块按顺序扫描，上次找到的 @blockend 仍在后面时不必重新查找
+        if self.blockend is None or 0 <= self.blockend <= start:
+            self.blockend = self.code.find("@blockend", start + 1)
+        if self.blockend != -1:
+            end, terminator = self.blockend, len("@blockend")
+        else:
+            end, terminator = self.code.find("@end", start + 1), len("@end")
+            if end == -1:
+                raise _ScanFallback()
+        return Tree("block", [name, self._token("BLOCK_CONTENT", start, end)]), end + terminator
+
+    def _definition(self, pos):
+        pos = self._skip(pos)
+        if pos == len(self.code) or self.code[pos] not in _SCAN_DEFINITIONS:
+            raise _ScanFallback()
+        kind, data = _SCAN_DEFINITIONS[self.code[pos]]
+        name, pos = self._match(pos, _SCAN_DEFINITION_NAME, kind)
+        children = [name]
+        if kind != "GGT_NAME":
+            params, pos = self._params(self._expect(pos, "("))
+            children.append(params)
+            if kind == "CPF_NAME":
+                pos = self._expect(pos, "{%%BODY%%}")
+        body, pos = self._brace_block(self._expect(pos, "{"))
+        children.append(body)
+        return Tree(data, children), pos
+
+    def _params(self, pos):
+        params = []
+        pos = self._skip(pos)
+        if self.code.startswith(")", pos):
+            return Tree("params", [None]), pos + 1
+        while True:
+            param_name, pos = self._match(pos, _SCAN_CNAME, "CNAME")
+            param = [param_name]
+            pos = self._skip(pos)
+            if self.code.startswith("=", pos):
+                default, pos = self._match(pos + 1, _SCAN_ANY_STRING, "ANY_STRING")
+                param.append(default)
+                pos = self._skip(pos)
+            params.append(Tree("param", param))
+            if self.code.startswith(",", pos):
+                pos += 1
+            elif self.code.startswith(")", pos):
+                return Tree("params", params), pos + 1
+            else:
+                raise _ScanFallback()
+
+    def _brace_block(self, pos):
+        # pos 为 "{" 之后；返回 (brace_block 树, "}" 之后的位置)。
+        # 定义体由文本片段与嵌套块拼成，只有一个文本片段时直接取源码切片
+        code = self.code
+        stack = [[]]
+        start = None
+        while True:
+            pos = self._skip(pos)
+            match = _SCAN_BRACE.search(code, pos)
+            if match is None:
+                raise _ScanFallback()
+            brace = match.start()
+            if brace > pos:
+                if start is None:
+                    start = pos
+                stack[-1].append(code[pos:brace])
+            pos = brace + 1
+            if code[brace] == "{":
+                stack.append([])
+                continue
+            parts = stack.pop()
+            if not parts:
+                raise _ScanFallback()     # 空的 { }
+            text = parts[0] if len(parts) == 1 else "".join(parts)
+            if not stack:
+                token = self._token("ANY_CHAR", start, brace, text)
+                return Tree("brace_block", [token]), pos
+            stack[-1].append(f"{{ {text} }}")
+
+
+def parse_definitions(name, code):
+    """
+    解析源码（name 为 "pre"）或库文件（"config"），返回与 get_parser(name).parse(code) 相同的语法树：
+    定义体的 brace_block 只含一个 ANY_CHAR 记号，值为拼接好的定义体，与 PreTransformer / ConfigTransformer 的结果相同。
+    """
+    try:
+        return _DefinitionScanner(code, name == "pre").scan()
+    except _ScanFallback:
+        return get_parser(name).parse(code)
+
+
+#=======================================library cache=========================================
+
+# 库文件解析结果缓存：文件名 -> (内容哈希, {"ggt", "spf", "cpf", "symbols"})
+# 同名文件内容变化时哈希不同，会在下次导入时重新解析并替换旧条目
+_LIBRARY_CACHE: Dict[str, Tuple[str, dict]] = {}
+
+# 索引库格式（由 tools/pack_library.py 从文本库生成），导入时只读取程序引用到的定义：
+#   ;ROP-INDEXED-LIBRARY 1
+#   名称<TAB>偏移<TAB>长度        每个定义一行，按名称排序
+#   ;END-INDEX
+#   记录……                        JSON 数组：[行号, 说明, 函数体] 或 [行号, 说明, 函数体, 形参]，偏移相对于记录区的起点
+INDEXED_LIBRARY_HEADER = ";ROP-INDEXED-LIBRARY 1\n"
+_INDEX_END = ";END-INDEX\n"
+_DEFINITION_TABLES = {"$": "ggt", "*": "spf", "!": "cpf"}
+
+def library_hash(content):
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+def load_library(filename, content, stats=None):
+    digest = library_hash(content)
+    cached = _LIBRARY_CACHE.get(filename)
+    if cached is not None and cached[0] == digest:
+        return cached[1]
+    if content.startswith(INDEXED_LIBRARY_HEADER):
+        library = IndexedLibrary(filename, content)
+        config = {table: _LibraryView(library, prefix, library.definition) for prefix, table in _DEFINITION_TABLES.items()}
+        config["symbols"] = _LibraryView(library, "", library.symbol)
+        _LIBRARY_CACHE[filename] = (digest, config)
+        return config
+    if stats is not None:
+        stats.count_parse(content)
+    tree = parse_definitions("config", content)
+    config = cast(dict, _transform(ConfigTransformer(), tree))
+    # 符号索引随解析结果一起缓存，同一版本的库文件只生成一次
+    lines = content.split("\n")
+    config["symbols"] = {}
+    for stmt in tree.children:
+        symbol = _definition_symbol(stmt, filename, lines)
+        if symbol is not None:
+            config["symbols"][symbol["name"]] = symbol
+    _LIBRARY_CACHE[filename] = (digest, config)
+    return config
+
+def prune_library_cache(libraries_dict):
+    # 丢弃已经不在库文件列表中的条目
+    for filename in list(_LIBRARY_CACHE):
+        if filename not in libraries_dict:
+            del _LIBRARY_CACHE[filename]
+
+def _merge_definitions(table, definitions):
+    # 文本库的定义直接合并；索引库按需查找，叠加在已有定义之上。
+    # 两种情况下都是后导入、后定义的覆盖先前的，之后的 def 写入最上层
+    if isinstance(definitions, dict):
+        table.update(definitions)
+        return table
+    return ChainMap({}, definitions, table)
+
+def pack_library(filename, content):
+    # 文本库 -> 索引库格式的文本
+    config = load_library(filename, content)
+    entries = {}
+    for name, symbol in config["symbols"].items():
+        definition = config[_DEFINITION_TABLES[name[0]]][name]
+        if isinstance(definition, dict):
+            record = [symbol["line"], symbol["detail"], definition["body"], [list(param) for param in definition["params"] if param is not None]]
+        else:
+            record = [symbol["line"], symbol["detail"], definition]
+        entries[name] = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+    index = []
+    offset = 0
+    for name in sorted(entries):
+        index.append(f"{name}\t{offset}\t{len(entries[name])}\n")
+        offset += len(entries[name])
+    return INDEXED_LIBRARY_HEADER + "".join(index) + _INDEX_END + "".join(entries[name] for name in sorted(entries))
+
+
+class IndexedLibrary():
+    """
+    索引库：按名称在有序索引中二分查找，只解析被引用到的记录，
+    导入的时间和内存随引用到的定义数量增长，与库的大小无关。
+    """
+    def __init__(self, filename, content):
+        self.filename = filename
+        self.content = content
+        self.index_start = len(INDEXED_LIBRARY_HEADER)
+        self.index_end = content.find(_INDEX_END)
+        if self.index_end == -1:
+            raise Exception(f"Corrupt indexed library: {filename}")
+        self.records_start = self.index_end + len(_INDEX_END)
+        self.records = {}       # 名称 -> 已读取的记录
+        self.definitions = {}   # 名称 -> 与文本库相同形式的定义
+
+    def _record(self, name):
+        if name in self.records:
+            return self.records[name]
+        content = self.content
+        low, high = self.index_start, self.index_end    # 均为行首
+        while low < high:
+            newline = content.rfind("\n", low, (low + high) // 2)
+            start = newline + 1 if newline != -1 else low
+            end = content.index("\n", start)
+            key, offset, length = content[start:end].split("\t")
+            if key == name:
+                offset = self.records_start + int(offset)
+                record = self.records[name] = json.loads(content[offset:offset + int(length)])
+                return record
+            if key < name:
+                low = end + 1
+            else:
+                high = start
+        raise KeyError(name)
+
+    def names(self):
+        for line in self.content[self.index_start:self.index_end].splitlines():
+            yield line.split("\t", 1)[0]
+
+    def definition(self, name):
+        if name not in self.definitions:
+            record = self._record(name)
+            if len(record) > 3:
+                params = [tuple(param) for param in record[3]]
+                self.definitions[name] = {'params': params, 'body': record[2], 'template': MacroTemplate(params, record[2])}
+            else:
+                self.definitions[name] = record[2]
+        return self.definitions[name]
+
+    def symbol(self, name):
+        record = self._record(name)
+        kind = _DEFINITION_KINDS[_DEFINITION_TABLES[name[0]] + "_def"]
+        symbol = {"name": name, "kind": kind, "file": self.filename, "line": record[0], "detail": record[1]}
+        if len(record) > 3:
+            symbol["params"] = [{"name": param_name, "default": default.strip() if default is not None else None} for param_name, default in record[3]]
+        return symbol
+
+
+class _LibraryView(Mapping):
+    # 索引库中以 prefix 开头的定义，按需读取
+    def __init__(self, library, prefix, get):
+        self.library = library
+        self.prefix = prefix
+        self.get_item = get
+
+    def __getitem__(self, name):
+        if not name.startswith(self.prefix):
+            raise KeyError(name)
+        return self.get_item(str(name))
+
+    def __iter__(self):
+        return (name for name in self.library.names() if name.startswith(self.prefix))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class CompileCancelled(Exception):
+    pass
+
+
+class CancelToken():
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+async def compile_async(compiler, code, token=None, on_block=None):
+    """
+    协作式异步编译：每一步之后 await 一次，让出事件循环（在 Pyodide 中即让浏览器处理输入）。
+    on_block(块名, CodeBuffer) 在每个块完成时调用；被取消时抛出 CompileCancelled。
+    """
+    steps = compiler.CompileSteps(code, token)
+    while True:
+        try:
+            event = next(steps)
+        except StopIteration as stop:
+            return stop.value
+        if event[0] == "block" and on_block is not None:
+            on_block(event[1], event[2])
+        await asyncio.sleep(0)
+
+
+class CompileStats():
+    """
+    一次编译的统计信息，只在 ROPCompiler(instrument=True) 时收集；
+    关闭时各阶段只多一次 `is not None` 判断。
+    """
+    def __init__(self):
+        self.phases_ms = {}
+        self.parses = 0
+        self.func_parses = {}       # 块名 -> FuncCompile 中的解析次数（复用缓存时为 0）
+        self.expansions = {}        # 宏名 -> 展开次数
+        self.libraries = {}         # 库文件名 -> {"ms", "cached"}
+        self.output_bytes = {}      # 块名 -> 字节数
+        self.max_intermediate_chars = 0
+
+    def count_parse(self, text):
+        self.parses += 1
+        self.track_size(text)
+
+    def track_size(self, text):
+        if len(text) > self.max_intermediate_chars:
+            self.max_intermediate_chars = len(text)
+
+    def to_dict(self):
+        return {
+            "phases_ms": self.phases_ms,
+            "parses": self.parses,
+            "func_parses": self.func_parses,
+            "expansions": self.expansions,
+            "libraries": self.libraries,
+            "output_bytes": self.output_bytes,
+            "max_intermediate_chars": self.max_intermediate_chars,
+        }
+
+
+#=======================================check=========================================
+
+_COMMENT = re.compile(r'(//|;)[^\n]*')
+_LABEL_DEF = re.compile(r'@adr\s*\.\s*([a-zA-Z_][a-zA-Z0-9_]*)')
+_MAYBE_LABEL = re.compile(r'(?<![\w#])([a-zA-Z_][a-zA-Z0-9_]*)')
+_LABEL_USE = re.compile(r'##?([a-zA-Z_][a-zA-Z0-9_]*)')
+
+def _parse_error(e):
+    # Lark 的解析错误 -> (起始偏移, 结束偏移, 简短描述)，偏移为 None 表示在文本末尾
+    if isinstance(e, UnexpectedCharacters):
+        return e.pos_in_stream, e.pos_in_stream + 1, f"Unexpected character: {e.char!r}"
+    if isinstance(e, UnexpectedToken) and e.token.type != "$END":
+        return e.token.start_pos, e.token.end_pos, f"Unexpected token: {str(e.token)!r}"
+    return None, None, "Unexpected end of input"
+
+def _error_message(e):
+    return _parse_error(e)[2] if isinstance(e, UnexpectedInput) else str(e)
+
+def _label_tokens(tree):
+    # 按源码顺序产生 ("def" | "use", 标签名)
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Token):
+            if node.type == "LABEL_CALL":
+                yield "use", node.value[1:]
+            elif node.type == "LABEL_CALL_RAW":
+                yield "use", node.value[2:]
+        elif node.data == "label_def":
+            yield "def", str(node.children[0])
+        else:
+            stack.extend(reversed(node.children))
+
+
+class Diagnostics():
+    """
+    检查结果：每条诊断为 {"message", "severity", "from", "to", "line", "column"}，
+    from/to 为源码中的字符偏移（可直接用于 CodeMirror），line/column 从 1 开始。
+    """
+    def __init__(self, source):
+        self.source = source
+        self.line_starts = [0] + [match.end() for match in re.finditer("\n", source)]
+        self.items = []
+
+    def add(self, message, start=None, end=None):
+        if start is None:
+            start = len(self.source)
+        end = min(max(end if end is not None else start + 1, start), len(self.source))
+        line = bisect.bisect_right(self.line_starts, start)
+        self.items.append({
+            "message": message,
+            "severity": "error",
+            "from": start,
+            "to": end,
+            "line": line,
+            "column": start - self.line_starts[line - 1] + 1,
+        })
+
+
+#=======================================symbol index=========================================
+
+_DEFINITION_KINDS = {"ggt_def": "gadget", "spf_def": "function", "cpf_def": "control"}
+
+def _line_comment(line):
+    # 行尾注释的内容，作为符号的说明
+    match = _COMMENT.search(line)
+    return match.group().lstrip("/;").strip() if match else ""
+
+def _definition_symbol(stmt, filename, lines):
+    # config/pre 语法树中的一条 ggt/spf/cpf 定义 -> 符号，其他语句返回 None
+    kind = _DEFINITION_KINDS.get(stmt.data)
+    if kind is None:
+        return None
+    name = stmt.children[0]
+    symbol = {"name": str(name), "kind": kind, "file": filename, "line": name.line, "detail": _line_comment(lines[name.line - 1])}
+    if kind != "gadget":
+        symbol["params"] = [
+            {"name": str(param.children[0]), "default": str(param.children[1]).strip() if len(param.children) > 1 else None}
+            for param in stmt.children[1].children if param is not None
+        ]
+    return symbol
+
+
+#=======================================gadget effects=========================================
+
+# gadget 命名规范（见 README 3.1）：$[?]效果[&额外 pop 的寄存器][?]
+#   开头的 ? 表示伴随其它效果，末尾的 ? 表示依赖 RT 返回；效果形如 目的=来源、目的-=来源，
+#   来源为空时目的寄存器的值直接取自链中紧随其后的数据，例如 $er0er4= 1234 5678
+_GADGET_NAME = re.compile(r'\$(?P<side>\?)?(?P<core>.*?)(?:&(?P<pops>[a-z0-9]+))?(?P<rt>\?)?$')
+_GADGET_EFFECT = re.compile(r'(?P<dest>[^=+\-]+?)(?P<op>[-+]?=)(?P<src>.*)')
+_REGISTER = re.compile(r'ea|sp|lr|[eqx]r\d+|r\d+')
+_POP_REGISTER = re.compile(r'ea|[eqx]\d+|r\d+')
+_REGISTER_WIDTHS = {"": 1, "e": 2, "x": 4, "q": 8}
+
+def register_bytes(register):
+    # 寄存器 -> 所占的字节寄存器集合：er2 -> {r2, r3}，xr4 -> {r4..r7}；ea/sp/lr 各自独立
+    match = re.fullmatch(r'([eqx]?)r(\d+)', register)
+    if match is None:
+        return frozenset([register])
+    start = int(match.group(2))
+    return frozenset(f"r{i}" for i in range(start, start + _REGISTER_WIDTHS[match.group(1)]))
+
+def _registers(text, pattern=_REGISTER):
+    # 连续书写的寄存器序列，例如 er0er4、eaxr4；含其它字符时返回 None
+    registers = pattern.findall(text)
+    if "".join(registers) != text:
+        return None
+    # pop 编码中省略了 r：e8 -> er8，x4 -> xr4
+    return [register if register in ("ea", "sp", "lr") or "r" in register else f"{register[0]}r{register[1:]}" for register in registers]
+
+def _byte_size(registers):
+    # pop 单个字节寄存器时 sp 同样加 2
+    return sum(max(len(register_bytes(register)), 2) for register in registers)
+
+
+class GadgetEffect():
+    """
+    由 gadget 名称解析出的效果。kind 为：
+    - "load"：目的寄存器的值取自链中的数据（loads 为这些寄存器）；
+    - "move"：目的寄存器 = 单个来源寄存器；
+    - "op"：其它运算、比较或内存读写；
+    - "routine"：名称不符合 目的=来源 的形式（如 $print、$memcpy），只记录名称。
+    clobbers 为执行后值被改变的字节寄存器（目的与额外 pop 的寄存器），cost 为在链中占用的字节数。
+    """
+    def __init__(self, name, value):
+        self.name = name
+        match = _GADGET_NAME.fullmatch(name)
+        self.side_effects = bool(match.group("side"))
+        self.rt = bool(match.group("rt"))
+        self.pops = _registers(match.group("pops") or "", _POP_REGISTER) or []
+        self.kind = "routine"
+        self.dest = []          # 被写入的寄存器
+        self.sources = []       # 被读取的寄存器
+        self.loads = []         # 值取自链中数据的寄存器
+        self.memory = False     # 是否读写内存
+        effect = _GADGET_EFFECT.fullmatch(match.group("core"))
+        if effect is not None:
+            dest, op, src = effect.group("dest", "op", "src")
+            registers = _registers(dest)
+            if registers is None and dest.startswith("[") and dest.endswith("]"):
+                self.memory = True
+                self.sources = _REGISTER.findall(dest)
+            elif registers is not None:
+                self.dest = registers
+            if registers is not None or self.memory:
+                self.sources += _REGISTER.findall(src)
+                self.memory = self.memory or "[" in src
+                if not src and op == "=" and not self.memory:
+                    self.kind = "load"
+                    self.loads = list(self.dest)
+                elif op == "=" and not self.memory and _registers(src) is not None and len(self.sources) == 1:
+                    self.kind = "move"
+                else:
+                    self.kind = "op"
+        self.clobbers = frozenset().union(*(register_bytes(register) for register in self.dest + self.pops))
+        self.cost = len(re.sub(r'\s', '', value)) // 2 + _byte_size(self.loads) + _byte_size(self.pops)
+
+    def to_dict(self):
+        return {
+            "name": self.name, "kind": self.kind, "dest": self.dest, "sources": self.sources, "loads": self.loads,
+            "pops": self.pops, "memory": self.memory, "side_effects": self.side_effects, "rt": self.rt, "cost": self.cost,
+        }
+
+
+class GadgetIndex():
+    """
+    按效果索引 gadget，查询时只在相关的索引项中查找，不逐个扫描整个库：
+    - load(["er0", "er4"])：从链中设置这些寄存器，返回按字节开销排序的 gadget 序列；
+    - move("er0", "er2")：把 er2 复制到 er0（直接或经由一个中间寄存器）。
+    两者都可以用 preserve 指定不得被改变的寄存器；默认不使用伴随其它效果（开头 ?）或依赖 RT 返回（末尾 ?）的 gadget。
+    """
+    def __init__(self, ggt):
+        self.effects = {}
+        self.by_load = {}       # 字节寄存器 -> 能从链中设置它的 gadget
+        self.by_move = {}       # (目的, 来源) -> gadget
+        self.moves_to = {}      # 目的 -> [(来源, gadget)]
+        self.by_load_set = {}   # 恰好设置这些字节寄存器、没有其它效果的 gadget，按字节开销排序
+        for name, value in ggt.items():
+            effect = self.effects[name] = GadgetEffect(name, value)
+            if effect.kind == "load":
+                loaded = frozenset().union(*(register_bytes(register) for register in effect.loads))
+                for byte in loaded:
+                    self.by_load.setdefault(byte, []).append(effect)
+                if not (effect.side_effects or effect.rt or effect.pops):
+                    self.by_load_set.setdefault(loaded, []).append(effect)
+            elif effect.kind == "move":
+                self.by_move.setdefault((effect.dest[0], effect.sources[0]), []).append(effect)
+                self.moves_to.setdefault(effect.dest[0], []).append((effect.sources[0], effect))
+        for effects in self.by_load_set.values():
+            effects.sort(key=lambda effect: (effect.cost, effect.name))
+
+    def exact_load(self, byte_registers):
+        # 恰好设置这些字节寄存器（如 {"r0", "r1", "r4", "r5"}）、没有其它效果的最便宜的 gadget，没有时为 None
+        effects = self.by_load_set.get(frozenset(byte_registers))
+        return effects[0] if effects else None
+
+    @staticmethod
+    def _usable(effect, preserved, side_effects, rt):
+        return not (effect.clobbers & preserved) and (side_effects or not effect.side_effects) and (rt or not effect.rt)
+
+    def load(self, registers, preserve=(), limit=5, max_length=4, side_effects=False, rt=False):
+        # 一致代价搜索：状态为已设置好的目标字节，每一步只从 by_load 中取能设置尚缺字节的 gadget
+        targets = frozenset().union(*(register_bytes(register) for register in registers))
+        preserved = frozenset().union(*(register_bytes(register) for register in preserve)) if preserve else frozenset()
+        if targets & preserved:
+            return []
+        results = []
+        seen = set()
+        heap = [(0, 0, (), frozenset())]
+        while heap and len(results) < limit:
+            cost, length, chain, done = heapq.heappop(heap)
+            if done == targets:
+                # 包含某个更便宜结果的全部 gadget 时，多出的 gadget 是多余的
+                if not any(set(result["gadgets"]) < set(chain) for result in results):
+                    results.append({"gadgets": list(chain), "cost": cost})
+                continue
+            if length == max_length:
+                continue
+            for byte in sorted(targets - done):
+                for effect in self.by_load.get(byte, ()):
+                    if not self._usable(effect, preserved, side_effects, rt):
+                        continue
+                    new_done = (done - effect.clobbers) | (targets & frozenset().union(*(register_bytes(register) for register in effect.loads)))
+                    # 同一组 gadget 以不同顺序执行时结果可能不同（后者可能改变前者设置的寄存器），按结果去重
+                    key = (tuple(sorted(chain + (effect.name,))), new_done)
+                    if new_done <= done or key in seen:
+                        continue
+                    seen.add(key)
+                    heapq.heappush(heap, (cost + effect.cost, length + 1, chain + (effect.name,), new_done))
+        return results
+
+    def move(self, dest, source, preserve=(), limit=5, side_effects=False, rt=False):
+        preserved = frozenset().union(*(register_bytes(register) for register in preserve)) if preserve else frozenset()
+        if register_bytes(source) & preserved:
+            preserved = preserved - register_bytes(source)
+        results = []
+        for effect in self.by_move.get((dest, source), ()):
+            if self._usable(effect, preserved, side_effects, rt):
+                results.append({"gadgets": [effect.name], "cost": effect.cost})
+        # 经由中间寄存器：source -> middle -> dest，第一步不得改变 source 以外需要保留的寄存器
+        for middle, second in self.moves_to.get(dest, ()):
+            if middle == source or not self._usable(second, preserved, side_effects, rt):
+                continue
+            for first in self.by_move.get((middle, source), ()):
+                if self._usable(first, preserved, side_effects, rt):
+                    results.append({"gadgets": [first.name, second.name], "cost": first.cost + second.cost})
+        results.sort(key=lambda result: (result["cost"], len(result["gadgets"]), result["gadgets"]))
+        return results[:limit]
+
+
+def gadget_index(filename, content):
+    # 库文件的效果索引随解析结果缓存，同一版本的库文件只建立一次
+    config = load_library(filename, content)
+    if "gadget_index" not in config:
+        config["gadget_index"] = GadgetIndex(config["ggt"])
+    return config["gadget_index"]
+
+#=======================================peephole=========================================
+
+_BARRIER = re.compile(r'@(adr|rstoffst|overwrite)\b')
+_WORD_REGISTER = re.compile(r'[eqx]r\d+')
+_HEX_BODY = re.compile(r'\s*(?:[0-9a-fA-FxX]{2}\s*)+')
+
+def _blank_comments(text):
+    # 注释替换为等长空白，位置不变
+    return _COMMENT.sub(lambda match: " " * len(match.group()), text)
+
+def _label_sensitivity(text):
+    # -> (块的字节数变化是否会移动块内 @rstoffst 之前的标签, 块内是否有 @rstoffst)
+    first = {}
+    for match in _BARRIER.finditer(_blank_comments(text)):
+        first.setdefault(match.group(1), match.start())
+    reset = first.get("rstoffst")
+    return "adr" in first and (reset is None or first["adr"] < reset), reset is not None
+
+def _offset_labels(texts, stats=None):
+    # 在加减表达式中被引用的标签（如 < #x + 0008 >）：这些标签之后的字节位置被直接引用，改写不能移动它们
+    labels = set()
+    for text in texts:
+        blanked = _blank_comments(text)
+        if "+" not in blanked and "-" not in blanked:
+            continue
+        try:
+            if stats is not None:
+                stats.count_parse(text)
+            tree = get_parser("asm").parse(text)
+        except UnexpectedInput:
+            continue    # 由汇编阶段报告错误
+        for expr in tree.find_data("expr"):
+            labels.update(label_name for kind, label_name in _label_tokens(expr) if kind == "use")
+    return labels
+
+def _ordered_bytes(register):
+    # er2 -> ["r2", "r3"]：pop 时数据按此顺序写入各字节
+    return sorted(register_bytes(register), key=lambda byte: int(byte[1:]))
+
+
+def _splice(text, edits):
+    """
+    按 edits（按起点排序、互不重叠的 (起点, 终点, 新文本, 新文本对应的调用名或 None)）替换文本。
+    text 为 _Expansion 时一并调整来源：完全落在替换区间内的调用区间被丢弃，跨越边界的截到新文本处，
+    新文本对应到替换区间起点处的来源；替换区间之后的文本保持原来的来源。
+    """
+    parts, pos = [], 0
+    for start, end, new_text, _ in edits:
+        parts.append(text[pos:start])
+        parts.append(new_text)
+        pos = end
+    parts.append(text[pos:])
+    result = "".join(parts)
+    if not isinstance(text, _Expansion):
+        return result
+
+    moved = []  # (原起点, 原终点, 新起点, 新终点)
+    delta = 0
+    for start, end, new_text, _ in edits:
+        moved.append((start, end, start + delta, start + delta + len(new_text)))
+        delta += len(new_text) - (end - start)
+    starts = [edit[0] for edit in moved]
+
+    def position(pos, inside):
+        # inside 为落在替换区间内部时的取值：新文本之前（"before"）或之后（"after"）
+        i = bisect.bisect_right(starts, pos) - 1
+        if i < 0:
+            return pos
+        start, end, new_start, new_end = moved[i]
+        if pos >= end:
+            return pos - end + new_end
+        if pos == start:
+            return new_start
+        return new_start if inside == "before" else new_end
+
+    spans = []
+    for span_start, span_end, name in text.spans:
+        i = bisect.bisect_right(starts, span_start) - 1
+        if i >= 0 and span_end <= moved[i][1] and (span_start, span_end) != moved[i][:2]:
+            continue
+        new_start, new_end = position(span_start, "after"), position(span_end, "after")
+        if new_end > new_start or span_end == span_start:
+            spans.append((new_start, new_end, name))
+    for (start, end, new_start, new_end), (_, _, _, name) in zip(moved, edits):
+        if name is not None:
+            spans.append((new_start, new_end, name))
+    spans.sort(key=lambda span: (span[0], -span[1]))
+
+    anchors = []
+    old_anchors = text.anchors
+    index = 0
+    for start, end, new_start, new_end in moved:
+        while index < len(old_anchors) and old_anchors[index][0] <= start:
+            anchor = old_anchors[index]
+            anchors.append((position(anchor[0], "before"), anchor[1], anchor[2]))
+            index += 1
+        # 替换区间内的来源丢弃，区间之后的文本从原来在 end 处的来源继续
+        last = old_anchors[index - 1] if index > 0 else None
+        while index < len(old_anchors) and old_anchors[index][0] < end:
+            last = old_anchors[index]
+            index += 1
+        if last is not None and (index == len(old_anchors) or old_anchors[index][0] != end):
+            anchors.append((new_end, last[1] + (end - last[0] if last[2] else 0), last[2]))
+    for anchor in old_anchors[index:]:
+        anchors.append((position(anchor[0], "before"), anchor[1], anchor[2]))
+    return _Expansion(result, spans, anchors)
+
+
+class Peephole():
+    """
+    展开结果上的窥孔优化（ROPCompiler(optimize=True)），按 gadget 名称中的效果（见 GadgetEffect）做两种改写：
+    - 紧接着又被下一个 load 完全覆盖的 load 连同其数据删除，如 $er0= 0001 $er0= 0002 -> $er0= 0002；
+    - 相邻的两个 load 换成库中恰好设置这些寄存器、字节数更少的一个 gadget，如 $er0= + $er4= -> $er0er4=，
+      $er0= + $er2= -> $xr0=，合并的结果还可以继续与下一个 load 合并。
+    参与改写的 load 不能有其它效果（?）、依赖 RT 返回或额外 pop（&），数据必须是紧随其后的字面字节，
+    且不在表达式、[ ] 或 < > 之中。改写会使之后的字节前移，因此块中有 @overwrite 时不做改写，
+    改写点之后（直到 @rstoffst）定义了地址标签、或后续块中有受字节计数影响的标签时也不改写；
+    在加减表达式中被引用的标签（如 < #x + 0008 >）之后直到 @rstoffst 的字节也不移动，
+    保证所有标签地址、标签加偏移指向的字节与覆写位置不变。
+    只作为数据地址使用的标签（如 *memcpy (d300, #tbl, 0010) 中的 #tbl）不固定其后的字节，
+    需要这些字节保持原样时写作 < #tbl + 0000 >。
+    """
+    def __init__(self, ggt, stats=None):
+        self.ggt = ggt
+        self.stats = stats
+        self.effects = {}
+        self.index = None
+
+    def effect(self, name):
+        if name not in self.effects:
+            value = self.ggt.get(name)
+            self.effects[name] = GadgetEffect(name, value) if value is not None and _HEX_BODY.fullmatch(value) else None
+        return self.effects[name]
+
+    @staticmethod
+    def _pure_load(effect):
+        return effect is not None and effect.kind == "load" and not (effect.side_effects or effect.rt or effect.pops)
+
+    def optimize(self, text, tail_sensitive, offset_labels=frozenset(), pinned=False):
+        """
+        优化一个块的展开结果（需由 FuncTransformer(source_map=True) 生成，以便找到各个 gadget），
+        tail_sensitive 表示之后的块中有受本块字节数影响的标签；offset_labels 为在加减表达式中被引用的标签（见 _offset_labels），
+        pinned 表示之前的块中定义了这样的标签且其后没有 @rstoffst。返回 (新文本, {"saved", "removed", "merged"})。
+        """
+        report = {"saved": 0, "removed": 0, "merged": 0}
+        spans = getattr(text, "spans", [])
+        if not spans:
+            return text, report
+        blanked = _blank_comments(text)
+        barriers = {"adr": [], "rstoffst": [], "overwrite": []}
+        pins = []       # 在加减表达式中被引用的标签的定义位置
+        for match in _BARRIER.finditer(blanked):
+            barriers[match.group(1)].append(match.start())
+            if match.group(1) == "adr":
+                label = _LABEL_DEF.match(blanked, match.start())
+                if label is not None and label.group(1) in offset_labels:
+                    pins.append(match.start())
+        if barriers["overwrite"]:
+            return text, report
+        # 各个 gadget（不含嵌套调用的 $ 区间）；没有相邻的两个 load 时不必解析
+        leaves = [span for i, span in enumerate(spans)
+                  if span[2][0] == "$" and not (i + 1 < len(spans) and spans[i + 1][0] < span[1])]
+        loads = [effect is not None and effect.kind == "load" for effect in map(self.effect, (span[2] for span in leaves))]
+        if not any(self._pure_load(self.effect(leaves[i][2])) and loads[i + 1] for i in range(len(leaves) - 1)):
+            return text, report
+        try:
+            if self.stats is not None:
+                self.stats.count_parse(text)
+            tree = get_parser("asm").parse(text)
+        except UnexpectedInput:
+            return text, report     # 由汇编阶段报告错误
+
+        # 可以移动的字节：不在表达式、[ ] 或 < > 中的字面字节
+        starts, ends, values = [], [], []
+        for node in tree.children:
+            if isinstance(node, Token) or node.data not in ("hex", "term"):
+                continue
+            for part in (node,) if node.data == "hex" else node.children:
+                if not isinstance(part, Token) and part.data == "hex":
+                    for token in part.children:
+                        starts.append(token.start_pos)
+                        ends.append(token.end_pos)
+                        values.append(token.value)
+
+        def plain(start, end):
+            # [start, end) 中除空白外恰好是连续的可移动字节时，返回其下标区间
+            first = bisect.bisect_left(starts, start)
+            last = bisect.bisect_left(starts, end)
+            if last > first and ends[last - 1] > end:
                 return None
-                
-            def block(self, items): 
-                name = items[0]
-                body = items[1]
-                self.blocks[name] = body
+            if "".join(values[first:last]) != "".join(blanked[start:end].split()):
                 return None
-            
-            def brace_block(self, items): return "".join(items)
-            def brace_block_nested(self, token): return f"{{ {token[0]} }}"
-            def params(self, items): return items
-            def param(self, items): return (items[0], items[1]) if len(items) > 1 else (items[0], None)
-            
-            def GGT_NAME(self, token): return token.value
-            def SPF_NAME(self, token): return token.value
-            def CPF_NAME(self, token): return token.value
-            def CNAME(self, token): return token.value
-            def ANY_STRING(self, token): return token.value
-            def FILE_NAME(self, token): return token.value
-            def ANY_CHAR(self, token): return token.value
-            def BLOCK_CONTENT(self, token): return token.value
-
-
-
-            def pre_program(self, items):
-                return {
-                    "ggt": self.ggt,
-                    "spf": self.spf,
-                    "cpf": self.cpf,
-                    "blocks": self.blocks
-                }
-            # --- 辅助方法和基本规则 ---
-
-            def _load_module(self, filename):
-                file_content = None
-                try:
-                    file_content = libraries_dict[filename]
-                    config = cast(dict,config_parser.parse(file_content))
-                    self.ggt.update(config["ggt"])
-                    self.spf.update(config["spf"])
-                    self.cpf.update(config["cpf"])
-                    print(f"Successfully loaded module '{filename}'")
-                except Exception as e:
-                    print(f"Error loading module '{filename}': {e}")
-
-
-
-
-
-
-        #=======================================preprocess end=========================================
-            
-
-        func_grammar = r"""
-            ?start: func_program
-
-            func_program: (HEX_DATA | ggt_call | spf_call | cpf_call |ANY_CHAR)*
-
-            ggt_call: GGT_NAME
-            spf_call: SPF_NAME "(" params ")"
-            cpf_call: CPF_NAME "(" params ")" "{" brace_block "}"
+            return first, last
+
+        def safe(pos):
+            # 从 pos 开始的字节前移后，所有标签地址都不变
+            reset = bisect.bisect_right(barriers["rstoffst"], pos)
+            limit = barriers["rstoffst"][reset] if reset < len(barriers["rstoffst"]) else None
+            adr = bisect.bisect_right(barriers["adr"], pos)
+            if adr < len(barriers["adr"]) and (limit is None or barriers["adr"][adr] < limit):
+                return False
+            # 之前（同一段内）有在加减表达式中被引用的标签时，标签加偏移指向的字节不能移动
+            segment = barriers["rstoffst"][reset - 1] if reset > 0 else -1
+            if (reset == 0 and pinned) or bisect.bisect_right(pins, segment) < bisect.bisect_left(pins, pos):
+                return False
+            return limit is not None or not tail_sensitive
+
+        # 各个 gadget 及其数据，None 表示无法改写的 gadget
+        elements = []
+        for i, (start, end, name) in enumerate(leaves):
+            effect = self.effect(name)
+            if effect is None or plain(start, end) is None:
+                elements.append(None)
+                continue
+            element = {"start": start, "end": end, "effect": effect, "data": None, "merged": False}
+            if self._pure_load(effect):
+                size = _byte_size(effect.loads)
+                first = bisect.bisect_left(starts, end)
+                next_start = leaves[i + 1][0] if i + 1 < len(leaves) else len(text)
+                if first + size <= len(starts) and ends[first + size - 1] <= next_start and plain(end, ends[first + size - 1]):
+                    element["data"] = values[first:first + size]
+                    element["end"] = ends[first + size - 1]
+            elements.append(element)
+
+        removed = []    # 删除的区间
+        def blank(start, end):
+            # [start, end) 中除已删除的区间外只有空白
+            for removed_start, removed_end in sorted(removed):
+                if removed_end <= start or removed_start >= end:
+                    continue
+                if blanked[start:removed_start].strip():
+                    return False
+                start = max(start, removed_end)
+            return start >= end or not blanked[start:end].strip()
+
+        out = []
+        for element in elements:
+            while element is not None and out and out[-1] is not None and out[-1]["data"] is not None:
+                prev = out[-1]
+                if not (blank(prev["end"], element["start"]) and safe(prev["start"])):
+                    break
+                effect = element["effect"]
+                if effect.kind == "load" and not effect.side_effects and prev["effect"].clobbers <= effect.clobbers:
+                    out.pop()
+                    removed.append((prev["start"], element["start"]))
+                    report["removed"] += 1
+                    report["saved"] += prev["effect"].cost
+                    continue
+                merged = self._merge(prev, element) if element["data"] is not None else None
+                if merged is None:
+                    break
+                out.pop()
+                report["merged"] += 1
+                report["saved"] += prev["effect"].cost + effect.cost - merged["effect"].cost
+                element = merged
+            out.append(element)
+
+        edits = [(start, end, "", None) for start, end in removed]
+        for element in out:
+            if element is not None and element["merged"]:
+                effect = element["effect"]
+                body = " ".join(self.ggt[effect.name].split())
+                edits.append((element["start"], element["end"], f"{body} {' '.join(element['data'])}", effect.name))
+        if not edits:
+            return text, report
+        edits.sort(key=lambda edit: (edit[0], -edit[1]))
+        nested = []
+        for edit in edits:
+            if nested and edit[0] < nested[-1][1]:
+                continue    # 包含在之前的删除区间中
+            nested.append(edit)
+        return _splice(text, nested), report
+
+    def _merge(self, prev, element):
+        loads = prev["effect"].loads + element["effect"].loads
+        if not all(_WORD_REGISTER.fullmatch(register) for register in loads):
+            return None
+        data = {}
+        for register, byte in zip((byte for register in loads for byte in _ordered_bytes(register)), prev["data"] + element["data"]):
+            if register in data:
+                return None     # 部分重叠的两个 load
+            data[register] = byte
+        if self.index is None:
+            self.index = GadgetIndex({name: value for name, value in self.ggt.items() if name[:1] == "$"})
+        combined = self.index.exact_load(data)
+        if combined is None or combined.cost >= prev["effect"].cost + element["effect"].cost or not _HEX_BODY.fullmatch(self.ggt[combined.name]):
+            return None
+        return {
+            "start": prev["start"], "end": element["end"], "effect": combined, "merged": True,
+            "data": [data[byte] for register in combined.loads for byte in _ordered_bytes(register)],
+        }
+
+#=======================================parallel compilation=========================================
+
+# 工作进程的入口（见 ROPCompiler._ParallelCompile）。异常以文本返回（部分解析异常无法跨进程传递），由主进程按块的顺序抛出，
+# 与串行编译报告同一个错误
+
+def _assemble_blocks(ggt, spf, cpf, max_depth, max_size, blocks):
+    # 标签收集阶段：逐块展开宏，并从初始状态汇编，返回可由 AsmTransformer.relocate 接续的结果
+    func_transformer = FuncTransformer(ggt, spf, cpf, max_depth, max_size)
+    results = []
+    for block_name, block in blocks:
+        try:
+            expanded = func_transformer.expand_block(block_name, block)
+        except Exception as e:
+            # 串行编译会在这里停止，之后的块不再有影响
+            results.append({"expand_error": str(e)})
+            break
+        assembler = AsmTransformer()
+        try:
+            buffer = assembler.assemble(expanded)
+        except Exception as e:
+            # 后面的块仍需展开：串行编译先展开全部块，展开错误优先于汇编错误
+            results.append({"asm_error": str(e)})
+            continue
+        summary = assembler.summary()
+        results.append({
+            "asm": buffer,
+            "summary": summary,
+            # 依赖进入时的占位符时，主进程可能需要在正确的状态下重新汇编
+            "expanded": expanded if summary["placeholder_used"] else None,
+        })
+    return results
+
+def _split_blocks(items, count, size):
+    # 按 size(item) 把有序的 items 切成至多 count 段连续的区间，各段大小尽量接近
+    total = sum(size(item) for item in items)
+    chunks, chunk, filled = [], [], 0
+    for item in items:
+        chunk.append(item)
+        filled += size(item)
+        if filled * count >= total * (len(chunks) + 1) and len(chunks) < count - 1:
+            chunks.append(chunk)
+            chunk = []
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+#=======================================disk cache=========================================
+
+def _digest(value):
+    # 可以 JSON 序列化的值 -> 内容哈希
+    return hashlib.sha1(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def compiler_digest():
+    # 编译器源码的哈希，作为磁盘缓存键中的编译器版本：修改编译器之后，旧的缓存条目不再命中
+    with open(__file__, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _definition_digest(definition):
+    # 定义表中的一项（gadget 为文本，宏为 {"params", "body", ...}）-> 哈希，未定义时为 None
+    if definition is None:
+        return None
+    if isinstance(definition, str):
+        return _digest(definition)
+    return _digest([definition["params"], definition["body"]])
+
+
+class CompileCache():
+    """
+    批量编译用的磁盘缓存（ROPCompiler(cache=CompileCache(目录))），条目按内容寻址：
+    - programs：键为编译器版本、编译选项、源码及其导入的每个库文件的内容哈希，值为各块的最终字节码、标签表和优化统计，
+      命中时不再解析源码；源码导入了哪些库文件记录在以源码为键的 manifests 中；
+    - blocks：键为编译器版本、展开选项、块名与块源码，值为展开结果及其引用到的定义的哈希。
+      修改了某个库文件时导入它的程序不再命中，其中引用到的定义都没有变化的块仍然复用展开结果。
+    条目先写入临时文件再原子替换，多个进程可以同时读写同一个目录，读到不完整或已被删除的条目时视为未命中。
+    总大小超过 max_bytes 时按最近使用时间删除最旧的条目（命中时更新文件的修改时间）。
+    """
+    KINDS = ("programs", "manifests", "blocks")
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = {"programs": 0, "blocks": 0}     # 实际复用的程序与块数
+        self._library_digests = {}  # 文件名 -> (内容, 哈希)，库文件未变化时不再重复计算
+        self._written = 0
+        for kind in self.KINDS:
+            os.makedirs(os.path.join(directory, kind), exist_ok=True)
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, kind, key[:2], f"{key}.json")
+
+    def get(self, kind, key):
+        path = self._path(kind, key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def put(self, kind, key, value):
+        import tempfile
+        path = self._path(kind, key)
+        data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError:
+            return      # 缓存写入失败不影响编译结果
+        self._written += len(data)
+        if self._written > self.max_bytes // 16:
+            self.prune()
+
+    def prune(self):
+        # 按修改时间从新到旧保留条目，直到总大小达到 max_bytes；其余条目与遗留的临时文件（超过一小时）删除
+        entries = []
+        now = time.time()
+        for kind in self.KINDS:
+            for directory, _, filenames in os.walk(os.path.join(self.directory, kind)):
+                for filename in filenames:
+                    path = os.path.join(directory, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if filename.endswith(".json"):
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                    elif now - stat.st_mtime > 3600:
+                        self._remove(path)
+        entries.sort(reverse=True)
+        total = 0
+        for _, size, path in entries:
+            total += size
+            if total > self.max_bytes:
+                self._remove(path)
+        self._written = 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass    # 已被其他进程删除
+
+    def library_digest(self, libraries_dict, filename):
+        if filename not in libraries_dict:
+            return None
+        content = libraries_dict[filename]
+        cached = self._library_digests.get(filename)
+        if cached is None or cached[0] is not content:
+            cached = self._library_digests[filename] = (content, library_hash(content))
+        return cached[1]
+
+    def program_key(self, code, libraries_dict, options):
+        # 源码此前编译过时返回 programs 中的键，否则为 None
+        manifest = self.get("manifests", _digest([compiler_digest(), code]))
+        if manifest is None:
+            return None
+        return self._program_key(code, libraries_dict, options, manifest["imports"])
+
+    def store_program(self, code, libraries_dict, options, imports, value):
+        self.put("manifests", _digest([compiler_digest(), code]), {"imports": imports})
+        self.put("programs", self._program_key(code, libraries_dict, options, imports), value)
+
+    def _program_key(self, code, libraries_dict, options, imports):
+        libraries = [[filename, self.library_digest(libraries_dict, filename)] for filename in imports]
+        return _digest([compiler_digest(), options, code, libraries])
+
+
+class ROPCompiler():
+    """
+    incremental=True 时，同一个实例在多次编译之间为每个块缓存展开结果、汇编结果和最终字节码：
+    - 展开结果在块源码与其引用到的全部定义（含库文件中的定义）都未变化时复用；
+    - 汇编结果在展开文本与进入该块时的偏移量/字节计数/占位符都未变化时复用；
+    - 最终字节码在汇编结果被复用且其引用到的标签地址都未变化时复用。
 
+    workers > 1 时 Compile 在 CPython 下用进程池并行处理各块（见 _ParallelCompile），输出与串行编译相同；
+    在 Pyodide 中、增量模式、instrument=True、source_map=True 或 optimize=True 时仍按串行编译。进程池在实例内复用，用完后调用 close()。
 
-            brace_block: (brace_block_nested | ANY_CHAR | ggt_call | spf_call | cpf_call)+
-            brace_block_nested: "{" brace_block "}"
-            param: ANY_STRING
-            params: [param ("," param)*]
+    source_map=True 时编译后 source_maps 为 {块名: SourceMap}，记录每段字节来自源码的哪一行、经过哪些宏和 gadget 展开，
+    SizeReport() 据此按块、gadget 和宏汇总字节数。
 
-            COMMENT: /(\/\/|;)[^\n]*/
-            
-            //终结符
-            HEX_DATA: /[0-9a-fA-FxX]{2}/
-            GGT_NAME: /\$[^ \t\r\n(]+/
-            SPF_NAME: /\*[^ \t\r\n(]+/
-            CPF_NAME: /![^ \t\r\n(]+/
-            ANY_STRING: /[^,)]+/
-            ANY_CHAR: /[^\$\*!\{\}]+/
+    optimize=True 时在展开与汇编之间对每个块做窥孔优化（见 Peephole），optimized 为 {块名: {"saved", "removed", "merged"}}。
+    优化不改变任何标签地址与覆写位置，但输出的字节码与不优化时不同；优化结果不参与增量缓存，每次编译都重新计算。
 
-            %ignore COMMENT
-            // --- 导入和忽略 ---
-            %import common.CNAME 
-            %import common.NEWLINE 
-            %import common.WS
-            %ignore WS          // 忽略空格
-            %ignore NEWLINE     // 忽略空行
+    cache 为 CompileCache 时 Compile 先查磁盘缓存，源码、导入的库文件与编译选项都未变化时直接返回上次的字节码（cache_hit 为真），
+    否则照常编译，各块的展开结果也按块源码及其依赖的定义从缓存中复用。source_map=True 时不使用程序级缓存。
+    """
+    def __init__(self, libraries_dict=None, max_expansion_depth=MAX_EXPANSION_DEPTH, max_expansion_size=MAX_EXPANSION_SIZE, incremental=False, instrument=False, workers=None, source_map=False, optimize=False, cache=None):
+        self.libraries_dict = libraries_dict if libraries_dict is not None else {}
+        self.max_expansion_depth = max_expansion_depth
+        self.max_expansion_size = max_expansion_size
+        self.incremental = incremental
+        self.instrument = instrument
+        self.stats = None
+        self.ggt = {}
+        self.spf = {}
+        self.cpf = {}
+        self.blocks = {}
+        self.adr_map = {}
+        self._block_cache = {}
+        self._check_cache = {}
+        self._generation = 0
+        self.workers = workers
+        self._pool = None
+        self.source_map = source_map
+        self.source_maps = {}
+        self.block_sources = {}
+        self.block_lines = {}
+        self.imports = []
+        self.definition_lines = {}
+        self.optimize = optimize
+        self.optimized = {}
+        self.cache = cache
+        self.cache_hit = False
+        self.import_requests = []
+
+    def PreCompile(self,code):
+        if self.stats is not None:
+            self.stats.count_parse(code)
+        tree = parse_definitions("pre", code)
+        pre_result= cast(Dict[str, Any], _transform(PreTransformer(self.libraries_dict, self.stats), tree))
+        self.ggt = pre_result['ggt']
+        self.spf = pre_result['spf']
+        self.cpf = pre_result['cpf']
+        self.blocks = pre_result['blocks']
+        self.block_lines = pre_result['block_lines']
+        self.imports = pre_result['imports']
+        self.import_requests = pre_result['import_requests']
+        self.definition_lines = pre_result['definition_lines']
+        # FuncCompile 会把 blocks 替换为展开结果，SourceMap 还需要块的源码
+        self.block_sources = dict(self.blocks) if self.source_map else {}
+        
+    # 以下几个阶段都实现为逐块推进的生成器，每处理完一个块 yield 一次，
+    # 同步编译直接跑完，CompileSteps 则在块与块之间交还控制权
+    def FuncCompile(self):
+        for _ in self._FuncSteps(): pass
+
+    def OptimizeCompile(self):
+        for _ in self._OptimizeSteps(): pass
+
+    def AdrCompile(self):
+        for _ in self._AdrSteps(): pass
+
+    def Pass2Compile(self):
+        for _ in self._Pass2Steps(): pass
+
+    def _FuncSteps(self):
+        # 窥孔优化需要展开结果中各个 gadget 的位置
+        spans = self.source_map or self.optimize
+        func_transformer = FuncTransformer(self.ggt, self.spf, self.cpf, self.max_expansion_depth, self.max_expansion_size, self.stats, spans)
+        block_cache = {}
+        for block_name, block in self.blocks.items():
+            entry = self._block_cache.get(block_name)
+            if (entry is not None and entry["source"] == block and entry["source_map"] == spans
+                    and self._deps_unchanged(entry["deps"])):
+                self.blocks[block_name] = entry["expanded"]
+            else:
+                cached = self._cached_expansion(block_name, block, spans) if self.cache is not None else None
+                if cached is not None:
+                    self.blocks[block_name], deps = cached
+                else:
+                    parses = self.stats.parses if self.stats is not None else 0
+                    self.blocks[block_name] = func_transformer.expand_block(block_name, block)
+                    if self.stats is not None:
+                        self.stats.func_parses[block_name] = self.stats.parses - parses
+                    deps = func_transformer.used
+                    if self.cache is not None:
+                        self._store_expansion(block_name, block, spans, self.blocks[block_name], deps)
+                entry = dict(entry or {}, source=block, source_map=spans, deps=deps, expanded=self.blocks[block_name])
+            block_cache[block_name] = entry
+            yield block_name
+        if self.incremental:
+            self._block_cache = block_cache
+
+    def _OptimizeSteps(self):
+        # 从后往前确定每个块之后是否有受其字节数影响的标签：块内第一个 @adr 在 @rstoffst 之前，
+        # 或块内没有 @rstoffst 而之后的块受影响
+        self.optimized = {}
+        if not self.optimize:
+            return
+        peephole = Peephole(self.ggt, self.stats)
+        tail_sensitive = {}
+        sensitive = False
+        for block_name in reversed(list(self.blocks)):
+            tail_sensitive[block_name] = sensitive
+            moves_labels, resets = _label_sensitivity(self.blocks[block_name])
+            sensitive = moves_labels or (sensitive and not resets)
+        # 在加减表达式中被引用的标签之后、直到 @rstoffst 的字节（可能跨块）都不移动
+        offset_labels = _offset_labels(self.blocks.values(), self.stats)
+        pinned = False
+        for block_name, block in self.blocks.items():
+            self.blocks[block_name], self.optimized[block_name] = peephole.optimize(block, tail_sensitive[block_name], offset_labels, pinned)
+            blanked = _blank_comments(block)
+            for match in _BARRIER.finditer(blanked):
+                if match.group(1) == "rstoffst":
+                    pinned = False
+                elif match.group(1) == "adr":
+                    label = _LABEL_DEF.match(blanked, match.start())
+                    pinned = pinned or (label is not None and label.group(1) in offset_labels)
+            yield block_name
+
+    def _AdrSteps(self):
+        # 单遍汇编所有块，同时收集地址标签；标签表与偏移量跨块累积
+        assembler = AsmTransformer(self.stats, self.source_map)
+        self.source_maps = {}
+        for block_name, block in self.blocks.items():
+            entry = self._block_cache.get(block_name, {})
+            state = assembler.state()
+            if entry.get("asm_source") == block and entry["asm_state"] == state and (entry["asm_map"] is not None or not self.source_map):
+                assembler.restore(entry["asm_exit_state"], entry["labels"])
+                self.blocks[block_name] = entry["asm"].copy()
+                source_map = entry["asm_map"]
+            else:
+                self.blocks[block_name] = assembler.assemble(block)
+                source_map = None
+                if self.source_map:
+                    source_map = SourceMap(self.block_sources[block_name], block, assembler.origins, len(self.blocks[block_name]))
+                if self.incremental:
+                    entry.update(asm_source=block, asm_state=state, asm_exit_state=assembler.state(),
+                                 labels=assembler.block_labels, asm=self.blocks[block_name].copy(), asm_map=source_map)
+            if self.source_map:
+                source_map.line = self.block_lines[block_name]
+                self.source_maps[block_name] = source_map
+            yield block_name
+        self.adr_map = assembler.label_map
+
+    def _Pass2Steps(self):
+        # 标签全部确定后统一回填，并应用覆写
+        for block_name, block in self.blocks.items():
+            entry = self._block_cache.get(block_name, {})
+            label_values = {label_name: self.adr_map.get(label_name) for label_name in block.label_names()}
+            if "output" in entry and entry["output_asm"] is entry["asm"] and entry["label_values"] == label_values:
+                self.blocks[block_name] = entry["output"].copy()
+            else:
+                block.resolve(self.adr_map)
+                if self.incremental:
+                    entry.update(output=block.copy(), output_asm=entry["asm"], label_values=label_values)
+            yield block_name
+
+
+    def Compile (self, code):
+        self._generation += 1
+        self.stats = CompileStats() if self.instrument else None
+        if self.stats is None:
+            if self._load_program(code):
+                return self.blocks
+            self.PreCompile(code)
+            if self._parallel():
+                self._ParallelCompile()
+            else:
+                self.FuncCompile()
+                self.OptimizeCompile()
+                self.AdrCompile()
+            self.Pass2Compile()
+            self._store_program(code)
+            return self.blocks
+
+        for phase in self._phases():
+            start = time.perf_counter()
+            getattr(self, phase)(*((code,) if phase == "PreCompile" else ()))
+            self.stats.phases_ms[phase] = (time.perf_counter() - start) * 1000
+        for block_name, block in self.blocks.items():
+            self.stats.func_parses.setdefault(block_name, 0)
+            self.stats.output_bytes[block_name] = len(block)
+        return self.blocks
+
+    # 磁盘缓存（见 CompileCache）：程序的最终结果不含 SourceMap，因此 source_map=True 时只复用展开结果
+    def _cache_options(self):
+        return [self.max_expansion_depth, self.max_expansion_size, self.optimize]
+
+    def _load_program(self, code):
+        self.cache_hit = False
+        if self.cache is None or self.source_map:
+            return False
+        key = self.cache.program_key(code, self.libraries_dict, self._cache_options())
+        entry = self.cache.get("programs", key) if key is not None else None
+        if entry is None:
+            return False
+        self.blocks = {}
+        for block_name, (data, mask) in entry["blocks"].items():
+            block = self.blocks[block_name] = CodeBuffer()
+            block.data = bytearray.fromhex(data)
+            block.mask = bytearray.fromhex(mask)
+        self.adr_map = {label_name: tuple(adr) for label_name, adr in entry["labels"].items()}
+        self.optimized = entry["optimized"]
+        self.source_maps = {}
+        self.cache_hit = True
+        self.cache.hits["programs"] += 1
+        return True
+
+    def _store_program(self, code):
+        if self.cache is None or self.source_map:
+            return
+        self.cache.store_program(code, self.libraries_dict, self._cache_options(), self.import_requests, {
+            "blocks": {block_name: [block.data.hex(), block.mask.hex()] for block_name, block in self.blocks.items()},
+            "labels": {label_name: list(adr) for label_name, adr in self.adr_map.items()},
+            "optimized": self.optimized,
+        })
+
+    def _expansion_key(self, block_name, block, spans):
+        return _digest([compiler_digest(), spans, self.max_expansion_depth, self.max_expansion_size, block_name, block])
+
+    def _cached_expansion(self, block_name, block, spans):
+        # 块源码相同、引用到的定义都未变化时返回 (展开结果, 依赖)
+        entry = self.cache.get("blocks", self._expansion_key(block_name, block, spans))
+        if entry is None:
+            return None
+        tables = {"$": self.ggt, "*": self.spf, "!": self.cpf}
+        deps = {name: tables[name[0]].get(name) for name in entry["deps"]}
+        if any(_definition_digest(definition) != entry["deps"][name] for name, definition in deps.items()):
+            return None
+        self.cache.hits["blocks"] += 1
+        if entry["spans"] is None:
+            return entry["text"], deps
+        spans = [tuple(span) for span in entry["spans"]]
+        anchors = [tuple(anchor) for anchor in entry["anchors"]]
+        return _Expansion(entry["text"], spans, anchors), deps
+
+    def _store_expansion(self, block_name, block, spans, expanded, deps):
+        self.cache.put("blocks", self._expansion_key(block_name, block, spans), {
+            "deps": {name: _definition_digest(definition) for name, definition in deps.items()},
+            "text": str(expanded),
+            "spans": getattr(expanded, "spans", None),
+            "anchors": getattr(expanded, "anchors", None),
+        })
+
+    def _phases(self):
+        # OptimizeCompile 只在 optimize=True 时出现在统计与进度事件中
+        return ("PreCompile", "FuncCompile", *(("OptimizeCompile",) if self.optimize else ()), "AdrCompile", "Pass2Compile")
+
+    def SizeReport(self):
         """
-
-        class FuncTransformer(Transformer):
-            def __init__(self, ggt, spf, cpf):
-                self.ggt = ggt
-                self.spf = spf
-                self.cpf = cpf
-                super().__init__()
-            
-            def ggt_call(self, token):
-                name = token[0]
-                self.ggt
-                try:
-                    ggt_value = self.ggt[name]
-                except KeyError:
-                    raise Exception(f"Undefined function: {name}")
-                return ggt_value
-
-            def spf_call(self, items):
-                name = items[0]
-                params = items[1]
-                params = [item for item in params if item is not None]
+        按块、gadget 和宏汇总上一次编译的字节数（见 size_report），需要 source_map=True。
+        另有 definitions：{名称: {"file", "line"}}，为各 gadget 和宏的定义位置（源码中的定义 file 为 None）。
+        """
+        report = size_report(self.source_maps)
+        report["definitions"] = {name: self._definition_location(name) for name in (*report["gadgets"], *report["macros"])}
+        return report
+
+    def _definition_location(self, name):
+        # 源码中的定义优先，其次是后导入的库文件；找不到时为 None
+        if name in self.definition_lines:
+            return {"file": None, "line": self.definition_lines[name]}
+        for filename in reversed(self.imports):
+            try:
+                symbols = load_library(filename, self.libraries_dict[filename])["symbols"]
+            except Exception:
+                continue
+            if name in symbols:
+                return {"file": filename, "line": symbols[name]["line"]}
+        return None
+
+    def _parallel(self):
+        # 进程池只在 CPython 下可用；增量模式下各块的结果依赖实例内的缓存，仍按串行处理
+        return (self.workers is not None and self.workers > 1 and js is None and not self.incremental and not self.source_map
+                and not self.optimize and len(self.blocks) > 1)
+
+    def _get_pool(self):
+        if self._pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            # 先在主进程中构建解析器，以 fork 方式启动的工作进程可以直接继承
+            get_parser("func")
+            get_parser("asm")
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _ParallelCompile(self):
+        """
+        FuncCompile 与 AdrCompile 的并行版本（之后仍由 Pass2Compile 回填）：工作进程展开各块并从初始状态汇编，
+        主进程按块的顺序用 AsmTransformer.relocate 接续汇编状态、登记标签，
+        依赖进入时占位符（@x=）的块在正确的状态下重新汇编。
+        块按源码长度切成与进程数相同的连续区间，每段只传递一次定义表。
+        回填留在主进程中：它只是逐个写入回填项，比把字节码传给工作进程再传回更快。
+        """
+        pool = self._get_pool()
+        items = list(self.blocks.items())
+        futures = [
+            pool.submit(_assemble_blocks, self.ggt, self.spf, self.cpf, self.max_expansion_depth, self.max_expansion_size, chunk)
+            for chunk in _split_blocks(items, self.workers, lambda item: len(item[1]))
+        ]
+        results = [result for future in futures for result in future.result()]
+        for result in results:
+            if "expand_error" in result:
+                raise Exception(result["expand_error"])
+
+        assembler = AsmTransformer()
+        for (block_name, _), result in zip(items, results):
+            if "asm_error" in result:
+                raise Exception(result["asm_error"])
+            if result["summary"]["placeholder_used"] and assembler.x_placeholder != "0":
+                self.blocks[block_name] = assembler.assemble(result["expanded"])
+            else:
+                assembler.relocate(result["summary"])
+                self.blocks[block_name] = result["asm"]
+        self.adr_map = assembler.label_map
+
+    def CompileSteps(self, code, token=None):
+        """
+        可中断的逐步编译：在阶段之间和块之间 yield 进度事件
+            ("phase", 阶段名)            进入一个阶段
+            ("progress", 阶段名, 块名)   该阶段处理完一个块
+            ("block", 块名, CodeBuffer)  该块的字节码已完成（部分结果）
+        生成器结束时返回全部块。token 为任何带 cancelled 属性的对象（如 CancelToken，
+        或 JS 传来的 {cancelled: false}），恢复执行时若 token.cancelled 为真、
+        或同一实例上已经开始了更新的编译，则抛出 CompileCancelled。
+        """
+        self._generation += 1
+        generation = self._generation
+        self.stats = None
+
+        def check():
+            if generation != self._generation or (token is not None and token.cancelled):
+                raise CompileCancelled()
+
+        yield ("phase", "PreCompile")
+        check()
+        self.PreCompile(code)
+        steps = {"FuncCompile": self._FuncSteps, "OptimizeCompile": self._OptimizeSteps, "AdrCompile": self._AdrSteps, "Pass2Compile": self._Pass2Steps}
+        for phase in self._phases()[1:]:
+            yield ("phase", phase)
+            check()
+            for block_name in steps[phase]():
+                if phase == "Pass2Compile":
+                    yield ("block", block_name, self.blocks[block_name])
+                else:
+                    yield ("progress", phase, block_name)
+                check()
+        return self.blocks
+
+    def CompileStream(self, code):
+        """
+        流式编译：按顺序 yield (块名, CodeBuffer)，块交给调用方之后编译器不再引用它。
+        第一遍逐块展开、汇编，只保留标签表和每个块进入时的汇编状态；第二遍从记录的状态重新展开、汇编每个块并回填，
+        因此内存峰值为单个块的各种中间形式加上标签表，代价是每个块要处理两次。
+        报告的错误与 Compile 相同，但出错之前的块可能已经交给了调用方。不使用增量缓存，也不生成 instrument 统计和 source map，不做窥孔优化。
+        """
+        self.stats = None
+        self.PreCompile(code)
+        sources, self.blocks = self.blocks, {}
+        func_transformer = FuncTransformer(self.ggt, self.spf, self.cpf, self.max_expansion_depth, self.max_expansion_size)
+
+        # 第一遍：收集标签。与 Compile 一致，展开错误优先于汇编错误，汇编出错后仍继续展开其余的块
+        assembler = AsmTransformer()
+        entry_states = []
+        error = None
+        for block_name, block in sources.items():
+            expanded = func_transformer.expand_block(block_name, block)
+            if error is None:
+                entry_states.append(assembler.state())
                 try:
-                    def_params = self.spf[name]['params']
-                    def_params = [item for item in def_params if item is not None]
-                    def_body = self.spf[name]['body']
-                except KeyError:
-                    raise Exception(f"Undefined function: {name}")
-                
-                #将形参映射到实参
-                param_dict = {}
-                for i in range(len(def_params)):
-                    try:
-                        param_dict[def_params[i][0]] = params[i]
-                    except IndexError:
-                        if def_params[i][1] is not None:
-                            param_dict[def_params[i][0]] = def_params[i][1]
-                        else:
-                            raise Exception(f"Not enough parameters for function: {name}")
-
-                #检测模板中%_xxx_%，并将实参替换到模板中  
-                for name in param_dict:
-                    pattern = r'%\_' + re.escape(name) + r'\_%'
-                    def_body = re.sub(pattern, param_dict[name], def_body)
-
-
-                #检测模板中&_xxx_&，并生成唯一标识符
-                uuid_map = {}
-                pattern = r'&_(\S+)_&'
-                def replacer(match):
-                    matched_content = match.group(1)
-                    if matched_content in uuid_map:
-                        return uuid_map[matched_content]
-                    else:
-                        unique_id = str(uuid.uuid4())[:8]
-                        new_value = f"{matched_content}_{unique_id}"
-                        uuid_map[matched_content] = new_value
-                        return new_value
-                    
-                def_body = re.sub(pattern, replacer, def_body)
-
-                return def_body
-
-
-
-
-            def cpf_call(self, items):
-                name = items[0]
-                params = items[1]
-                params = [item for item in params if item is not None]
-                body = items[2]
+                    assembler.assemble(expanded)
+                except Exception as e:
+                    error = e
+            del expanded
+        if error is not None:
+            raise error
+        self.adr_map = assembler.label_map
+
+        # 第二遍：输出
+        for (block_name, block), state in zip(sources.items(), entry_states):
+            emitter = AsmTransformer()
+            emitter.restore(state, [])
+            buffer = emitter.assemble(func_transformer.expand_block(block_name, block))
+            buffer.resolve(self.adr_map)
+            yield block_name, buffer
+            del buffer
+
+    def Check(self, code):
+        """
+        只检查、不生成字节码：预处理、宏展开，并收集各块的地址标签定义与引用，
+        尽可能一次报告全部错误（未定义的宏、参数不足、重复或未定义的标签、语法错误等）。
+        标签地址和表达式的值不会计算，因此越界之类只有编译时才能发现的错误不在检查范围内。
+        某个块出错时其他块照常检查；只有可能由该块中展开失败的宏定义的标签不报告为未定义。
+        incremental=True 时按块缓存检查结果，块源码与其引用的定义都未变化时直接复用。
+        返回按位置排序的诊断列表，格式见 Diagnostics。
+        """
+        diagnostics = Diagnostics(code)
+        try:
+            tree = parse_definitions("pre", code)
+        except UnexpectedInput as e:
+            start, end, message = _parse_error(e)
+            diagnostics.add(message, start, end)
+            return diagnostics.items
+
+        origins = {}    # 块名 -> (块名 Token, 块内容 Token)，同名块以最后一个为准，与编译一致
+        for stmt in tree.children:
+            if stmt.data == "import_stmt":
+                token = stmt.children[0]
+                filename = str(token)
+                if filename not in self.libraries_dict:
+                    diagnostics.add(f"Library not found: {filename}", token.start_pos, token.end_pos)
+                    continue
                 try:
-                    def_params = self.cpf[name]['params']
-                    def_params = [item for item in def_params if item is not None]
-                    def_body = self.cpf[name]['body']
-                except KeyError:
-                    raise Exception(f"Undefined function: {name}")
-                
-                #将形参映射到实参
-                param_dict = {}
-                for i in range(len(def_params)):
-                    try:
-                        param_dict[def_params[i][0]] = params[i]
-                    except IndexError:
-                        if def_params[i][1] is not None:
-                            param_dict[def_params[i][0]] = def_params[i][1]
-                        else:
-                            raise Exception(f"Not enough parameters for function: {name}")
-
-                #检测模板中%_xxx_%，并将实参替换到模板中  
-                for name in param_dict:
-                    pattern = r'%\_' + re.escape(name) + r'\_%'
-                    def_body = re.sub(pattern, param_dict[name], def_body)
-
-
-                #检测模板中&_xxx_&，并生成唯一标识符
-                uuid_map = {}
-                pattern = r'&_(\S+)_&'
-                def replacer(match):
-                    matched_content = match.group(1)
-                    if matched_content in uuid_map:
-                        return uuid_map[matched_content]
-                    else:
-                        unique_id = str(uuid.uuid4())[:8]
-                        new_value = f"{matched_content}_{unique_id}"
-                        uuid_map[matched_content] = new_value
-                        return new_value
-                    
-                def_body = re.sub(pattern, replacer, def_body)
-                    
-                #替换模板中的%%BODY%%
-                def_body = def_body.replace(r"%%BODY%%", body)
-                
-                return def_body
-            
-
-
-            def brace_block(self, items): return "".join(items)
-            def brace_block_nested(self, token): return f"{{ {token[0]} }}"
-            def param(self, token): return token[0]
-            def params(self, items): return items
-
-
-            def HEX_DATA(self, token): return token.value
-            def GGT_NAME(self, token): return token.value
-            def SPF_NAME(self, token): return token.value
-            def CPF_NAME(self, token): return token.value
-            def CNAME(self, token): return token.value
-            def ANY_STRING(self, token): return token.value
-            def ANY_CHAR(self, token): return token.value
-
-            
-            #返回处理后的代码
-            def func_program(self, items):
-                return "".join(items)
-
-
-        pass1_grammar = r"""
-            start: (expr | offset_def | x_def | label_def | rstoffst)*
-            ?expr: term (( PLUS | MINUS ) term)*
-            ?term: factor+
-            ?factor: brackets | swap_endian | hex | LABEL_CALL | LABEL_CALL_RAW | overwrite
-            swap_endian: "[" expr "]" 
-            ?brackets: "<" expr ">"
-
-            overwrite: "@overwrite" "(" ANY_STRING "," ANY_STRING ")"
-
-            offset_def: "@offset" "=" FOUR_BYTE
-            rstoffst: "@rstoffst"
-            x_def: "@x" "=" HALF_BYTE
-            label_def: "@adr" "." CNAME
-
-            PLUS: "+"
-            MINUS: "-"
-
-            FOUR_BYTE: /[0-9a-fA-F]{4}/
-            HALF_BYTE: /[0-9a-fA-F]/
-            hex: HEX_DATA+
-            ANY_STRING: /[^,)]+/
-            
-            LABEL_CALL: /#[a-zA-Z_][a-zA-Z0-9_]*/
-            LABEL_CALL_RAW: /##[a-zA-Z_][a-zA-Z0-9_]*/
-            HEX_DATA: /[0-9a-fA-FxX]{2}/
-
-            COMMENT: /(\/\/|;)[^\n]*/
-
-
-            %ignore COMMENT    
-            %import common.CNAME
-            %import common.WS
-            %ignore WS
+                    load_library(filename, self.libraries_dict[filename])
+                except UnexpectedInput as e:
+                    diagnostics.add(f"Error loading library '{filename}': {_error_message(e)} at line {e.line}", token.start_pos, token.end_pos)
+                except Exception as e:
+                    diagnostics.add(f"Error loading library '{filename}': {e}", token.start_pos, token.end_pos)
+            elif stmt.data == "block":
+                origins[str(stmt.children[0])] = (stmt.children[0], stmt.children[1])
+
+        pre_result = cast(Dict[str, Any], _transform(PreTransformer(self.libraries_dict), tree))
+        self.ggt = pre_result['ggt']
+        self.spf = pre_result['spf']
+        self.cpf = pre_result['cpf']
+        func_transformer = FuncTransformer(self.ggt, self.spf, self.cpf, self.max_expansion_depth, self.max_expansion_size)
+        check_cache = {}
+        defined = set()
+        used = []           # (标签名, 起始偏移, 结束偏移)
+        maybe = set()       # 未能完整展开的块中可能由宏定义的标签，不报告为未定义
+        for block_name, (name_token, content) in origins.items():
+            entry = self._check_cache.get(block_name)
+            if entry is None or entry["source"] != content.value or not self._deps_unchanged(entry["deps"]):
+                entry = self._check_block(func_transformer, block_name, content.value)
+                entry["deps"] = func_transformer.used
+            check_cache[block_name] = entry
+
+            # 块内结果的位置相对于块内容的起点，None 表示标在块名上
+            def span(relative):
+                if relative is None:
+                    return (name_token.start_pos, name_token.end_pos)
+                return (content.start_pos + relative[0], content.start_pos + relative[1])
+            for message, relative in entry["diagnostics"]:
+                diagnostics.add(message, *span(relative))
+            for label_name, relative in entry["defs"]:
+                if label_name in defined:
+                    diagnostics.add(f"Label {label_name} already defined", *span(relative))
+                defined.add(label_name)
+            for label_name, relative in entry["uses"]:
+                used.append((label_name,) + span(relative))
+            if not entry["complete"]:
+                maybe.update(entry["maybe"])
+        if self.incremental:
+            self._check_cache = check_cache
+
+        reported = set()
+        for label_name, start, end in used:
+            if label_name not in defined and label_name not in maybe and (label_name, start) not in reported:
+                reported.add((label_name, start))
+                diagnostics.add(f"Label undefined: {label_name}", start, end)
+
+        diagnostics.items.sort(key=lambda item: (item["from"], item["to"]))
+        return diagnostics.items
+
+    def Index(self, code):
+        """
+        符号索引，供编辑器补全和悬停提示。返回 {引用形式: 符号}，键为 "$名称"、"*名称"、"!名称"、
+        "#标签名" 或 "@block.块名"；符号为 {"name", "kind", "file", "line", "detail"}，
+        file 为库文件名（源码中的定义为 None），detail 为定义所在行的行尾注释。
+        函数（kind 为 function/control）另有 params：[{"name", "default"}]；
+        标签另有 block 和 address/relative（绝对/相对地址的十六进制文本，无法汇编时为 None）。
+        只收录源码中以 @adr. 写出的标签，宏内部生成的标签不在其中。
+        库文件的符号随库文件解析结果缓存；incremental=True 时各块的展开与汇编结果在多次调用之间复用，
+        因此只有修改过的块需要重新处理。源码无法解析时抛出异常。
         """
+        tree = parse_definitions("pre", code)
+        lines = code.split("\n")
+        symbols = {}
+        for stmt in tree.children:
+            if stmt.data == "import_stmt":
+                filename = str(stmt.children[0])
+                try:
+                    symbols.update(load_library(filename, self.libraries_dict[filename])["symbols"])
+                except Exception:
+                    pass    # 缺少或无法解析的库文件由 Check 报告
+            else:
+                symbol = _definition_symbol(stmt, None, lines)
+                if symbol is not None:
+                    symbols[symbol["name"]] = symbol
+
+        pre_result = cast(Dict[str, Any], _transform(PreTransformer(self.libraries_dict), tree))
+        self.ggt = pre_result['ggt']
+        self.spf = pre_result['spf']
+        self.cpf = pre_result['cpf']
+        self.blocks = pre_result['blocks']
+        self.stats = None
+        try:
+            self.FuncCompile()
+            self.AdrCompile()
+            label_map = self.adr_map
+        except Exception:
+            label_map = {}
+
+        for stmt in tree.children:
+            if stmt.data != "block":
+                continue
+            name, content = stmt.children
+            symbols[f"@block.{name}"] = {"name": str(name), "kind": "block", "file": None, "line": name.line, "detail": _line_comment(lines[name.line - 1])}
+            source = _COMMENT.sub(lambda match: " " * len(match.group()), content.value)
+            line, pos = content.line, 0
+            for match in _LABEL_DEF.finditer(source):
+                line += source.count("\n", pos, match.start())
+                pos = match.start()
+                label_name = match.group(1)
+                address = label_map.get(label_name)
+                symbols.setdefault(f"#{label_name}", {
+                    "name": label_name, "kind": "label", "file": None, "line": line, "detail": _line_comment(lines[line - 1]),
+                    "block": str(name),
+                    "address": f"{address[0]:04X}" if address is not None else None,
+                    "relative": f"{address[1]:04X}" if address is not None else None,
+                })
+        return symbols
+
+    def _check_block(self, func_transformer, block_name, block):
+        # 检查单个块，返回块内的诊断、按顺序的标签定义与引用；位置相对于块内容的起点
+        # complete 为 False 时，maybe 是该块中可能由展开失败的宏定义的标签名（源码中出现的、不以 # 开头的名称）
+        result = {"source": block, "diagnostics": [], "defs": [], "uses": [], "complete": False, "maybe": set()}
+        diagnostics = result["diagnostics"]
+        # 注释替换为等长空白，在源码中查找标签时偏移不变
+        source = _COMMENT.sub(lambda match: " " * len(match.group()), block)
+        result["maybe"] = set(_MAYBE_LABEL.findall(source))
+
+        def incomplete():
+            # 未能汇编的块：标签定义直接从源码中的 @adr.名称 取得，仍参与重复定义的检查
+            result["defs"] = [(match.group(1), match.span()) for match in _LABEL_DEF.finditer(source)]
+            return result
+
+        func_transformer.errors = []
+        try:
+            expanded = func_transformer.expand_block(block_name, block)
+        except UnexpectedInput as e:
+            start, end, message = _parse_error(e)
+            diagnostics.append((message, (start, end) if start is not None else (len(block), len(block))))
+            return incomplete()
+        except Exception as e:
+            diagnostics.append((_error_message(e), None))
+            return incomplete()
+        for name, e in func_transformer.errors:
+            diagnostics.append((_error_message(e), (name.start_pos, name.end_pos)))
+
+        try:
+            asm_tree = get_parser("asm").parse(expanded)
+        except UnexpectedInput as e:
+            start, end, message = _parse_error(e)
+            if start is None:
+                diagnostics.append((message, (len(block), len(block))))
+            elif expanded == block:
+                diagnostics.append((message, (start, end)))
+            else:
+                # 展开后的文本与源码位置不对应，按出错处的文本在源码中查找，找不到时标在块名上
+                snippet = expanded[start:].split("\n", 1)[0].strip()
+                found = source.find(snippet) if snippet else -1
+                if found != -1 and source.find(snippet, found + 1) == -1:
+                    diagnostics.append((message, (found, found + len(snippet))))
+                else:
+                    diagnostics.append((message, None))
+            return incomplete()
+
+        def_spans = {}
+        for match in _LABEL_DEF.finditer(source):
+            def_spans.setdefault(match.group(1), []).append(match.span())
+        use_spans = {}
+        for match in _LABEL_USE.finditer(source):
+            use_spans.setdefault(match.group(1), match.span())
+        for kind, label_name in _label_tokens(asm_tree):
+            if kind == "use":
+                result["uses"].append((label_name, use_spans.get(label_name)))
+                continue
+            # 第 n 次定义对应源码中第 n 处 @adr.名称；由宏生成的标签标在源码中出现该名称的地方（通常是宏参数），
+            # 都找不到时标在块名上
+            spans = def_spans.get(label_name)
+            if spans:
+                result["defs"].append((label_name, spans.pop(0)))
+            else:
+                match = re.search(r'(?<![\w#])' + re.escape(label_name) + r'\b', source)
+                result["defs"].append((label_name, match.span() if match else None))
+        result["complete"] = not func_transformer.errors
+        if result["complete"]:
+            result["maybe"] = set()
+        return result
+
+    def _deps_unchanged(self, deps):
+        tables = {"$": self.ggt, "*": self.spf, "!": self.cpf}
+        for name, definition in deps.items():
+            if tables[name[0]].get(name) != definition:
+                return False
+        return True
+
+
+# 供 IDE 使用的编译器实例，在多次编译之间保留增量缓存；检查和符号索引用单独的实例，
+# 避免与尚未完成的异步编译共用状态
+_ide_compiler = ROPCompiler(incremental=True)
+_ide_checker = ROPCompiler(incremental=True)
+
+
+_NONZERO = bytes([0]) + bytes([1]) * 255
+_SAME_BYTES = re.compile(rb"(.)\1*", re.S)
+
+def _wildcard_runs(mask):
+    # 掩码中非零字节的游程 [[起始偏移, 长度, 掩码]...]：先把非零字节映射为 1，用 find 跳过大段的 0，
+    # 只在每个游程处进入 Python，比逐字节的正则扫描快数倍
+    flags = mask.translate(_NONZERO)
+    runs = []
+    pos = flags.find(1)
+    while pos != -1:
+        end = _SAME_BYTES.match(mask, pos).end()
+        runs.append([pos, end - pos, mask[pos]])
+        pos = flags.find(1, end)
+    return runs
+
+
+def pack_blocks(blocks, label_map=None):
+    """
+    把各块的字节码按顺序拼接为一段连续的缓冲区，返回
+    {"data": memoryview, "blocks": [[块名, 起始偏移, 长度]...], "labels": {标签名: [地址, 字节计数]}, "wild": [[起始偏移, 长度, 掩码]...]}。
+    wild 是由占位符 x 填充的半字节：连续若干字节的掩码相同（0xF0/0x0F/0xFF 表示高/低/两个半字节）时合并为一项，偏移相对于整个缓冲区。
+    data 在 Pyodide 中经 toJs 转为 Uint8Array，大小只有十六进制文本的一半，也不必再逐块解析文本。
+    """
+    table = []
+    offset = 0
+    for block_name, block in blocks.items():
+        table.append([block_name, offset, len(block.data)])
+        offset += len(block.data)
+    return {
+        "data": memoryview(b"".join(block.data for block in blocks.values())),
+        "blocks": table,
+        "labels": {label_name: list(adr) for label_name, adr in (label_map or {}).items()},
+        "wild": _wildcard_runs(b"".join(block.mask for block in blocks.values())),
+    }
+
+
+def _ide_compile(source_code, libraries_js_proxy, instrument, source_map, optimize):
+    # compile_to_bytecode 与 compile_to_bytecode_binary 共用：编译并返回 (块, 附加结果)
+    libraries_dict = libraries_js_proxy.to_py() if hasattr(libraries_js_proxy, "to_py") else dict(libraries_js_proxy)
+    prune_library_cache(libraries_dict)
+
+    _ide_compiler.libraries_dict = libraries_dict
+    _ide_compiler.instrument = instrument
+    _ide_compiler.source_map = source_map
+    _ide_compiler.optimize = optimize
+    blocks = _ide_compiler.Compile(source_code)
+    extra = {}
+    if _ide_compiler.stats is not None:
+        extra["stats"] = _ide_compiler.stats.to_dict()
+    if source_map:
+        extra["source_map"] = {block_name: _ide_compiler.source_maps[block_name].to_dict() for block_name in blocks}
+        extra["size_report"] = _ide_compiler.SizeReport()
+    if optimize:
+        extra["optimize"] = {"saved": sum(report["saved"] for report in _ide_compiler.optimized.values()), "blocks": _ide_compiler.optimized}
+    return blocks, extra
+
+
+def compile_to_bytecode(source_code, libraries_js_proxy, instrument=False, source_map=False, optimize=False):
+    """
+    Pyodide 适配层：接收 JS 传来的源代码和库文件（JS Proxy 或 dict），
+    返回 {块名: 十六进制字符串}，出错时返回 {"error": ...}。
+    instrument=True 时额外返回 "stats"：各阶段耗时、解析次数、宏展开次数等统计信息。
+    source_map=True 时额外返回 "source_map"：{块名: [{"start", "end", "line", "chain"}]}（见 SourceMap.to_dict），
+    以及 "size_report"（见 ROPCompiler.SizeReport）。
+    optimize=True 时做窥孔优化（见 Peephole），额外返回 "optimize"：{"saved": 共节省的字节数, "blocks": {块名: {"saved", "removed", "merged"}}}。
+    """
+    try:
+        blocks, extra = _ide_compile(source_code, libraries_js_proxy, instrument, source_map, optimize)
+        result = {block_name: block.hex() for block_name, block in blocks.items()}
+        result.update(extra)
+        return result
 
+    except Exception as e:
+        # 将Python错误返回给JS
+        if js is not None:
+            js.console.error(f"Python 编译时出错: {e}")
+        return {"error": f"error: {e}"}
 
-        #将地址标签全都替换成0x0000，并解析算式，排除其它符号，方便后续计算地址
-        class Pass1Transformer(Transformer):
-            def __init__(self):
-                super().__init__()
-
-            def factor(self, token):
-                return token
-            def brackets(self, items):
-                return items[0]
-            def term(self, items):
-                return "".join(items)
-            
-            def hex(self, items):
-                return "".join(items)
-            def overwrite(self, items):
-                return ""
-            def offset_def(self, items):
-                return f" @offset={items[0]} "
-            def rstoffst(self, token):
-                return " @rstoffst "
-            def x_def(self, items):
-                return ""
-            
-            def swap_endian(self, token):
-                return self._swap_endian(token[0])
-            def expr(self, items):
-                max_width = self._get_max_width(items)
-                result_int = int(items[0], 16)
-                if len(items) == 1: return items[0]
-                for i in range(2, len(items), 2):
-                    op = items[i-1]
-                    value = items[i]
-                    int_value = int(value, 16)
-                    if op == "+":
-                        result_int += int_value
-                    elif op == "-":
-                        result_int -= int_value
-                        max_value = 16**max_width
-                        if result_int < 0:
-                            result_int += max_value
-                    else:
-                        raise Exception(f"Invalid operator: {op}")
-                    
-                result_str = f"{result_int:0{max_width}X}"
-                return result_str
-            
-            def LABEL_CALL(self, token):
-                return "0000"
-            
-            def LABEL_CALL_RAW(self, token):
-                return "0000"
-            
-            def label_def(self, items):
-                return f" @adr.{items[0]} "
-            
-            def HEX_DATA(self, token):
-                hex_string:str = token.value
-                hex_string = hex_string.lower()
-                hex_string=hex_string.replace(" ", "")
-                hex_string = hex_string.replace("x", "0")
-                return hex_string
-
-            def ANY_STRING(self, token):
-                return token.value
-            def FOUR_BYTE(self, token):
-                return token.value
-            def HALF_BYTE(self, token):
-                return token.value
-            def PLUS(self, token): return token.value
-            def MINUS(self, token): return token.value
-            def CNAME(self, token):
-                return token.value
-            def start(self, items):
-                return "".join(items)  
-
-            # 一些辅助函数
-            def _swap_endian(self, hex_string: str):
-                hex_string = hex_string.replace(" ", "")
-                if len(hex_string) % 4 != 0:
-                    raise ValueError("Hex string length for endian swap must have even length")
-                bytes_list = [hex_string[i:i+2] for i in range(0, len(hex_string), 2)]
-                result = []
-                for i in range(0, len(bytes_list), 2): # 每两个字节交换位置
-                    result.append(bytes_list[i+1])
-                    result.append(bytes_list[i])
-                return "".join(result)
-            
-            def _get_max_width(self, items):
-                # 计算表达式中所有操作数的最大长度（以字符数为准）。
-                max_len = 0
-                # items 结构是 [value1, Token('op1'), value2, ...]
-                for i in range(0, len(items), 2): # 只遍历操作数 (索引 0, 2, 4, ...)
-                    item = items[i]
-                    # item 此时是 HEX_DATA 或 expr/term 返回的十六进制字符串
-                    width = len(item)
-                    if width > max_len:
-                        max_len = width
-                # 确保宽度是偶数
-                return max_len if max_len % 2 == 0 else max_len + 1
-
-        adr_grammar = r"""
-            start:(HEX_DATA | label_def | offset_def | rstoffst)*
-            label_def: "@adr" "." CNAME
-            HEX_DATA: /[0-9a-fA-F]{2}/
-            offset_def: "@offset" "=" FOUR_BYTE
-            rstoffst: "@rstoffst"
-            FOUR_BYTE: /[0-9a-fA-F]{4}/
-
-            COMMENT: /(\/\/|;)[^\n]*/
-
-            %ignore COMMENT
-            %import common.CNAME
-            %import common.WS
-            %ignore WS
-        """
+def compile_to_bytecode_binary(source_code, libraries_js_proxy, instrument=False, source_map=False, optimize=False):
+    """
+    与 compile_to_bytecode 相同，但以二进制形式返回字节码（见 pack_blocks）：
+    {"data", "blocks", "labels", "wild"}，以及 stats / source_map / optimize 等附加结果；出错时返回 {"error": ...}。
+    JS 按 "blocks" 中的偏移取 data 的子数组，只为实际显示的行生成十六进制文本。
+    """
+    try:
+        blocks, extra = _ide_compile(source_code, libraries_js_proxy, instrument, source_map, optimize)
+        result = pack_blocks(blocks, _ide_compiler.adr_map)
+        result.update(extra)
+        return result
 
-        # 解析地址标签
-        class AdrTransformer(Transformer):
-            def __init__(self):
-                self.label_map = {}
-                self.byte_count = 0
-                self.offset = 0x0000
-                super().__init__()
+    except Exception as e:
+        if js is not None:
+            js.console.error(f"Python 编译时出错: {e}")
+        return {"error": f"error: {e}"}
 
-            def HEX_DATA(self, token):
-                self.byte_count += len(token.value)/2
-                return None
-            
-            def offset_def(self, items):
-                self.offset = int(items[0], 16)
-                return None
-            def rstoffst(self, token):
-                self.byte_count = 0
-                return None
-            def label_def(self, items):
-                label_name = items[0]
-                if label_name in self.label_map:
-                    raise Exception(f"Label {label_name} already defined")
-                label_list = []
-                label_list.append(f"{int(self.offset + self.byte_count):04X}")
-                label_list.append(f"{int(self.byte_count):04X}")
-                self.label_map[label_name] = label_list
-                return None
-            def CNAME(self, token):
-                return token.value
-            
-            def start(self, items):
-                return self.label_map
-            
-
-        pass2_grammar = r"""
-            start: (expr | offset_def | x_def | label_def | overwrite | rstoffst)*
-            ?expr: term (( PLUS | MINUS ) term)*
-            ?term: factor+
-            ?factor: brackets | swap_endian | hex | LABEL_CALL | LABEL_CALL_RAW
-            swap_endian: "[" expr "]" 
-            ?brackets: "<" expr ">"
-
-            overwrite: "@overwrite" "(" expr "," expr ")"
-
-            offset_def: "@offset" "=" FOUR_BYTE
-            rstoffst: "@rstoffst"
-            x_def: "@x" "=" HALF_BYTE
-            label_def: "@adr" "." CNAME
-
-            PLUS: "+"
-            MINUS: "-"
-
-            FOUR_BYTE: /[0-9a-fA-F]{4}/
-            HALF_BYTE: /[0-9a-fA-F]/
-            hex: HEX_DATA+
-            LABEL_CALL: /#[a-zA-Z_][a-zA-Z0-9_]*/
-            LABEL_CALL_RAW: /##[a-zA-Z_][a-zA-Z0-9_]*/
-            HEX_DATA: /[0-9a-fA-FxX]{2}/
-
-            
-            COMMENT: /(\/\/|;)[^\n]*/
-
-            %ignore COMMENT
-            %import common.CNAME
-            %import common.WS
-            %ignore WS
-        """
+async def compile_to_bytecode_async(source_code, libraries_js_proxy, token=None, on_block=None, binary=False):
+    """
+    compile_to_bytecode 的异步版本，用于边输入边编译：在块与块之间让出主线程。
+    token 为 JS 对象 {cancelled: false}，置为 true 即丢弃这次编译；新的编译开始时旧的也会自动作废。
+    on_block(块名, 十六进制字符串) 在每个块完成时回调。被取消时返回 {"cancelled": True}。
+    binary=True 时与 compile_to_bytecode_binary 一样以二进制形式返回（见 pack_blocks）。
+    """
+    try:
+        libraries_dict = libraries_js_proxy.to_py() if hasattr(libraries_js_proxy, "to_py") else dict(libraries_js_proxy)
+        prune_library_cache(libraries_dict)
+
+        _ide_compiler.libraries_dict = libraries_dict
+        blocks = {}
+        def collect(block_name, block):
+            blocks[block_name] = block
+            if on_block is not None:
+                on_block(block_name, block.hex())
+        await compile_async(_ide_compiler, source_code, token, collect)
+        if binary:
+            return pack_blocks(blocks, _ide_compiler.adr_map)
+        return {block_name: block.hex() for block_name, block in blocks.items()}
+
+    except CompileCancelled:
+        return {"cancelled": True}
+    except Exception as e:
+        if js is not None:
+            js.console.error(f"Python 编译时出错: {e}")
+        return {"error": f"error: {e}"}
 
-        class Pass2Transformer(Transformer):
-            def __init__(self,label_map):
-                self.label_map :dict = label_map
-                self.x_placeholder = "0"
-                self.overwrite_map = {}
-                super().__init__()
-
-            def factor(self, token):
-                return token
-            def brackets(self, items):
-                return items[0]
-            def term(self, items):
-                return "".join(items)
-            
-            def hex(self, items):
-                return "".join(items)
-            def overwrite(self, items):
-                self.overwrite_map[items[0]] = items[1]
-                return ""
-            def offset_def(self, items):
-                return ""
-            def  rstoffst(self, token):
-                return ""
-            def x_def(self, items):
-                self.x_placeholder = items[0]
-                return ""
-            
-            def swap_endian(self, token):
-                return self._swap_endian(token[0])
-            def expr(self, items):
-                max_width = self._get_max_width(items)
-                result_int = int(items[0], 16)
-                if len(items) == 1: return items[0]
-                for i in range(2, len(items), 2):
-                    op = items[i-1]
-                    value = items[i]
-                    int_value = int(value, 16)
-                    if op == "+":
-                        result_int += int_value
-                    elif op == "-":
-                        result_int -= int_value
-                        max_value = 16**max_width
-                        if result_int < 0:
-                            result_int += max_value
-                    else:
-                        raise Exception(f"Invalid operator: {op}")
-                    
-                result_str = f"{result_int:0{max_width}X}"
-                return result_str
-            
-            def LABEL_CALL(self, token):
-                try:
-                    label_name = token.value[1:]
-                    label_value = int(self.label_map[label_name][0], 16)
-                    return f"{label_value:04X}"
-                except KeyError as e:
-                    raise Exception(f"Label undefined: {label_name}")
-            
-            def LABEL_CALL_RAW(self, token):
-                label_name = token.value[2:]
-                label_value = int(self.label_map[label_name][1], 16)
-                return f"{label_value:04X}"
-            
-            def label_def(self, items):
-                return ""
-            
-            def HEX_DATA(self, token):
-                hex_string:str = token.value
-                hex_string = hex_string.lower()
-                hex_string = hex_string.replace(" ", "")
-                hex_string = hex_string.replace("x", self.x_placeholder)
-                return hex_string
-
-            def ANY_STRING(self, token):
-                return token.value
-            def FOUR_BYTE(self, token):
-                return token.value
-            def HALF_BYTE(self, token):
-                return token.value
-            def PLUS(self, token): return token.value
-            def MINUS(self, token): return token.value
-            def CNAME(self, token):
-                return token.value
-            def start(self, items):
-                code = "".join(items) 
-                overwrite = self.overwrite_map
-                return {"code": code, "overwrite": overwrite} 
-
-            # 一些辅助函数
-            def _swap_endian(self, hex_string: str):
-                hex_string = hex_string.replace(" ", "")
-                if len(hex_string) % 4 != 0:
-                    raise ValueError("Hex string length for endian swap must have even length")
-                bytes_list = [hex_string[i:i+2] for i in range(0, len(hex_string), 2)]
-                result = []
-                for i in range(0, len(bytes_list), 2): # 每两个字节交换位置
-                    result.append(bytes_list[i+1])
-                    result.append(bytes_list[i])
-                return "".join(result)
-            
-            def _get_max_width(self, items):
-                # 计算表达式中所有操作数的最大长度（以字符数为准）。
-                max_len = 0
-                # items 结构是 [value1, Token('op1'), value2, ...]
-                for i in range(0, len(items), 2): # 只遍历操作数 (索引 0, 2, 4, ...)
-                    item = items[i]
-                    # item 此时是 HEX_DATA 或 expr/term 返回的十六进制字符串
-                    width = len(item)
-                    if width > max_len:
-                        max_len = width
-                # 确保宽度是偶数
-                return max_len if max_len % 2 == 0 else max_len + 1
-            
-
-        class ROPCompiler():
-            def __init__(self):
-                self.ggt = {}
-                self.spf = {}
-                self.cpf = {}
-                self.blocks = {}
-                self.adr_map = {}
-
-            def PreCompile(self,code):
-                pre_parser = Lark(pre_grammar, start='pre_program', parser='lalr',transformer=PreTransformer())
-                pre_result= cast(Dict[str, Any], pre_parser.parse(code))
-                self.ggt = pre_result['ggt']
-                self.spf = pre_result['spf']
-                self.cpf = pre_result['cpf']
-                self.blocks = pre_result['blocks']
-                
-            def FuncCompile(self):
-                func_parser = Lark(func_grammar, start='func_program', parser='lalr',transformer=FuncTransformer(self.ggt, self.spf, self.cpf))
-                for block_name, block in self.blocks.items():
-                    last_block = ""
-                    while block != last_block:
-                        last_block = block
-                        block = func_parser.parse(block)
-                    self.blocks[block_name] = block
-
-
-            def AdrCompile(self):
-                pass1parser = Lark(pass1_grammar, start='start', parser='lalr',transformer=Pass1Transformer())
-                adrparser = Lark(adr_grammar, start='start', parser='lalr',transformer=AdrTransformer())
-                for block_name, block in self.blocks.items():
-                    adr_block = pass1parser.parse(self.blocks[block_name])
-                    self.adr_map.update(cast(dict, adrparser.parse(adr_block)))
-            
-            def Pass2Compile(self):
-                pass2parser = Lark(pass2_grammar, start='start', parser='lalr',transformer=Pass2Transformer(self.adr_map))
-
-                for block_name, block in self.blocks.items():
-                    overwrite_map = {}
-                    result = cast(dict, pass2parser.parse(block))
-                    self.blocks[block_name] = result["code"]
-                    # 解析overwrite
-                    overwrite_map.update(result["overwrite"])
-                    for addr, value in overwrite_map.items():
-                        pos = int(addr, 16)
-                        pos = pos*2 - 2
-                        if pos >= len(self.blocks[block_name]):
-                            raise Exception(f"Overwrite address out of range: {addr}")
-                        
-                        self.blocks[block_name] = self.blocks[block_name][:pos+2] + value + self.blocks[block_name][pos+len(value)+2:]
-
-
-            def Compile (self):
-                code = source_code
-                self.PreCompile(code)
-                self.FuncCompile()
-                self.AdrCompile()
-                self.Pass2Compile()
+def compile_to_bytecode_stream(source_code, libraries_js_proxy, on_block):
+    """
+    流式版本（见 ROPCompiler.CompileStream），用于输出很大、整体返回会耗尽 Pyodide 堆的程序：
+    每个块完成后立即以 on_block(块名, 十六进制字符串) 交给 JS 并释放。
+    返回 {"blocks": [块名...]}，出错时返回 {"error": ...}（出错之前的块已经回调过）。
+    不使用 IDE 实例的增量缓存，以免缓存重新持有全部块。
+    """
+    try:
+        libraries_dict = libraries_js_proxy.to_py() if hasattr(libraries_js_proxy, "to_py") else dict(libraries_js_proxy)
+        prune_library_cache(libraries_dict)
 
-                return self.blocks
-        
-        # -----------------------------------------------
-        # --- [ 您的逻辑结束 ] ---
-        # -----------------------------------------------
-        
-        compiler = ROPCompiler()
-        items = compiler.Compile()
-        for item in items:
-            items[item] = items[item].upper()
-        return items
+        block_names = []
+        for block_name, block in ROPCompiler(libraries_dict).CompileStream(source_code):
+            on_block(block_name, block.hex())
+            block_names.append(block_name)
+            del block
+        return {"blocks": block_names}
 
     except Exception as e:
-        # 将Python错误返回给JS
-        js.console.error(f"Python 编译时出错: {e}")
+        if js is not None:
+            js.console.error(f"Python 编译时出错: {e}")
         return {"error": f"error: {e}"}
 
+def check(source_code, libraries=None):
+    """
+    只检查不编译，供编辑器的 linter 在每次输入后调用，返回诊断列表（见 ROPCompiler.Check）。
+    libraries 可以是 JS Proxy 或 dict；库文件的解析结果与编译共用同一份缓存。
+    """
+    libraries_dict = libraries.to_py() if hasattr(libraries, "to_py") else dict(libraries or {})
+    prune_library_cache(libraries_dict)
+    _ide_checker.libraries_dict = libraries_dict
+    return _ide_checker.Check(source_code)
+
+def index(source_code, libraries=None):
+    """
+    符号索引（见 ROPCompiler.Index），供编辑器补全与悬停提示；源码无法解析时抛出异常。
+    """
+    libraries_dict = libraries.to_py() if hasattr(libraries, "to_py") else dict(libraries or {})
+    prune_library_cache(libraries_dict)
+    _ide_checker.libraries_dict = libraries_dict
+    return _ide_checker.Index(source_code)
+
 # 2. 将Python函数暴露给JS，以便JS的 "编译" 按钮可以调用它
-js.globalThis.pyProcessCode = compile_to_bytecode
\ No newline at end of file
+if js is not None:
+    js.globalThis.pyProcessCode = compile_to_bytecode
+    js.globalThis.pyProcessCodeBinary = compile_to_bytecode_binary
+    js.globalThis.pyProcessCodeAsync = compile_to_bytecode_async
+    js.globalThis.pyProcessCodeStream = compile_to_bytecode_stream
+    js.globalThis.pyCheckCode = check
+    js.globalThis.pyIndexCode = index
@@ -30,6 +30,10 @@ import { oneDark } from '@codemirror/theme-one-dark';
 window.libraryFiles = window.libraryFiles || {};
 window.completionWords = window.completionWords || {};
 let lastBytecode = "";
+let compileToken = null; // 正在进行的异步编译的取消标记 ({cancelled})
+// 源码或上一次编译的输出超过该长度（字符）时改用流式编译，逐块接收结果，避免 Python 堆同时持有整个程序
+const STREAMING_THRESHOLD = 1 << 20;
+let lastOutputSize = 0;
 
 const STORAGE_KEY = 'ropIdeSourceCode'
 
@@ -223,6 +227,33 @@ function buildCompletionWords(sourceCode, libraryFiles = {}, importedFileNames =
     };
     Object.assign(newWords, staticWords);
 
+    // 优先使用编译器的符号索引：库文件的符号随解析结果缓存，不必每次重新扫描库文件
+    if (typeof window.pyIndexCode === 'function') {
+        try {
+            const resultProxy = window.pyIndexCode(sourceCode || "", libraryFiles);
+            const symbols = resultProxy.toJs({ dict_converter: Object.fromEntries });
+            resultProxy.destroy();
+            Object.entries(symbols).forEach(([key, symbol]) => {
+                if (symbol.kind === 'label') {
+                    // 添加 #xxx 和 ##xxx，说明中附上已解析的地址
+                    const detail = symbol.address ? `${symbol.address} ${symbol.detail}`.trim() : symbol.detail;
+                    newWords[key] = { label: key, detail: detail, type: 'label' };
+                    newWords['#' + key] = { label: '#' + key, detail: detail, type: 'label' };
+                } else if (symbol.kind !== 'block') {
+                    const params = symbol.params
+                        ? `(${symbol.params.map(p => p.default == null ? p.name : `${p.name}=${p.default}`).join(', ')}) `
+                        : '';
+                    newWords[key] = { label: key, detail: (params + symbol.detail).trim(), type: assignCompletionType(key[0]), rt: key.endsWith('?') };
+                }
+            });
+            finishCompletionWords(newWords);
+            return;
+        } catch (error) {
+            // 源码暂时无法解析（例如正在输入中），退回到逐行扫描
+            console.log("DEBUG: 符号索引不可用，改为逐行扫描:", error.message);
+        }
+    }
+
     const librarySources = importedFileNames
         .filter(name => libraryFiles[name]) // 只保留 window.libraryFiles 中实际存在的
         .map(name => ({ name: name, content: libraryFiles[name], isLibrary: true }));
@@ -303,7 +334,11 @@ function buildCompletionWords(sourceCode, libraryFiles = {}, importedFileNames =
         });
     });
 
-    // ... (添加 import, def 关键字保持不变) ...
+    finishCompletionWords(newWords);
+}
+
+// 添加 import, def 关键字并发布词库
+function finishCompletionWords(newWords) {
     if (!newWords['import']) { newWords['import'] = { label: 'import', detail: '导入库文件', type: assignCompletionType('import') }; }
     if (!newWords['def']) { newWords['def'] = { label: 'def', detail: '定义新的gadgets/函数', type: assignCompletionType('def') }; }
 
@@ -496,7 +531,25 @@ const myLinter = linter(view => {
             }
         }
     });
-    
+
+    // --- 5. 编译器检查 (未定义的宏、参数不足、重复/未定义的标签、语法错误) ---
+    // 只做预处理和宏展开，不生成字节码；未改动的块直接复用上次的检查结果
+    if (typeof window.pyCheckCode === 'function') {
+        try {
+            const resultProxy = window.pyCheckCode(code, window.libraryFiles);
+            const items = resultProxy.toJs({ dict_converter: Object.fromEntries });
+            resultProxy.destroy();
+            items.forEach(item => diagnostics.push({
+                from: Math.min(item.from, code.length),
+                to: Math.min(item.to, code.length),
+                severity: item.severity,
+                message: item.message
+            }));
+        } catch (error) {
+            console.error("检查代码时出错:", error);
+        }
+    }
+
     return diagnostics;
 });
 
@@ -547,6 +600,116 @@ function formatHexView(hexString, addr1Hex, addr2Hex, bytesPerLine = 16) {
     return output || "无字节码数据";
 }
 
+// ----------------------------------------------------------------------
+// 二进制编译结果 (pyProcessCodeBinary) 的显示：只为实际显示的行生成十六进制文本
+// ----------------------------------------------------------------------
+const HEX_BYTE = Array.from({ length: 256 }, (_, i) => i.toString(16).toUpperCase().padStart(2, '0'));
+const HEX_VIEW_CHUNK_ROWS = 256; // 每次追加的行数，滚动到末尾时再追加下一批
+let hexViewObserver = null;
+
+/**
+ * 将字节数组中的若干行格式化为与 formatHexView 相同的双地址列视图。
+ * @param {Uint8Array} bytes - 块的字节码
+ * @param {number} addr1Start - 起始地址 1
+ * @param {number} addr2Start - 起始地址 2
+ * @param {number} firstRow - 第一行的行号
+ * @param {number} rowCount - 行数
+ * @param {number} bytesPerLine - 每行显示的字节数
+ * @returns {string} 格式化后的字符串
+ */
+function formatByteRows(bytes, addr1Start, addr2Start, firstRow, rowCount, bytesPerLine = 16) {
+    let output = "";
+    const end = Math.min(bytes.length, (firstRow + rowCount) * bytesPerLine);
+    for (let i = firstRow * bytesPerLine; i < end; i += bytesPerLine) {
+        const addr1Current = (addr1Start + i).toString(16).toUpperCase().padStart(4, '0');
+        const addr2Current = (addr2Start + i).toString(16).toUpperCase().padStart(4, '0');
+        const hexPart = Array.from(bytes.subarray(i, Math.min(i + bytesPerLine, end)), byte => HEX_BYTE[byte]).join(' ');
+        output += `${addr1Current} ${addr2Current}  ${hexPart.padEnd(bytesPerLine * 3 - 1)}\n`;
+    }
+    return output;
+}
+
+/**
+ * 在 contentDisplay 中显示一个块：十六进制字符串（流式编译、错误信息）整体格式化；
+ * Uint8Array 先显示前 HEX_VIEW_CHUNK_ROWS 行，末尾的占位元素进入视口时再追加下一批。
+ */
+function renderBytecodeView(contentDisplay, block, addr1Hex, addr2Hex) {
+    if (hexViewObserver) {
+        hexViewObserver.disconnect();
+        hexViewObserver = null;
+    }
+    if (!(block instanceof Uint8Array)) {
+        contentDisplay.textContent = formatHexView(block, addr1Hex, addr2Hex);
+        return;
+    }
+
+    const addr1Start = parseInt(addr1Hex, 16);
+    const addr2Start = parseInt(addr2Hex, 16);
+    if (isNaN(addr1Start) || isNaN(addr2Start)) { contentDisplay.textContent = "地址格式错误"; return; }
+    if (block.length === 0) { contentDisplay.textContent = "无字节码数据"; return; }
+
+    const totalRows = Math.ceil(block.length / 16);
+    let nextRow = 0;
+    const sentinel = document.createElement('span');
+    contentDisplay.textContent = '';
+    contentDisplay.appendChild(sentinel);
+    const appendRows = () => {
+        const rowCount = Math.min(HEX_VIEW_CHUNK_ROWS, totalRows - nextRow);
+        sentinel.before(formatByteRows(block, addr1Start, addr2Start, nextRow, rowCount));
+        nextRow += rowCount;
+        return nextRow < totalRows;
+    };
+    if (!appendRows()) { sentinel.remove(); return; }
+
+    const observer = new IntersectionObserver(entries => {
+        if (!entries.some(entry => entry.isIntersecting)) return;
+        // 重新 observe 会立即再回调一次：追加后占位元素仍在视口内时继续追加
+        observer.unobserve(sentinel);
+        if (appendRows()) {
+            observer.observe(sentinel);
+        } else {
+            observer.disconnect();
+            sentinel.remove();
+            if (hexViewObserver === observer) hexViewObserver = null;
+        }
+    });
+    observer.observe(sentinel);
+    hexViewObserver = observer;
+}
+
+/**
+ * 将 pyProcessCodeBinary 的结果拆分为各块的字节数组（共用同一段缓冲区的 subarray）。
+ * 同时在 window.bytecodeLabels / window.bytecodeWildcards 中保存标签地址与各块中由占位符 x 填充的半字节。
+ */
+function unpackBinaryResult(result) {
+    let data = result.data;
+    if (!(data instanceof Uint8Array)) {
+        // toJs 未转换缓冲区时仍是 PyProxy：复制一次到 JS，避免 Pyodide 堆增长后视图失效
+        const buffer = data.getBuffer('u8');
+        try { data = buffer.data.slice(); } finally { buffer.release(); result.data.destroy(); }
+    }
+    const blocks = {};
+    const wildcards = {};
+    for (const [blockName, start, length] of result.blocks) {
+        blocks[blockName] = data.subarray(start, start + length);
+        wildcards[blockName] = result.wild
+            .filter(([pos]) => pos >= start && pos < start + length)
+            .map(([pos, size, mask]) => [pos - start, size, mask]);
+    }
+    window.bytecodeLabels = result.labels || {};
+    window.bytecodeWildcards = wildcards;
+    return blocks;
+}
+
+function bytesToHex(bytes) {
+    return Array.from(bytes, byte => HEX_BYTE[byte]).join('');
+}
+
+function blockOutputSize(block) {
+    // 与十六进制字符串长度相同的口径，用于判断是否改用流式编译
+    return block instanceof Uint8Array ? block.length * 2 : block.length;
+}
+
 // ----------------------------------------------------------------------
 // 【新增】十六进制字符串转 Uint8Array 函数 (用于二进制导出)
 // ----------------------------------------------------------------------
@@ -782,7 +945,44 @@ if (compileBtn) {
         buildCompletionWords(sourceCode, window.libraryFiles); 
         
         try {
-            if (typeof window.pyProcessCode === 'function') {
+            const useStreaming = typeof window.pyProcessCodeStream === 'function'
+                && (sourceCode.length > STREAMING_THRESHOLD || lastOutputSize > STREAMING_THRESHOLD);
+            if (useStreaming) {
+                const blocks = {};
+                const resultProxy = await window.pyProcessCodeStream(sourceCode, window.libraryFiles, (blockName, hex) => {
+                    blocks[blockName] = hex;
+                });
+                const result = resultProxy.toJs({ dict_converter: Object.fromEntries });
+                resultProxy.destroy();
+                if (result.error) blocks.error = result.error;
+                lastOutputSize = Object.values(blocks).reduce((size, hex) => size + hex.length, 0);
+                window.bytecodeBlocks = blocks;
+                updateBytecodeViewer();
+            } else if (typeof window.pyProcessCodeAsync === 'function') {
+                // 可取消的异步编译：Python 在块与块之间让出主线程；再次点击编译时作废尚未完成的上一次编译。
+                // 结果为二进制：字节码整体作为一段缓冲区传给 JS，只为显示的行生成十六进制文本
+                if (compileToken) compileToken.cancelled = true;
+                const token = { cancelled: false };
+                compileToken = token;
+                const resultProxy = await window.pyProcessCodeAsync(sourceCode, window.libraryFiles, token, undefined, true);
+                const result = resultProxy.toJs({ dict_converter: Object.fromEntries });
+                resultProxy.destroy();
+                if (result.cancelled || token !== compileToken) return; // 已被新的编译取代
+                compileToken = null;
+                const blocks = result.error ? { error: result.error } : unpackBinaryResult(result);
+                lastOutputSize = Object.values(blocks).reduce((size, block) => size + blockOutputSize(block), 0);
+                window.bytecodeBlocks = blocks;
+                updateBytecodeViewer();
+            } else if (typeof window.pyProcessCodeBinary === 'function') {
+                // 二进制结果：字节码整体作为一段缓冲区传给 JS，只为显示的行生成十六进制文本
+                const resultProxy = await window.pyProcessCodeBinary(sourceCode, window.libraryFiles);
+                const result = resultProxy.toJs({ dict_converter: Object.fromEntries });
+                resultProxy.destroy();
+                const blocks = result.error ? { error: result.error } : unpackBinaryResult(result);
+                lastOutputSize = Object.values(blocks).reduce((size, block) => size + blockOutputSize(block), 0);
+                window.bytecodeBlocks = blocks;
+                updateBytecodeViewer();
+            } else if (typeof window.pyProcessCode === 'function') {
                 
                 // 【修复 1】确保传递所有参数 (addr1, addr2)
                 const resultProxy = await window.pyProcessCode(sourceCode, window.libraryFiles);
@@ -795,6 +995,7 @@ if (compileBtn) {
                 console.log("DEBUG: Python 返回的字节码字典 (已转换):", resultObject); 
 
                 window.bytecodeBlocks = resultObject; 
+                lastOutputSize = Object.values(resultObject).reduce((size, hex) => size + hex.length, 0);
                 
                 // 【重要】调用 updateBytecodeViewer() 来填充下拉框
                 // 这应该会自动触发 onchange 事件 (通过 dispatchEvent) 来显示第一个块的内容
@@ -843,10 +1044,10 @@ if(bytecodeSelector) {
         
         if (selectedBlock && window.bytecodeBlocks[selectedBlock]) {
             // 【修改】调用 Hex 格式化函数
-            contentDisplay.textContent = formatHexView(window.bytecodeBlocks[selectedBlock], addr1Hex, addr2Hex);
+            renderBytecodeView(contentDisplay, window.bytecodeBlocks[selectedBlock], addr1Hex, addr2Hex);
         } else if (Object.keys(window.bytecodeBlocks).length > 0 && !selectedBlock) {
              const firstKey = Object.keys(window.bytecodeBlocks)[0];
-             contentDisplay.textContent = formatHexView(window.bytecodeBlocks[firstKey], addr1Hex, addr2Hex);
+             renderBytecodeView(contentDisplay, window.bytecodeBlocks[firstKey], addr1Hex, addr2Hex);
         } else {
             contentDisplay.textContent = '请选择一个代码块查看字节码。';
         }
@@ -913,18 +1114,19 @@ if(exportBytecodeBtn) {
         }
         
         const blockName = selectedBlock;
-        const hexString = window.bytecodeBlocks[blockName];
+        const block = window.bytecodeBlocks[blockName];
+        const hexString = block instanceof Uint8Array ? null : block;
         
         // 弹出对话框让用户选择格式
         const format = prompt(`导出字节码块 "${blockName}"\n请输入导出格式: 'txt' (十六进制文本) 或 'bin' (二进制文件)`, 'txt');
         
         if (format && format.toLowerCase() === 'bin') {
             // 导出二进制
-            const byteArray = hexStringToUint8Array(hexString);
+            const byteArray = hexString === null ? block : hexStringToUint8Array(hexString);
             downloadFile(`${projectName}_${blockName}.bin`, byteArray, 'application/octet-stream');
         } else if (format && format.toLowerCase() === 'txt') {
             // 导出文本
-            downloadFile(`${projectName}_${blockName}.txt`, hexString, 'text/plain');
+            downloadFile(`${projectName}_${blockName}.txt`, hexString === null ? bytesToHex(block) : hexString, 'text/plain');
         } else if (format !== null) {
             alert('无效的格式，请输入 "txt" 或 "bin"。');
         }
@@ -0,0 +1,72 @@
+"""
+按效果查找 gadget：根据 gadget 名称中的效果（见 README 3.1 命名规范）建立索引，
+查询设置若干寄存器或在寄存器之间复制值的 gadget 序列，按在链中占用的字节数排序。
+
+用法:
+    python tools/gadget_search.py load er0 er4 [--preserve er2]
+    python tools/gadget_search.py move er0 er2 [--preserve er12]
+    python tools/gadget_search.py effects
+
+-l 指定库文件（可重复，后面的覆盖前面的同名 gadget），默认为 public/vendor/libraries/basic-991cnx-verc.ggt。
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+from collections import ChainMap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "public"))
+
+from compiler import GadgetIndex, load_library  # noqa: E402
+
+DEFAULT_LIBRARY = os.path.join(ROOT, "public", "vendor", "libraries", "basic-991cnx-verc.ggt")
+
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-l", "--library", action="append", help="库文件（.ggt / .macro / 索引库）")
+    common.add_argument("--preserve", nargs="+", default=[], help="不得被改变的寄存器")
+    common.add_argument("--limit", type=int, default=5, help="最多输出的结果数")
+    common.add_argument("--side-effects", action="store_true", help="允许使用伴随其它效果的 gadget（名称以 ? 开头）")
+    common.add_argument("--rt", action="store_true", help="允许使用依赖 RT 返回的 gadget（名称以 ? 结尾）")
+    parser = argparse.ArgumentParser(description="按效果查找 gadget")
+    commands = parser.add_subparsers(dest="command", required=True)
+    load_parser = commands.add_parser("load", parents=[common], help="从链中设置寄存器")
+    load_parser.add_argument("registers", nargs="+")
+    move_parser = commands.add_parser("move", parents=[common], help="把 SOURCE 复制到 DEST")
+    move_parser.add_argument("dest")
+    move_parser.add_argument("source")
+    commands.add_parser("effects", parents=[common], help="输出所有 gadget 解析出的效果")
+    args = parser.parse_args(argv)
+
+    tables = []
+    for path in args.library or [DEFAULT_LIBRARY]:
+        with open(path, encoding="utf-8") as f:
+            content = f.read()
+        with contextlib.redirect_stdout(io.StringIO()):
+            tables.append(load_library(os.path.basename(path), content)["ggt"])
+    index = GadgetIndex(ChainMap(*reversed(tables)))
+
+    if args.command == "effects":
+        for effect in index.effects.values():
+            print(json.dumps(effect.to_dict(), ensure_ascii=False))
+        return 0
+
+    options = dict(preserve=args.preserve, limit=args.limit, side_effects=args.side_effects, rt=args.rt)
+    if args.command == "load":
+        results = index.load(args.registers, **options)
+    else:
+        results = index.move(args.dest, args.source, **options)
+    if not results:
+        print("no chain found", file=sys.stderr)
+        return 1
+    for result in results:
+        print(f"{result['cost']:4d} bytes  {' '.join(result['gadgets'])}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
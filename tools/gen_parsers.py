@@ -0,0 +1,79 @@
+"""
+生成 public/rop_parsers.py：lark 独立运行时 + 编译器各语法预先构建好的 LALR 分析表。
+
+浏览器加载该模块后无需再安装 lark 包、也无需在首次编译前分析语法。
+修改 compiler.py 中的任何语法后都需要重新运行：
+
+    python tools/gen_parsers.py
+
+编译器按语法内容的哈希校验分析表，不一致时会退回到用 lark 现场构建。
+"""
+import base64
+import os
+import pickle
+import sys
+import zlib
+
+import lark
+from lark.tools.standalone import EXTRACT_STANDALONE_FILES, extract_sections, strip_docstrings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUTPUT = os.path.join(ROOT, "public", "rop_parsers.py")
+sys.path.insert(0, os.path.join(ROOT, "public"))
+sys.modules["rop_parsers"] = None  # 始终基于 lark 包生成，不加载旧的 rop_parsers.py
+
+import compiler  # noqa: E402
+
+LARK_DIR = os.path.dirname(lark.__file__)
+
+
+def runtime_source():
+    # 与 lark.tools.standalone 相同的方式抽取运行时代码
+    parts = []
+    for i, pyfile in enumerate(EXTRACT_STANDALONE_FILES):
+        with open(os.path.join(LARK_DIR, pyfile)) as f:
+            code = extract_sections(f)["standalone"]
+        if i:
+            code = strip_docstrings(iter(code.splitlines(True)).__next__)
+        parts.append(code)
+    return "\n".join(parts)
+
+
+def pack(obj):
+    return base64.b64encode(zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), 9)).decode("ascii")
+
+
+def main():
+    lines = [
+        "# 由 tools/gen_parsers.py 生成，请勿手动修改",
+        f"# The file was automatically generated by Lark v{lark.__version__}",
+        f'__version__ = "{lark.__version__}"',
+        "",
+        runtime_source(),
+        "import pickle, zlib, base64",
+        "Shift = 0",
+        "Reduce = 1",
+        "",
+        "# 语法名 -> (语法哈希, 压缩后的 data, 压缩后的 memo)",
+        "PARSERS = {",
+    ]
+    for name in compiler._GRAMMARS:
+        data, memo = compiler.serialize_parser(name)
+        lines.append(f"    {name!r}: ({compiler.grammar_digest(name)!r}, {pack(data)!r}, {pack(memo)!r}),")
+    lines += [
+        "}",
+        "",
+        "def load_tables(name, digest):",
+        "    entry = PARSERS.get(name)",
+        "    if entry is None or entry[0] != digest:",
+        "        return None",
+        "    return tuple(pickle.loads(zlib.decompress(base64.b64decode(packed))) for packed in entry[1:])",
+        "",
+    ]
+    with open(OUTPUT, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    print(f"wrote {os.path.relpath(OUTPUT, ROOT)}")
+
+
+if __name__ == "__main__":
+    main()
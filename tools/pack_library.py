@@ -0,0 +1,51 @@
+"""
+把文本库（.ggt / .macro）转换为索引库格式。编译器导入索引库时不解析整个文件，
+只按名称读取程序引用到的定义，适合由 ROM 生成的、包含数万条 gadget 的库。
+
+用法:
+    python tools/pack_library.py rom-gadgets.ggt [更多文件...] [-d 输出目录]
+
+输出文件为 <输出目录>/<原文件名>.idx（默认与原文件同目录），在源码中以
+import rom-gadgets.ggt.idx 导入。
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "public"))
+
+from compiler import pack_library  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="将文本库转换为索引库格式")
+    parser.add_argument("inputs", nargs="+", help=".ggt / .macro 文本库")
+    parser.add_argument("-d", "--output-dir", help="输出目录，默认与输入文件相同")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for path in args.inputs:
+        filename = os.path.basename(path)
+        output = os.path.join(args.output_dir or os.path.dirname(path), filename + ".idx")
+        with open(path, encoding="utf-8") as f:
+            content = f.read()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                packed = pack_library(filename, content)
+        except Exception as e:
+            print(f"{path}: error: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+        with open(output, "w", encoding="utf-8", newline="\n") as f:
+            f.write(packed)
+        print(f"{path} -> {output}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
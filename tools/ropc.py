@@ -0,0 +1,176 @@
+"""
+命令行批量编译：递归查找目录中的 .rop 文件，用进程池并行编译，每个块输出一个文件。
+只有一个程序时改为在同一个程序的各块之间并行（ROPCompiler(workers=N)）。
+
+用法:
+    python tools/ropc.py programs/ -o build/ [-L libs/] [--format hex|bin] [-j 8] [--stream] [--source-map] [-O] [--cache DIR]
+
+输出文件为 <输出目录>/<相对路径>/<文件名>.<块名>.hex（或 .bin）。
+--source-map 时另外写出 <文件名>.map.json：{"blocks": {块名: 字节来源}, "size_report": 按块、gadget 和宏汇总的字节数}。
+-O 时对展开结果做窥孔优化（见 compiler.Peephole），并输出每个程序节省的字节数。
+--cache 指定磁盘缓存目录（见 compiler.CompileCache）：源码、导入的库文件与选项都未变化的程序直接使用上次的结果，
+修改了某个库文件时只重新编译导入它的程序，其中未引用到被修改定义的块也不再展开。多个进程共用同一个缓存目录，
+总大小超过 --cache-size（MiB）时删除最久未使用的条目。
+库文件按 import 的文件名在 -L 指定的目录中查找，默认为 public/vendor/libraries。
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "public"))
+
+from compiler import CompileCache, ROPCompiler  # noqa: E402
+
+DEFAULT_LIBRARY_DIR = os.path.join(ROOT, "public", "vendor", "libraries")
+
+
+class LibraryDirs(Mapping):
+    """按文件名在若干目录中查找库文件，只在被 import 时才读取。"""
+
+    def __init__(self, dirs):
+        self.dirs = list(dirs)
+        self._contents = {}
+
+    def _path(self, filename):
+        for directory in self.dirs:
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def __getitem__(self, filename):
+        if filename not in self._contents:
+            path = self._path(filename)
+            if path is None:
+                raise KeyError(filename)
+            with open(path, encoding="utf-8") as f:
+                self._contents[filename] = f.read()
+        return self._contents[filename]
+
+    def __contains__(self, filename):
+        return filename in self._contents or self._path(filename) is not None
+
+    def __iter__(self):
+        names = set()
+        for directory in self.dirs:
+            names.update(name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name)))
+        return iter(sorted(names))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+_libraries = None
+_cache = None
+
+def _init_worker(library_dirs, cache_dir=None, cache_size=None):
+    global _libraries, _cache
+    _libraries = LibraryDirs(library_dirs)
+    _cache = CompileCache(cache_dir, cache_size) if cache_dir is not None else None
+
+
+def compile_file(source_path, output_base, output_format, workers=None, stream=False, source_map=False, optimize=False):
+    """
+    编译单个文件并写出各个块，返回 (源文件, 错误信息或 None, 窥孔优化节省的字节数, 是否直接使用了缓存的结果)。
+    stream=True 时每个块完成后立即写出。
+    """
+    rop = ROPCompiler(_libraries, workers=workers, source_map=source_map, optimize=optimize, cache=None if stream else _cache)
+    try:
+        with open(source_path, encoding="utf-8") as f:
+            source = f.read()
+        os.makedirs(os.path.dirname(output_base) or ".", exist_ok=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            blocks = rop.CompileStream(source) if stream else rop.Compile(source).items()
+            for block_name, block in blocks:
+                write_block(output_base, output_format, block_name, block)
+        if source_map:
+            with open(f"{output_base}.map.json", "w", encoding="utf-8") as f:
+                json.dump({
+                    "source": source_path,
+                    "blocks": {block_name: block_map.to_dict() for block_name, block_map in rop.source_maps.items()},
+                    "size_report": rop.SizeReport(),
+                }, f, ensure_ascii=False, indent=1)
+        return source_path, None, sum(report["saved"] for report in rop.optimized.values()), rop.cache_hit
+    except Exception as e:
+        return source_path, str(e), 0, False
+    finally:
+        rop.close()
+
+
+def write_block(output_base, output_format, block_name, block):
+    if output_format == "bin":
+        with open(f"{output_base}.{block_name}.bin", "wb") as f:
+            f.write(block.data)
+    else:
+        with open(f"{output_base}.{block_name}.hex", "w", encoding="utf-8") as f:
+            f.write(block.hex() + "\n")
+
+
+def find_sources(paths):
+    # 返回 (源文件, 相对路径)
+    for path in paths:
+        if os.path.isfile(path):
+            yield path, os.path.basename(path)
+            continue
+        for directory, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                if filename.endswith(".rop"):
+                    source_path = os.path.join(directory, filename)
+                    yield source_path, os.path.relpath(source_path, path)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="批量编译 .rop 程序")
+    arg_parser.add_argument("paths", nargs="+", help=".rop 文件或包含 .rop 文件的目录")
+    arg_parser.add_argument("-o", "--output", default="build", help="输出目录（默认 build）")
+    arg_parser.add_argument("-L", "--library-dir", action="append", dest="library_dirs", help="库文件目录，可重复指定")
+    arg_parser.add_argument("--format", choices=("hex", "bin"), default="hex", help="输出格式（默认 hex）")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=None, help="并行进程数（默认为 CPU 数）")
+    arg_parser.add_argument("--stream", action="store_true", help="逐块编译并写出，内存占用只与最大的块有关（每个块处理两次，且不在块之间并行）")
+    arg_parser.add_argument("--source-map", action="store_true", help="另外写出每段字节的来源与按块、gadget、宏汇总的字节数（不在块之间并行）")
+    arg_parser.add_argument("-O", "--optimize", action="store_true", help="窥孔优化：删除被覆盖的 load、合并相邻的 load（不在块之间并行）")
+    arg_parser.add_argument("--cache", metavar="DIR", help="磁盘缓存目录，未变化的程序不再重新编译（不用于 --stream）")
+    arg_parser.add_argument("--cache-size", type=int, default=256, metavar="MIB", help="磁盘缓存的大小上限（默认 256 MiB）")
+    args = arg_parser.parse_args(argv)
+    if args.stream and args.source_map:
+        arg_parser.error("--source-map cannot be combined with --stream")
+    if args.stream and args.optimize:
+        arg_parser.error("--optimize cannot be combined with --stream")
+
+    library_dirs = args.library_dirs or [DEFAULT_LIBRARY_DIR]
+    jobs = []
+    for source_path, relative_path in find_sources(args.paths):
+        output_base = os.path.join(args.output, os.path.splitext(relative_path)[0])
+        jobs.append((source_path, output_base, args.format, None, args.stream, args.source_map, args.optimize))
+
+    cache_args = (args.cache, args.cache_size * 1024 * 1024)
+    if len(jobs) == 1:
+        _init_worker(library_dirs, *cache_args)
+        source_path, output_base, output_format, _, stream, source_map, optimize = jobs[0]
+        results = [compile_file(source_path, output_base, output_format, None if stream else args.jobs or os.cpu_count(), stream, source_map, optimize)]
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker, initargs=(library_dirs, *cache_args)) as pool:
+            results = [future.result() for future in [pool.submit(compile_file, *job) for job in jobs]]
+
+    failed = 0
+    cached = 0
+    for source_path, error, saved, cache_hit in results:
+        cached += cache_hit
+        if error is not None:
+            failed += 1
+            print(f"error: {source_path}: {error}", file=sys.stderr)
+        elif args.optimize:
+            print(f"{source_path}: {saved} bytes saved", file=sys.stderr)
+
+    print(f"{len(jobs) - failed}/{len(jobs)} programs compiled" + (f" ({cached} from cache)" if args.cache else ""), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())